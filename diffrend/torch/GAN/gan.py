@@ -19,14 +19,11 @@ from diffrend.torch.GAN.datasets import Dataset_load
 from diffrend.torch.GAN.twin_networks import create_networks
 from diffrend.torch.GAN.parameters_halfbox_shapenet import Parameters
 from diffrend.torch.params import SCENE_SPHERE_HALFBOX_0
+from diffrend.torch.GAN.losses import SplatRegularizer
 from diffrend.torch.utils import (tch_var_f, tch_var_l, get_data,
-                                  get_normalmap_image, cam_to_world,
-                                  unit_norm2_L2loss, normal_consistency_cost,
-                                  away_from_camera_penalty, spatial_3x3,
-                                  depth_rgb_gradient_consistency,
-                                  grad_spatial2d)
+                                  get_normalmap_image, cam_to_world)
 from diffrend.torch.renderer import (render, render_splats_along_ray,
-                                     z_to_pcl_CC)
+                                     render_splats_along_ray_batched, z_to_pcl_CC)
 from diffrend.torch.NEstNet import NEstNetV1_2
 from diffrend.utils.sample_generator import uniform_sample_sphere
 from diffrend.utils.utils import contrast_stretch_percentile, save_xyz
@@ -83,6 +80,26 @@ def create_scene(width, height, fovy, focal_length, n_samples):
     return scene
 
 
+def set_mesh_objects(scene, mesh, num_static=0):
+    """Put a (collated) dataset mesh into the scene. Its last num_static faces (the background,
+    see the bg_model of the datasets) go to scene['static_objects'], i.e., a static layer."""
+    face = mesh['face'][0].cuda()
+    normal = mesh['normal'][0].cuda()
+    num_dynamic = face.shape[0] - num_static
+    layers = [(scene['objects'], 0, num_dynamic)]
+    scene.pop('static_objects', None)
+    if num_static > 0:
+        scene['static_objects'] = {}
+        layers.append((scene['static_objects'], num_dynamic, face.shape[0]))
+    scene['objects'].pop('triangle', None)
+    for objects, start, end in layers:
+        if end > start:
+            objects['triangle'] = {
+                'face': Variable(face[start:end], requires_grad=False),
+                'normal': Variable(normal[start:end], requires_grad=False),
+                'material_idx': tch_var_l(np.zeros(end - start, dtype=int).tolist())}
+
+
 def calc_gradient_penalty(discriminator, real_data, fake_data, fake_data_cond,
                           gp_lambda):
     """Calculate GP."""
@@ -233,6 +250,7 @@ class GAN(object):
     def create_criterion(self, ):
         """Create criterion."""
         self.criterion = nn.BCELoss()
+        self.regularizer = SplatRegularizer(self.opt)
         if not self.opt.no_cuda:
             self.criterion = self.criterion.cuda()
 
@@ -330,20 +348,12 @@ class GAN(object):
                     del large_scene['objects']['sphere']
                 if 'disk' in large_scene['objects']:
                     del large_scene['objects']['disk']
-                if 'triangle' not in large_scene['objects']:
-                    large_scene['objects'] = {
-                        'triangle': {'face': None, 'normal': None,
-                                     'material_idx': None}}
                 samples = self.get_samples()
-
-                large_scene['objects']['triangle']['material_idx'] = tch_var_l(
-                    np.zeros(samples['mesh']['face'][0].shape[0],
-                             dtype=int).tolist())
-                large_scene['objects']['triangle']['face'] = Variable(
-                    samples['mesh']['face'][0].cuda(), requires_grad=False)
-                large_scene['objects']['triangle']['normal'] = Variable(
-                    samples['mesh']['normal'][0].cuda(),
-                    requires_grad=False)
+                # With static_bg, the background is traced once as a static layer and the
+                # foreground object only within its screen footprint
+                num_static = (int(samples['mesh']['num_static'][0])
+                              if self.opt.static_bg and 'num_static' in samples['mesh'] else 0)
+                set_mesh_objects(large_scene, samples['mesh'], num_static)
             else:
                 if 'sphere' in large_scene['objects']:
                     del large_scene['objects']['sphere']
@@ -374,14 +384,19 @@ class GAN(object):
             large_scene['lights']['pos'][0,:3]=tch_var_f(self.light_pos[idx])
 
             # Render scene
+            # Single-channel (depth) training only needs the depth-only path
             res = render(large_scene,
-                         norm_depth_image_only=self.opt.norm_depth_image_only,
+                         norm_depth_image_only=(self.opt.norm_depth_image_only or
+                                                self.opt.render_img_nc == 1),
                          double_sided=True, use_quartic=self.opt.use_quartic)
 
             # Get rendered output
             if self.opt.render_img_nc == 1:
+                # The depth-only path has no normals: the real samples are the depth, as in render_batch
                 depth = res['depth']
                 im_d = depth.unsqueeze(0)
+                im = im_d
+                im_n = None
             else:
                 depth = res['depth']
                 im_d = depth.unsqueeze(0)
@@ -394,34 +409,38 @@ class GAN(object):
 
             # Add depth image to the output structure
             if self.iterationa_no % self.opt.save_image_interval == 0:
-                imsave((inpath + str(self.iterationa_no) +
-                        'real_normalmap_{:05d}.png'.format(idx)),
-                       target_normalmap_img_)
+                if im_n is not None:
+                    imsave((inpath + str(self.iterationa_no) +
+                            'real_normalmap_{:05d}.png'.format(idx)),
+                           target_normalmap_img_)
                 imsave((inpath + str(self.iterationa_no) +
                         'real_depth_{:05d}.png'.format(idx)), get_data(depth))
                 # imsave(inpath + str(self.iterationa_no) + 'real_depthmap_{:05d}.png'.format(idx), im_d)
                 # imsave(inpath + str(self.iterationa_no) + 'world_normalmap_{:05d}.png'.format(idx), target_worldnormalmap_img_)
             data.append(im)
             data_depth.append(im_d)
-            data_normal.append(im_n)
+            if im_n is not None:
+                data_normal.append(im_n)
             data_cond.append(large_scene['camera']['eye'])
         # Stack real samples
         real_samples = torch.stack(data)
         real_samples_depth = torch.stack(data_depth)
-        real_samples_normal = torch.stack(data_normal)
+        real_samples_normal = torch.stack(data_normal) if data_normal else None
         real_samples_cond = torch.stack(data_cond)
         self.batch_size = real_samples.size(0)
         if not self.opt.no_cuda:
             real_samples = real_samples.cuda()
             real_samples_depth = real_samples_depth.cuda()
-            real_samples_normal = real_samples_normal.cuda()
+            if real_samples_normal is not None:
+                real_samples_normal = real_samples_normal.cuda()
             real_samples_cond = real_samples_cond.cuda()
 
         # Set input/output variables
 
         self.input.resize_as_(real_samples.data).copy_(real_samples.data)
         self.input_depth.resize_as_(real_samples_depth.data).copy_(real_samples_depth.data)
-        self.input_normal.resize_as_(real_samples_normal.data).copy_(real_samples_normal.data)
+        if real_samples_normal is not None:
+            self.input_normal.resize_as_(real_samples_normal.data).copy_(real_samples_normal.data)
         self.input_cond.resize_as_(real_samples_cond.data).copy_(real_samples_cond.data)
         self.label.resize_(self.batch_size).fill_(self.real_label)
         # TODO: Remove Variables
@@ -551,105 +570,49 @@ class GAN(object):
         self.scene['camera']['at'] = tch_var_f(lookat)
         self.scene['objects']['disk']['material_idx'] = tch_var_l(
             np.zeros(self.opt.splats_img_size * self.opt.splats_img_size))
-        loss = 0.0
-        loss_ = 0.0
-        z_loss_ = 0.0
-        z_norm_loss_ = 0.0
-        spatial_loss_ = 0.0
-        spatial_var_loss_ = 0.0
-        unit_normal_loss_ = 0.0
-        normal_away_from_cam_loss_ = 0.0
-        image_depth_consistency_loss_ = 0.0
-        for idx in range(batch_size):
-            # Get splats positions and normals
-            eps = 1e-3
-            if self.opt.rescaled:
-                z = F.relu(-batch[idx][:, 0]) + z_min
-                z = ((z - z.min()) / (z.max() - z.min() + eps) *
-                     (z_max - z_min) + z_min)
-                pos = -z
-            else:
-                z = F.relu(-batch[idx][:, 0]) + z_min
-                pos = -F.relu(-batch[idx][:, 0]) - z_min
-            normals = batch[idx][:, 1:]
-
-            self.scene['objects']['disk']['pos'] = pos
-
-            # Normal estimation network and est_normals don't go together
-            self.scene['objects']['disk']['normal'] = normals if self.opt.est_normals is False else None
-
-            # Set camera position
-            if batch_cond is None:
-                if not self.opt.same_view:
-                    self.scene['camera']['eye'] = tch_var_f(cam_pos[idx])
-                else:
-                    self.scene['camera']['eye'] = tch_var_f(cam_pos[0])
-            else:
-                if not self.opt.same_view:
-                    self.scene['camera']['eye'] = batch_cond[idx]
-                else:
-                    self.scene['camera']['eye'] = batch_cond[0]
-
-            self.scene['lights']['pos'][0,:3]=tch_var_f(self.light_pos[idx])
+        # Get splats positions and normals
+        eps = 1e-3
+        z = F.relu(-batch[..., 0]) + z_min
+        if self.opt.rescaled:
+            z_lo = z.min(dim=1, keepdim=True)[0]
+            z_hi = z.max(dim=1, keepdim=True)[0]
+            z = (z - z_lo) / (z_hi - z_lo + eps) * (z_max - z_min) + z_min
+        pos = -z
+        # Normal estimation network and est_normals don't go together
+        normals = batch[..., 1:] if self.opt.est_normals is False else None
+
+        # Camera and light position of each sample
+        if batch_cond is None:
+            cam_eyes = tch_var_f(cam_pos[:batch_size] if not self.opt.same_view else
+                                 np.repeat(cam_pos[:1], batch_size, axis=0))
+        else:
+            cam_eyes = batch_cond if not self.opt.same_view else batch_cond[:1].expand(batch_size, -1)
+        cameras = dict(self.scene['camera'],
+                       eye=cam_eyes,
+                       at=self.scene['camera']['at'][np.newaxis].expand(batch_size, -1),
+                       up=self.scene['camera']['up'][np.newaxis].expand(batch_size, -1))
+        light_pos = self.scene['lights']['pos'][np.newaxis].repeat(batch_size, 1, 1)
+        light_pos[:, 0, :3] = tch_var_f(self.light_pos[:batch_size])
+        lights = dict(self.scene['lights'], pos=light_pos)
+
+        # Render the whole batch at once
+        res_batch = render_splats_along_ray_batched(self.scene, pos, normals, cameras, lights,
+                                                    samples=self.opt.pixel_samples,
+                                                    normal_estimation_method='plane')
+        # Regularizers of the whole batch, the statistics stay on the device
+        loss, stats = self.regularizer(
+            res_batch['image'], res_batch['depth'], res_batch['pos'],
+            res_batch['normal'], z_min, z_max,
+            res_batch['depth'][..., np.newaxis] if self.opt.render_img_nc == 1 else None)
 
-            # Render scene
-            # res = render_splats_NDC(self.scene)
-            res = render_splats_along_ray(self.scene,
-                                          samples=self.opt.pixel_samples,
-                                          normal_estimation_method='plane')
+        for idx in range(batch_size):
+            self.scene['camera']['eye'] = cam_eyes[idx]
+            res = {key: value[idx] for key, value in res_batch.items()}
 
             world_tform = cam_to_world(res['pos'].view((-1, 3)),
                                        res['normal'].view((-1, 3)),
                                        self.scene['camera'])
 
-            # Get rendered output
-            res_pos = res['pos'].contiguous()
-            res_pos_2D = res_pos.view(res['image'].shape)
-            # The z_loss needs to be applied after supersampling
-            # TODO: Enable this (currently final loss becomes NaN!!)
-            # loss += torch.mean(
-            #    (10 * F.relu(z_min - torch.abs(res_pos[..., 2]))) ** 2 +
-            #    (10 * F.relu(torch.abs(res_pos[..., 2]) - z_max)) ** 2)
-
-
-            res_normal = res['normal']
-            # depth_grad_loss = spatial_3x3(res['depth'][..., np.newaxis])
-            # grad_img = grad_spatial2d(torch.mean(res['image'], dim=-1)[..., np.newaxis])
-            # grad_depth_img = grad_spatial2d(res['depth'][..., np.newaxis])
-            image_depth_consistency_loss = depth_rgb_gradient_consistency(
-                res['image'], res['depth'])
-            unit_normal_loss = unit_norm2_L2loss(res_normal, 10.0)  # TODO: MN
-            normal_away_from_cam_loss = away_from_camera_penalty(
-                res_pos, res_normal)
-            z_pos = res_pos[..., 2]
-            z_loss = torch.mean((2 * F.relu(z_min - torch.abs(z_pos))) ** 2 +
-                                (2 * F.relu(torch.abs(z_pos) - z_max)) ** 2)
-            z_norm_loss = normal_consistency_cost(
-                res_pos, res['normal'], norm=1)
-            spatial_loss = spatial_3x3(res_pos_2D)
-            spatial_var = torch.mean(res_pos[..., 0].var() +
-                                     res_pos[..., 1].var() +
-                                     res_pos[..., 2].var())
-            spatial_var_loss = (1 / (spatial_var + 1e-4))
-
-            loss = (self.opt.zloss * z_loss +
-                    self.opt.unit_normalloss*unit_normal_loss +
-                    self.opt.normal_consistency_loss_weight * z_norm_loss +
-                    self.opt.spatial_var_loss_weight * spatial_var_loss +
-                    self.opt.grad_img_depth_loss*image_depth_consistency_loss +
-                    self.opt.spatial_loss_weight * spatial_loss)
-            pos_out_ = get_data(res['pos'])
-            loss_ += get_data(loss)
-            z_loss_ += get_data(z_loss)
-            z_norm_loss_ += get_data(z_norm_loss)
-            spatial_loss_ += get_data(spatial_loss)
-            spatial_var_loss_ += get_data(spatial_var_loss)
-            unit_normal_loss_ += get_data(unit_normal_loss)
-            normal_away_from_cam_loss_ += get_data(normal_away_from_cam_loss)
-            image_depth_consistency_loss_ += get_data(
-                image_depth_consistency_loss)
-            normals_ = get_data(res_normal)
-
             if self.opt.render_img_nc == 1:
                 depth = res['depth']
                 im = depth.unsqueeze(0)
@@ -657,6 +620,8 @@ class GAN(object):
                 depth = res['depth']
                 im_d = depth.unsqueeze(0)
                 im = res['image'].permute(2, 0, 1)
+            if self.iterationa_no % self.opt.save_image_interval == 0:
+                # Only read the normal maps back when they are saved
                 H, W = im.shape[1:]
                 target_normal_ = get_data(res['normal']).reshape((H, W, 3))
                 target_normalmap_img_ = get_normalmap_image(target_normal_)
@@ -664,7 +629,6 @@ class GAN(object):
                     (H, W, 3))
                 target_worldnormalmap_img_ = get_normalmap_image(
                     target_worldnormal_)
-            if self.iterationa_no % self.opt.save_image_interval == 0:
                 imsave((inpath + str(self.iterationa_no) +
                         'normalmap_{:05d}.png'.format(idx)),
                        target_normalmap_img_)
@@ -699,13 +663,6 @@ class GAN(object):
                           'withnormal_world_{:05d}.xyz'.format(idx)),
                          pos=get_data(world_tform['pos']),
                          normal=get_data(world_tform['normal']))
-            if self.opt.gz_gi_loss is not None and self.opt.gz_gi_loss > 0:
-                gradZ = grad_spatial2d(res_pos_2D[:, :, 2][:, :, np.newaxis])
-                gradImg = grad_spatial2d(torch.mean(im,
-                                                    dim=0)[:, :, np.newaxis])
-                for (gZ, gI) in zip(gradZ, gradImg):
-                    loss += (self.opt.gz_gi_loss * torch.mean(torch.abs(
-                                torch.abs(gZ) - torch.abs(gI))))
             # Store normalized depth into the data
             rendered_data.append(im)
             rendered_data_depth.append(im_d)
@@ -716,12 +673,14 @@ class GAN(object):
         rendered_data_depth = torch.stack(rendered_data_depth)
 
         if self.iterationa_no % self.opt.print_interval*4 == 0 and self.in_critic == 0:
-            z__ = pos_out_[..., 2]
+            stats = self.regularizer.to_host(stats)
+            z__ = get_data(res['pos'][..., 2])
+            normals_ = get_data(res['normal'])
             self.writer.add_scalar("loss",
-                                   loss_/self.opt.batchSize,
+                                   stats['loss'],
                                    self.iterationa_no)
             self.writer.add_scalar("nloss",
-                                   unit_normal_loss_/self.opt.batchSize,
+                                   stats['unit_normal_loss'],
                                    self.iterationa_no)
             self.writer.add_scalar("minz",
                                    np.min(z__),
@@ -736,26 +695,30 @@ class GAN(object):
                                    normals_[..., 2].max(),
                                    self.iterationa_no)
             self.writer.add_scalar("z_loss",
-                                   z_loss_/self.opt.batchSize,
+                                   stats['z_loss'],
                                    self.iterationa_no)
             self.writer.add_scalar("z_normal_loss",
-                                   z_norm_loss_/self.opt.batchSize,
+                                   stats['z_normal_loss'],
                                    self.iterationa_no)
             self.writer.add_scalar("spatial_var_loss",
-                                   spatial_var_loss_/self.opt.batchSize,
+                                   stats['spatial_var_loss'],
                                    self.iterationa_no)
             self.writer.add_scalar("normal_away_loss",
-                                   normal_away_from_cam_loss_/self.opt.batchSize,
+                                   stats['normal_away_loss'],
                                    self.iterationa_no)
             self.writer.add_scalar("spatial_loss",
-                                   spatial_loss_/self.opt.batchSize,
+                                   stats['spatial_loss'],
                                    self.iterationa_no)
             self.writer.add_scalar("im_depth_cons_loss",
-                                   image_depth_consistency_loss_/self.opt.batchSize,
+                                   stats['im_depth_cons_loss'],
                                    self.iterationa_no)
 
-            res['pos'].register_hook(self.tensorboard_pos_hook)
-            res['normal'].register_hook(self.tensorboard_normal_hook)
+            # Hook the batch tensors the losses are computed on, and log the
+            # gradients of the last sample
+            res_batch['pos'].register_hook(
+                lambda grad: self.tensorboard_pos_hook(grad[-1]))
+            res_batch['normal'].register_hook(
+                lambda grad: self.tensorboard_normal_hook(grad[-1]))
 
 
             log_to_print = ('it: %d. loss: %f nloss: %f z_loss:%f [%f, %f], '
@@ -763,20 +726,20 @@ class GAN(object):
                             'normal_away_loss: %f, nz_range: [%f, %f], '
                             'spatial_loss: %f, im_depth_cons_loss: %f' %
                             (self.iterationa_no,
-                             loss_/self.opt.batchSize,
-                             unit_normal_loss_/self.opt.batchSize,
-                             z_loss_/self.opt.batchSize,
+                             stats['loss'],
+                             stats['unit_normal_loss'],
+                             stats['z_loss'],
                              np.min(z__), np.max(z__),
-                             z_norm_loss_/self.opt.batchSize,
-                             spatial_var_loss_/self.opt.batchSize,
-                             normal_away_from_cam_loss_/self.opt.batchSize,
+                             stats['z_normal_loss'],
+                             stats['spatial_var_loss'],
+                             stats['normal_away_loss'],
                              normals_[..., 2].min(), normals_[..., 2].max(),
-                             spatial_loss_/self.opt.batchSize,
-                             image_depth_consistency_loss_/self.opt.batchSize))
+                             stats['spatial_loss'],
+                             stats['im_depth_cons_loss']))
             print(log_to_print)
             self.output_loss_file.write(log_to_print)
             self.output_loss_file.flush()
-        return rendered_data, rendered_data_depth, loss/self.opt.batchSize
+        return rendered_data, rendered_data_depth, loss
     def tensorboard_hook(self, grad):
         self.writer.add_scalar("z_gradient_mean",
                                get_data(torch.mean(grad[0])),
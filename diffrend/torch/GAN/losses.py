@@ -0,0 +1,86 @@
+"""Regularization losses on the rendered splats of a GAN batch."""
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from diffrend.torch.utils import (get_data, norm2_sqr,
+                                  away_from_camera_penalty_batched,
+                                  spatial_3x3_batched,
+                                  depth_rgb_gradient_consistency_batched,
+                                  normal_consistency_cost_batched)
+
+
+class SplatRegularizer(nn.Module):
+    """Vectorized version of the per-sample losses of `render_batch`.
+
+    All the terms are computed on the whole batch at once and the returned
+    statistics stay on the device, so that the host only has to read them
+    (with `SplatRegularizer.to_host`) at logging intervals.
+
+    The returned loss is the one of the per-sample loop of `render_batch`,
+    i.e., the loss of the last sample divided by the batch size, unless
+    opt.reg_batch_mean is set, in which case it is the batch mean.
+    """
+    def __init__(self, opt):
+        super(SplatRegularizer, self).__init__()
+        self.weights = {'z_loss': opt.zloss,
+                        'unit_normal_loss': opt.unit_normalloss,
+                        'z_normal_loss': opt.normal_consistency_loss_weight,
+                        'spatial_var_loss': opt.spatial_var_loss_weight,
+                        'im_depth_cons_loss': opt.grad_img_depth_loss,
+                        'spatial_loss': opt.spatial_loss_weight,
+                        'gz_gi_loss': opt.gz_gi_loss or 0.0}
+        self.batch_mean = getattr(opt, 'reg_batch_mean', False)
+
+    def forward(self, image, depth, pos, normal, z_min, z_max, gz_gi_image=None):
+        """
+        Args:
+            image: [B, H, W, 3] rendered images
+            depth: [B, H, W] rendered depth
+            pos: [B, H, W, 3] positions in the camera's coordinate system
+            normal: [B, H, W, 3] normals
+            z_min, z_max: valid depth range
+            gz_gi_image: [B, H, W, C] images whose gradients gz_gi_loss
+                compares with the depth gradients (image by default), i.e.,
+                the rendered data: the depth when render_img_nc == 1
+
+        Returns:
+            (loss, stats). loss is the weighted sum of the terms of the last
+            sample divided by B (or its batch mean with opt.reg_batch_mean),
+            and stats maps each term name (and 'loss') to its batch mean as
+            a detached device tensor.
+        """
+        B = pos.shape[0]
+        abs_z = torch.abs(pos[..., 2]).view(B, -1)
+        terms = {
+            'z_loss': torch.mean((2 * F.relu(z_min - abs_z)) ** 2 +
+                                 (2 * F.relu(abs_z - z_max)) ** 2, dim=-1),
+            'unit_normal_loss': torch.mean(
+                (10.0 * (torch.sqrt(norm2_sqr(normal)) - 1)).view(B, -1) ** 2,
+                dim=-1),
+            'z_normal_loss': normal_consistency_cost_batched(pos, normal, 1),
+            'spatial_var_loss': 1 / (torch.sum(
+                pos.contiguous().view(B, -1, 3).var(dim=1), dim=-1) + 1e-4),
+            'im_depth_cons_loss': depth_rgb_gradient_consistency_batched(
+                image, depth),
+            'spatial_loss': spatial_3x3_batched(pos),
+        }
+        if self.weights['gz_gi_loss'] > 0:
+            # Sum over the 8 neighbours of the mean gradient mismatch
+            terms['gz_gi_loss'] = 8 * depth_rgb_gradient_consistency_batched(
+                image if gz_gi_image is None else gz_gi_image, pos[..., 2])
+
+        loss = sum(self.weights[key] * value for key, value in terms.items())
+        stats = {key: torch.mean(value.detach()) for key, value in terms.items()}
+        stats['normal_away_loss'] = torch.mean(
+            away_from_camera_penalty_batched(pos.detach(), normal.detach()))
+        stats['loss'] = torch.mean(loss.detach())
+        if self.batch_mean:
+            return torch.mean(loss), stats
+        return loss[-1] / B, stats
+
+    @staticmethod
+    def to_host(stats):
+        """Copy the statistics returned by `forward` to the host."""
+        keys = list(stats.keys())
+        values = get_data(torch.stack([stats[key] for key in keys]))
+        return dict(zip(keys, values.tolist()))
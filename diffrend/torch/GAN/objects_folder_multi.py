@@ -79,9 +79,11 @@ class ObjectsFolderMultiObjectDataset(Dataset):
             mesh = obj_to_triangle_spec(obj_model)
             #import ipdb; ipdb.set_trace()
             material_idx = np.array([0] * obj1['f'].shape[0] + [1] * obj2['f'].shape[0])
+            # The background faces are the last num_static ones
             meshes = {'face': mesh['face'].astype(np.float32),
                       'normal': mesh['normal'].astype(np.float32),
-                      'material_idx': material_idx}
+                      'material_idx': material_idx,
+                      'num_static': obj2['f'].shape[0]}
             sample = {'synset': 0, 'mesh': meshes}
             # normalize the vertices
             # v = obj_model['v']
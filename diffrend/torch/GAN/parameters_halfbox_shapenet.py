@@ -67,6 +67,8 @@ class Parameters():
         self.parser.add_argument('--dis_model_path', type=str, default=None, help='dataset root directory')
         self.parser.add_argument('--dis_model_path2', type=str, default=None, help='dataset root directory')
         self.parser.add_argument('--bg_model', type=str, default='../../../data/halfbox.obj', help='Background model path')
+        self.parser.add_argument('--static_bg', action='store_true', default=False,
+                                 help='Render the background of the mesh datasets as a static layer.')
         self.parser.add_argument('--gz_gi_loss', type=float, default=0.0,help='grad z and grad img consistency.')
         self.parser.add_argument('--pixel_samples', type=int, default=1, help="Samples per pixel.")
 
@@ -119,6 +121,9 @@ class Parameters():
                                  help='Spatial variance loss weight.')
         self.parser.add_argument('--spatial_loss_weight', type=float, default=0.5,
                                  help='Spatial smoothness loss weight.')
+        self.parser.add_argument('--reg_batch_mean', action='store_true', default=False,
+                                 help='Average the splat regularizers over the batch (by default, the loss of the '
+                                      'last sample divided by the batch size, as the original per-sample loop).')
         self.parser.add_argument('--beta1', type=float, default=0.0, help='beta1 for adam. default=0.5')
         self.parser.add_argument('--n_iter', type=int, default=45201, help='number of iterations to train')
         self.parser.add_argument('--batchSize', type=int, default=4, help='input batch size')
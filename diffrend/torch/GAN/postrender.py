@@ -20,12 +20,9 @@ from diffrend.torch.GAN.twin_networks import create_networks
 from diffrend.torch.GAN.parameters_halfbox_shapenet import Parameters
 from diffrend.torch.GAN.iterator import Iterator
 from diffrend.torch.params import SCENE_SPHERE_HALFBOX_0
+from diffrend.torch.GAN.losses import SplatRegularizer
 from diffrend.torch.utils import (tch_var_f, tch_var_l, get_data,
-                                  get_normalmap_image, cam_to_world,
-                                  unit_norm2_L2loss, normal_consistency_cost,
-                                  away_from_camera_penalty, spatial_3x3,
-                                  depth_rgb_gradient_consistency,
-                                  grad_spatial2d)
+                                  get_normalmap_image, cam_to_world)
 from diffrend.torch.renderer import (render, render_splats_along_ray,
                                      z_to_pcl_CC)
 from diffrend.torch.NEstNet import NEstNetV1_2
@@ -234,6 +231,7 @@ class GAN(object):
     def create_criterion(self, ):
         """Create criterion."""
         self.criterion = nn.BCELoss()
+        self.regularizer = SplatRegularizer(self.opt)
         if not self.opt.no_cuda:
             self.criterion = self.criterion.cuda()
 
@@ -413,15 +411,7 @@ class GAN(object):
         self.scene['camera']['at'] = tch_var_f(lookat)
         self.scene['objects']['disk']['material_idx'] = tch_var_l(
             np.zeros(self.opt.splats_img_size * self.opt.splats_img_size))
-        loss = 0.0
-        loss_ = 0.0
-        z_loss_ = 0.0
-        z_norm_loss_ = 0.0
-        spatial_loss_ = 0.0
-        spatial_var_loss_ = 0.0
-        unit_normal_loss_ = 0.0
-        normal_away_from_cam_loss_ = 0.0
-        image_depth_consistency_loss_ = 0.0
+        results = []
         for idx in range(batch_size):
             # Get splats positions and normals
             eps = 1e-3
@@ -460,59 +450,12 @@ class GAN(object):
             res = render_splats_along_ray(self.scene,
                                           samples=self.opt.pixel_samples,
                                           normal_estimation_method='plane')
+            results.append(res)
 
             world_tform = cam_to_world(res['pos'].view((-1, 3)),
                                        res['normal'].view((-1, 3)),
                                        self.scene['camera'])
 
-            # Get rendered output
-            res_pos = res['pos'].contiguous()
-            res_pos_2D = res_pos.view(res['image'].shape)
-            # The z_loss needs to be applied after supersampling
-            # TODO: Enable this (currently final loss becomes NaN!!)
-            # loss += torch.mean(
-            #    (10 * F.relu(z_min - torch.abs(res_pos[..., 2]))) ** 2 +
-            #    (10 * F.relu(torch.abs(res_pos[..., 2]) - z_max)) ** 2)
-
-
-            res_normal = res['normal']
-            # depth_grad_loss = spatial_3x3(res['depth'][..., np.newaxis])
-            # grad_img = grad_spatial2d(torch.mean(res['image'], dim=-1)[..., np.newaxis])
-            # grad_depth_img = grad_spatial2d(res['depth'][..., np.newaxis])
-            image_depth_consistency_loss = depth_rgb_gradient_consistency(
-                res['image'], res['depth'])
-            unit_normal_loss = unit_norm2_L2loss(res_normal, 10.0)  # TODO: MN
-            normal_away_from_cam_loss = away_from_camera_penalty(
-                res_pos, res_normal)
-            z_pos = res_pos[..., 2]
-            z_loss = torch.mean((2 * F.relu(z_min - torch.abs(z_pos))) ** 2 +
-                                (2 * F.relu(torch.abs(z_pos) - z_max)) ** 2)
-            z_norm_loss = normal_consistency_cost(
-                res_pos, res['normal'], norm=1)
-            spatial_loss = spatial_3x3(res_pos_2D)
-            spatial_var = torch.mean(res_pos[..., 0].var() +
-                                     res_pos[..., 1].var() +
-                                     res_pos[..., 2].var())
-            spatial_var_loss = (1 / (spatial_var + 1e-4))
-
-            loss = (self.opt.zloss * z_loss +
-                    self.opt.unit_normalloss*unit_normal_loss +
-                    self.opt.normal_consistency_loss_weight * z_norm_loss +
-                    self.opt.spatial_var_loss_weight * spatial_var_loss +
-                    self.opt.grad_img_depth_loss*image_depth_consistency_loss +
-                    self.opt.spatial_loss_weight * spatial_loss)
-            pos_out_ = get_data(res['pos'])
-            loss_ += get_data(loss)
-            z_loss_ += get_data(z_loss)
-            z_norm_loss_ += get_data(z_norm_loss)
-            spatial_loss_ += get_data(spatial_loss)
-            spatial_var_loss_ += get_data(spatial_var_loss)
-            unit_normal_loss_ += get_data(unit_normal_loss)
-            normal_away_from_cam_loss_ += get_data(normal_away_from_cam_loss)
-            image_depth_consistency_loss_ += get_data(
-                image_depth_consistency_loss)
-            normals_ = get_data(res_normal)
-
             if self.opt.render_img_nc == 1:
                 depth = res['depth']
                 im = depth.unsqueeze(0)
@@ -520,6 +463,8 @@ class GAN(object):
                 depth = res['depth']
                 im_d = depth.unsqueeze(0)
                 im = res['image'].permute(2, 0, 1)
+            if self.iterationa_no % (self.opt.save_image_interval*5) == 0:
+                # Only read the normal maps back when they are saved
                 H, W = im.shape[1:]
                 target_normal_ = get_data(res['normal']).reshape((H, W, 3))
                 target_normalmap_img_ = get_normalmap_image(target_normal_)
@@ -527,7 +472,6 @@ class GAN(object):
                     (H, W, 3))
                 target_worldnormalmap_img_ = get_normalmap_image(
                     target_worldnormal_)
-            if self.iterationa_no % (self.opt.save_image_interval*5) == 0:
                 imsave((inpath + str(self.iterationa_no) +
                         'normalmap_{:05d}.png'.format(idx)),
                        target_normalmap_img_)
@@ -562,13 +506,6 @@ class GAN(object):
                           'withnormal_world_{:05d}.xyz'.format(idx)),
                          pos=get_data(world_tform['pos']),
                          normal=get_data(world_tform['normal']))
-            if self.opt.gz_gi_loss is not None and self.opt.gz_gi_loss > 0:
-                gradZ = grad_spatial2d(res_pos_2D[:, :, 2][:, :, np.newaxis])
-                gradImg = grad_spatial2d(torch.mean(im,
-                                                    dim=0)[:, :, np.newaxis])
-                for (gZ, gI) in zip(gradZ, gradImg):
-                    loss += (self.opt.gz_gi_loss * torch.mean(torch.abs(
-                                torch.abs(gZ) - torch.abs(gI))))
             # Store normalized depth into the data
             rendered_data.append(im)
             rendered_data_depth.append(im_d)
@@ -578,8 +515,15 @@ class GAN(object):
         rendered_data = torch.stack(rendered_data)
         rendered_data_depth = torch.stack(rendered_data_depth)
 
+        # Regularizers of the whole batch, the statistics stay on the device
+        res_batch = {key: torch.stack([sample[key] for sample in results])
+                     for key in ['image', 'depth', 'pos', 'normal']}
+        loss, _ = self.regularizer(
+            res_batch['image'], res_batch['depth'], res_batch['pos'],
+            res_batch['normal'], z_min, z_max,
+            res_batch['depth'][..., np.newaxis] if self.opt.render_img_nc == 1 else None)
 
-        return rendered_data, rendered_data_depth, loss/self.opt.batchSize
+        return rendered_data, rendered_data_depth, loss
     def tensorboard_hook(self, grad):
         self.writer.add_scalar("z_gradient_mean",
                                get_data(torch.mean(grad[0])),
@@ -83,6 +83,26 @@ def create_scene(width, height, fovy, focal_length, n_samples):
     return scene
 
 
+def set_mesh_objects(scene, mesh, num_static=0):
+    """Put a (collated) dataset mesh into the scene. Its last num_static faces (the background,
+    see the bg_model of the datasets) go to scene['static_objects'], i.e., a static layer."""
+    face = mesh['face'][0].cuda()
+    normal = mesh['normal'][0].cuda()
+    num_dynamic = face.shape[0] - num_static
+    layers = [(scene['objects'], 0, num_dynamic)]
+    scene.pop('static_objects', None)
+    if num_static > 0:
+        scene['static_objects'] = {}
+        layers.append((scene['static_objects'], num_dynamic, face.shape[0]))
+    scene['objects'].pop('triangle', None)
+    for objects, start, end in layers:
+        if end > start:
+            objects['triangle'] = {
+                'face': Variable(face[start:end], requires_grad=False),
+                'normal': Variable(normal[start:end], requires_grad=False),
+                'material_idx': tch_var_l(np.zeros(end - start, dtype=int).tolist())}
+
+
 def calc_gradient_penalty(discriminator, real_data, fake_data, fake_data_cond,
                           gp_lambda):
     """Calculate GP."""
@@ -339,20 +359,12 @@ class GAN(object):
                     del large_scene['objects']['sphere']
                 if 'disk' in large_scene['objects']:
                     del large_scene['objects']['disk']
-                if 'triangle' not in large_scene['objects']:
-                    large_scene['objects'] = {
-                        'triangle': {'face': None, 'normal': None,
-                                     'material_idx': None}}
                 samples = self.get_samples()
-
-                large_scene['objects']['triangle']['material_idx'] = tch_var_l(
-                    np.zeros(samples['mesh']['face'][0].shape[0],
-                             dtype=int).tolist())
-                large_scene['objects']['triangle']['face'] = Variable(
-                    samples['mesh']['face'][0].cuda(), requires_grad=False)
-                large_scene['objects']['triangle']['normal'] = Variable(
-                    samples['mesh']['normal'][0].cuda(),
-                    requires_grad=False)
+                # With static_bg, the background is traced once as a static layer and the
+                # foreground object only within its screen footprint
+                num_static = (int(samples['mesh']['num_static'][0])
+                              if self.opt.static_bg and 'num_static' in samples['mesh'] else 0)
+                set_mesh_objects(large_scene, samples['mesh'], num_static)
             else:
                 if 'sphere' in large_scene['objects']:
                     del large_scene['objects']['sphere']
@@ -384,14 +396,19 @@ class GAN(object):
             #large_scene['lights']['pos'][1,:3]=tch_var_f(self.light_pos2[idx])
 
             # Render scene
+            # Single-channel (depth) training only needs the depth-only path
             res = render(large_scene,
-                         norm_depth_image_only=self.opt.norm_depth_image_only,
+                         norm_depth_image_only=(self.opt.norm_depth_image_only or
+                                                self.opt.render_img_nc == 1),
                          double_sided=True, use_quartic=self.opt.use_quartic)
 
             # Get rendered output
             if self.opt.render_img_nc == 1:
+                # The depth-only path has no normals: the real samples are the depth, as in render_batch
                 depth = res['depth']
                 im_d = depth.unsqueeze(0)
+                im = im_d
+                im_n = None
             else:
                 depth = res['depth']
                 im_d = depth.unsqueeze(0)
@@ -418,37 +435,42 @@ class GAN(object):
             out_file_name4 = inpath2 + str(self.iterationa_no) +"_"+str(self.critic_iter)+'input_depth{:05d}.npy'.format(idx)
             np.save(out_file_name4, get_data(res['depth']))
             out_file_name5 = inpath2 + str(self.iterationa_no) +"_"+str(self.critic_iter)+'input_normal{:05d}.npy'.format(idx)
-            np.save(out_file_name5, get_data(res['normal']))
+            if 'normal' in res:
+                np.save(out_file_name5, get_data(res['normal']))
 
             if self.iterationa_no % (self.opt.save_image_interval*5) == 0:
-                imsave((inpath + str(self.iterationa_no) +
-                        'real_normalmap_{:05d}.png'.format(idx)),
-                       target_normalmap_img_)
+                if im_n is not None:
+                    imsave((inpath + str(self.iterationa_no) +
+                            'real_normalmap_{:05d}.png'.format(idx)),
+                           target_normalmap_img_)
                 imsave((inpath + str(self.iterationa_no) +
                         'real_depth_{:05d}.png'.format(idx)), get_data(depth))
                 # imsave(inpath + str(self.iterationa_no) + 'real_depthmap_{:05d}.png'.format(idx), im_d)
                 # imsave(inpath + str(self.iterationa_no) + 'world_normalmap_{:05d}.png'.format(idx), target_worldnormalmap_img_)
             data.append(im)
             data_depth.append(im_d)
-            data_normal.append(im_n)
+            if im_n is not None:
+                data_normal.append(im_n)
             data_cond.append(large_scene['camera']['eye'])
         # Stack real samples
         real_samples = torch.stack(data)
         real_samples_depth = torch.stack(data_depth)
-        real_samples_normal = torch.stack(data_normal)
+        real_samples_normal = torch.stack(data_normal) if data_normal else None
         real_samples_cond = torch.stack(data_cond)
         self.batch_size = real_samples.size(0)
         if not self.opt.no_cuda:
             real_samples = real_samples.cuda()
             real_samples_depth = real_samples_depth.cuda()
-            real_samples_normal = real_samples_normal.cuda()
+            if real_samples_normal is not None:
+                real_samples_normal = real_samples_normal.cuda()
             real_samples_cond = real_samples_cond.cuda()
 
         # Set input/output variables
 
         self.input.resize_as_(real_samples.data).copy_(real_samples.data)
         self.input_depth.resize_as_(real_samples_depth.data).copy_(real_samples_depth.data)
-        self.input_normal.resize_as_(real_samples_normal.data).copy_(real_samples_normal.data)
+        if real_samples_normal is not None:
+            self.input_normal.resize_as_(real_samples_normal.data).copy_(real_samples_normal.data)
         self.input_cond.resize_as_(real_samples_cond.data).copy_(real_samples_cond.data)
         self.label.resize_(self.batch_size).fill_(self.real_label)
         # TODO: Remove Variables
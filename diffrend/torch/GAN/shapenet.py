@@ -65,6 +65,7 @@ class ShapeNetDataset(Dataset):
 
         # Load obj model
         obj_model = load_model(obj_path)
+        num_static = 0
 
         # Show loaded model
         # animate_sample_generation(model_name=None, obj=obj_model,
@@ -80,6 +81,7 @@ class ShapeNetDataset(Dataset):
             v = np.concatenate((scale * v1 + offset, bg_v))
             f = np.concatenate((obj_model['f'], bg_model['f'] + v1.shape[0]))
             obj_model = {'v': v, 'f': f}
+            num_static = bg_model['f'].shape[0]
 
         if self.opt.use_mesh:
             # normalize the vertices
@@ -88,8 +90,10 @@ class ShapeNetDataset(Dataset):
             v = (v - np.mean(v, axis=0)) / max(axis_range)  # Normalize to make the largest spread 1
             obj_model['v'] = v
             mesh = obj_to_triangle_spec(obj_model)
+            # The background faces are the last num_static ones
             meshes = {'face': mesh['face'].astype(np.float32),
-                      'normal': mesh['normal'].astype(np.float32)}
+                      'normal': mesh['normal'].astype(np.float32),
+                      'num_static': num_static}
             sample = {'synset': synset, 'mesh': meshes}
         else:
             # Sample points from the 3D mesh
@@ -1,6 +1,6 @@
 from diffrend.torch.params import SCENE_BASIC
 from diffrend.torch.utils import tch_var_f, tch_var_l, get_data
-from diffrend.torch.renderer import render
+from diffrend.torch.renderer import render, render_progressive
 from diffrend.utils.sample_generator import uniform_sample_sphere
 from diffrend.model import load_model, obj_to_triangle_spec
 from data import DIR_DATA
@@ -57,7 +57,8 @@ def batch_render_random_camera(filename, cam_dist, num_views, width, height,
                          fovy, focal_length, theta_range=None, phi_range=None,
                          axis=None, angle=None, cam_pos=None, cam_lookat=None,
                          double_sided=False, use_quartic=False, b_shadow=True,
-                         tile_size=None, save_image_queue=None):
+                         tile_size=None, save_image_queue=None, aa_max_passes=1, aa_var_threshold=None,
+                         aa_time_budget=None):
     rendering_time = []
 
     obj = load_model(filename)
@@ -101,9 +102,15 @@ def batch_render_random_camera(filename, cam_dist, num_views, width, height,
 
         # main render run
         start_time = time()
-        res = render(scene, tile_size=tile_size, tiled=tile_size is not None,
-                     shadow=b_shadow, double_sided=double_sided,
-                     use_quartic=use_quartic)
+        render_params = dict(tile_size=tile_size, tiled=tile_size is not None,
+                             shadow=b_shadow, double_sided=double_sided,
+                             use_quartic=use_quartic)
+        if aa_max_passes > 1:
+            # Progressive anti-aliasing: jittered passes until the variance or time budget is reached
+            res = render_progressive(scene, aa_max_passes=aa_max_passes, aa_var_threshold=aa_var_threshold,
+                                     aa_time_budget=aa_time_budget, **render_params)
+        else:
+            res = render(scene, **render_params)
         res['suffix'] = '_{}'.format(idx)
         res['camera_far'] = scene['camera']['far']
         save_image_queue.put_nowait(get_data(res))
@@ -136,6 +143,12 @@ if __name__ == '__main__':
     parser.add_argument('--use-quartic', action='store_true', help='Use quartic attenuation.')
     parser.add_argument('--tile-size', type=int, default=64**2, help='tile size.')
     parser.add_argument('--shadow', action='store_true', default=True, help='Render shadows')
+    parser.add_argument('--aa-max-passes', type=int, default=1, help='Maximum number of progressive '
+                                                                     'anti-aliasing passes per view.')
+    parser.add_argument('--aa-var-threshold', type=float, help='Stop accumulating once the variance of the mean '
+                                                               'image drops below this value.')
+    parser.add_argument('--aa-time-budget', type=float, help='Time budget in seconds per view for the '
+                                                             'anti-aliasing passes.')
 
     args = parser.parse_args()
     print(args)
@@ -174,7 +187,8 @@ if __name__ == '__main__':
                                axis=axis, angle=angle, cam_pos=cam_pos, cam_lookat=args.at,
                                tile_size=args.tile_size, double_sided=args.double_sided,
                                b_shadow=args.shadow, use_quartic=args.use_quartic,
-                               save_image_queue=save_image_queue)
+                               save_image_queue=save_image_queue, aa_max_passes=args.aa_max_passes,
+                               aa_var_threshold=args.aa_var_threshold, aa_time_budget=args.aa_time_budget)
     save_image_queue.put(None)
     write_to_disk_process.join()
 
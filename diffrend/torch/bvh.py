@@ -0,0 +1,177 @@
+"""Bounding volume hierarchy over the scene objects.
+
+The hierarchy is a complete binary tree over leaves of `leaf_size` objects sorted along a Morton
+curve (i.e., a linear BVH), stored level by level, so that it can be refit bottom-up in O(M) when
+the objects move (e.g., during an optimization) instead of being rebuilt. The tree is only rebuilt
+when the surface area heuristic (SAH) cost of the refit tree grows by `rebuild_threshold` over the
+cost it had when it was built.
+
+Every tile of rays of `nearest_fragments` traverses the tree as a packet, and only the objects of
+the leaves hit by at least one ray of the tile are intersected (see `render` with params['bvh']).
+"""
+import numpy as np
+import torch
+from diffrend.torch.utils import get_data
+
+
+def object_bounds(scene_objects):
+    """[M x 2 x 3] axis-aligned bounds (min, max) of the objects, in the order of ray_object_intersections.
+    Planes are unbounded, i.e., their bounds are (-inf, inf).
+    """
+    bounds = []
+    for obj_type in scene_objects:
+        obj = scene_objects[obj_type]
+        if obj_type == 'triangle':
+            vertices = obj['face'][:, :, :3]
+            lo, hi = torch.min(vertices, dim=1)[0], torch.max(vertices, dim=1)[0]
+        elif obj_type in ['disk', 'sphere']:
+            # A disk is inside the sphere of the same center and radius
+            radius = obj['radius'].view(-1, 1)
+            lo, hi = obj['pos'][:, :3] - radius, obj['pos'][:, :3] + radius
+        else:
+            lo = torch.full((obj['material_idx'].shape[0], 3), -np.inf, device=obj['pos'].device)
+            hi = -lo
+        bounds.append(torch.stack((lo, hi), dim=1))
+    return torch.cat(bounds, dim=0).detach()
+
+
+def box_area(bounds):
+    """Surface area of [... x 2 x 3] boxes, 0 for empty boxes"""
+    extent = torch.clamp(bounds[..., 1, :] - bounds[..., 0, :], min=0)
+    return 2 * (extent[..., 0] * extent[..., 1] + extent[..., 1] * extent[..., 2] + extent[..., 2] * extent[..., 0])
+
+
+def morton_codes(points, bits=10):
+    """30-bit Morton codes of [N x 3] points (quantized to 2^bits cells per axis within their bounds)"""
+    lo, hi = torch.min(points, dim=0)[0], torch.max(points, dim=0)[0]
+    cells = ((points - lo) / torch.clamp(hi - lo, min=1e-12) * (2 ** bits - 1)).long()
+    codes = torch.zeros(points.shape[0], dtype=torch.long, device=points.device)
+    for bit in range(bits):
+        for axis in range(3):
+            codes |= ((cells[:, axis] >> bit) & 1) << (3 * bit + 2 - axis)
+    return codes
+
+
+def ray_box_hits(ray_orig, ray_dir, bounds, near, far, eps=1e-5):
+    """Slab test of every ray against every box.
+    :param ray_orig: [1 x 3] or [N x 3] ray origins
+    :param ray_dir: [3 x N] ray directions
+    :param bounds: [F x 2 x 3] boxes
+    :return: [F x N] mask of the rays that go through the box for a distance in [near, far]
+    """
+    ray_dir = ray_dir.transpose(1, 0)
+    ray_dir = torch.where(torch.abs(ray_dir) < 1e-12, torch.full_like(ray_dir, 1e-12), ray_dir)
+    # Slightly enlarged boxes, so that the test stays conservative
+    pad = eps * (1 + torch.abs(bounds))
+    t0 = ((bounds[:, np.newaxis, 0, :] - pad[:, np.newaxis, 0, :]) - ray_orig[np.newaxis, :, :3]) / ray_dir
+    t1 = ((bounds[:, np.newaxis, 1, :] + pad[:, np.newaxis, 1, :]) - ray_orig[np.newaxis, :, :3]) / ray_dir
+    t_enter = torch.max(torch.min(t0, t1), dim=-1)[0]
+    t_exit = torch.min(torch.max(t0, t1), dim=-1)[0]
+    return (t_exit >= torch.clamp(t_enter, min=near)) * (t_enter <= far)
+
+
+class BVH:
+    """Linear BVH over the bounded objects of a scene (see the module docstring).
+
+    Unbounded objects (planes) are not in the tree and are always intersected.
+    """
+    def __init__(self, scene_objects, leaf_size=8, rebuild_threshold=1.5, traversal_cost=1., intersection_cost=1.):
+        self.leaf_size = leaf_size
+        self.rebuild_threshold = rebuild_threshold
+        self.traversal_cost = traversal_cost
+        self.intersection_cost = intersection_cost
+        self.num_builds = 0
+        self.num_refits = 0
+        self.build(scene_objects)
+
+    def build(self, scene_objects):
+        """Full rebuild: sorts the objects along the Morton curve of their centers."""
+        bounds = object_bounds(scene_objects)
+        self.num_objects = bounds.shape[0]
+        bounded = torch.all(torch.isfinite(bounds.view(-1, 6)), dim=1)
+        self.unbounded = torch.nonzero(~bounded).view(-1)
+        obj_idx = torch.nonzero(bounded).view(-1)
+        if obj_idx.numel() > 0:
+            obj_idx = obj_idx[torch.argsort(morton_codes(torch.mean(bounds[obj_idx], dim=1)))]
+        num_leaves = max(int(np.ceil(obj_idx.numel() / self.leaf_size)), 1)
+        self.depth = int(np.ceil(np.log2(num_leaves)))
+        # The leaves of the complete tree are padded with -1
+        num_slots = 2 ** self.depth * self.leaf_size
+        padding = torch.full((num_slots - obj_idx.numel(),), -1, dtype=torch.long, device=bounds.device)
+        self.leaf_objects = torch.cat((obj_idx, padding)).view(2 ** self.depth, self.leaf_size)
+        self.num_builds += 1
+        self.refit_bounds(bounds)
+        self.build_cost = self.sah()
+
+    def refit_bounds(self, bounds):
+        """Bottom-up update of the node bounds from [M x 2 x 3] object bounds"""
+        empty = torch.tensor([[np.inf] * 3, [-np.inf] * 3], device=bounds.device)
+        slot_bounds = torch.cat((bounds, empty[np.newaxis]), dim=0)[self.leaf_objects]
+        level = torch.stack((torch.min(slot_bounds[:, :, 0], dim=1)[0], torch.max(slot_bounds[:, :, 1], dim=1)[0]), 1)
+        self.levels = [level]
+        for _ in range(self.depth):
+            children = level.view(-1, 2, 2, 3)
+            level = torch.stack((torch.min(children[:, :, 0], dim=1)[0], torch.max(children[:, :, 1], dim=1)[0]), 1)
+            self.levels.insert(0, level)
+
+    def sah(self):
+        """SAH cost of the tree, relative to the area of the root"""
+        root_area = box_area(self.levels[0][0])
+        if root_area <= 0:
+            return 0.
+        counts = torch.sum(self.leaf_objects >= 0, dim=1).float()
+        cost = self.traversal_cost * sum([torch.sum(box_area(level)) for level in self.levels[:-1]]) + \
+            self.intersection_cost * torch.sum(box_area(self.levels[-1]) * counts)
+        return float(cost / root_area)
+
+    def refit(self, scene_objects):
+        """Refit the tree to the current objects, and rebuild it if its SAH cost grew by more than
+        rebuild_threshold since the last build (or if the number of objects changed).
+        :return: True if the tree was rebuilt
+        """
+        bounds = object_bounds(scene_objects)
+        if bounds.shape[0] != self.num_objects:
+            self.build(scene_objects)
+            return True
+        self.refit_bounds(bounds)
+        self.num_refits += 1
+        if self.sah() > self.rebuild_threshold * self.build_cost:
+            self.build(scene_objects)
+            return True
+        return False
+
+    def candidates(self, ray_orig, ray_dir, near, far):
+        """Packet traversal.
+        :return: [K] sorted indices of the objects in the leaves hit by at least one of the rays (plus the
+                 unbounded objects, and object 0 so that the rays that hit nothing get the same nearest
+                 object as without the BVH)
+        """
+        nodes = torch.zeros(1, dtype=torch.long, device=ray_dir.device)
+        for depth, level in enumerate(self.levels):
+            nodes = nodes[torch.any(ray_box_hits(ray_orig, ray_dir, level[nodes], near, far), dim=1)]
+            if depth < self.depth:
+                nodes = torch.stack((2 * nodes, 2 * nodes + 1), dim=1).view(-1)
+        obj_idx = self.leaf_objects[nodes].view(-1)
+        first = torch.zeros(1, dtype=torch.long, device=obj_idx.device)
+        return torch.unique(torch.cat((obj_idx[obj_idx >= 0], self.unbounded, first)))
+
+
+def test_bvh(scene, num_iterations=10, step_size=0.05):
+    """render with a BVH must match render without it while the objects move.
+    :param scene: Scene with torch variables (see make_torch_var) with disks or spheres
+    """
+    from diffrend.torch.renderer import render
+    bvh = BVH(scene['objects'])
+    for iteration in range(num_iterations):
+        res_bvh = render(scene, bvh=bvh)
+        res = render(scene)
+        for key in ['image', 'depth', 'nearest']:
+            np.testing.assert_array_equal(get_data(res_bvh[key]), get_data(res[key]))
+        for obj_type in ['disk', 'sphere']:
+            if obj_type in scene['objects']:
+                pos = scene['objects'][obj_type]['pos']
+                offset = step_size * torch.randn_like(pos)
+                offset[:, 3:] = 0
+                scene['objects'][obj_type]['pos'] = pos + offset
+    print('builds: {}, refits: {}, SAH: {:.2f} (at build {:.2f})'.format(bvh.num_builds, bvh.num_refits, bvh.sah(),
+                                                                        bvh.build_cost))
@@ -2,9 +2,10 @@ import torch
 import numpy as np
 from diffrend.torch.utils import cam_to_world, world_to_cam, world_to_cam_batched, cam_to_world_batched, get_data
 from diffrend.torch.render import render_scene, load_scene, make_torch_var
-from diffrend.torch.utils import make_list2np, tch_var_f, tch_var_l, scatter_mean_dim0, scatter_weighted_blended_oit, nonzero_divide
+from diffrend.torch.utils import make_list2np, tch_var_f, tch_var_l, scatter_mean_dim0, scatter_weighted_blended_oit_grouped, nonzero_divide
 from diffrend.torch.renderer import z_to_pcl_CC, z_to_pcl_CC_batched, render
 import copy
+import functools
 import math
 
 
@@ -105,11 +106,72 @@ def projection_renderer(surfels, rgb, camera):
     rgb_out, mask = scatter_mean_dim0(rgb_reshaped, px_idx.long())
     return rgb_out.reshape(rgb.shape), mask.reshape(rgb.shape)
 
-def projection_renderer_differentiable(surfels, rgb, camera, rotated_image=None, blur_size=0.15):
+def projection_renderer_differentiable(surfels, rgb, camera, rotated_image=None, blur_size=0.15, num_sigmas=3):
     """Project surfels given in world coordinate to the camera's projection plane
        in a way that is differentiable w.r.t depth. This is achieved by interpolating
        the surfel values using a Gaussian filter.
 
+       Each surfel is only splatted to the pixels within `num_sigmas` standard deviations of its projection,
+       so the memory is O(num_surfels * window) instead of O(H*W * num_surfels) for the dense version.
+
+    Args:
+        surfels: [batch_size, num_surfels, pos]
+        rgb: [batch_size, num_surfels, D-channel data] or [batch_size, H, W, D-channel data]
+        camera: [{'eye': [num_batches,...], 'lookat': [num_batches,...], 'up': [num_batches,...],
+                    'viewport': [0, 0, W, H], 'fovy': <radians>}]
+        rotated_image: [batch_size, num_surfels, D-channel data] or [batch_size, H, W, D-channel data]
+                        Image to mix in with the result of the rotation.
+        blur_size: Determines the std of the Gaussian used for filtering (see `blur`).
+        num_sigmas: Radius of the splatting window in standard deviations.
+
+    Returns:
+        RGB image of dimensions [batch_size, H, W, 3] from projected surfels
+
+    """
+    _, px_coord = project_image_coordinates(surfels, camera)
+    viewport = make_list2np(camera['viewport'])
+    W = int(viewport[2] - viewport[0])
+    H = int(viewport[3] - viewport[1])
+    rgb_reshaped = rgb.view(rgb.size(0), -1, rgb.size(-1))
+    batch_size, _, D = rgb_reshaped.size()
+
+    sigma = blur_size * rgb.size(-2) / 6
+    # Pixel centers are at integer + 0.5, so pixels up to half a pixel further than num_sigmas * sigma can be needed
+    radius = int(math.ceil(num_sigmas * sigma + 0.5))
+    xp, yp = px_coord[..., 0], px_coord[..., 1]
+    col = torch.floor(xp).long().unsqueeze(-1) + torch.arange(-radius, radius + 1, device=xp.device)
+    col_dist_2 = (col.float() + 0.5 - xp.unsqueeze(-1)) ** 2
+    col_outside = (col < 0) | (col >= W)
+    row0 = torch.floor(yp).long()
+
+    # The weights are scattered with the data, and out of bounds pixels go to the extra (last) index
+    values = torch.cat((rgb_reshaped, torch.ones_like(rgb_reshaped[..., :1])), -1).unsqueeze(-2)
+    splats = torch.zeros(batch_size, H * W + 1, D + 1, device=rgb.device, dtype=rgb.dtype)
+    for dy in range(-radius, radius + 1):
+        row = (row0 + dy).unsqueeze(-1)
+        scale = torch.exp((-col_dist_2 - (row.float() + 0.5 - yp.unsqueeze(-1)) ** 2) / (2 * sigma ** 2))
+        idx = torch.where(col_outside | (row < 0) | (row >= H), torch.full_like(col, H * W), row * W + col)
+        splats = splats.scatter_add(1, idx.view(batch_size, -1, 1).expand(-1, -1, D + 1),
+                                    (scale.unsqueeze(-1) * values).view(batch_size, -1, D + 1))
+
+    mask = splats[:, :-1, D]
+    if rotated_image is not None:
+        rotated_image = rotated_image.view(*rgb_reshaped.size())
+        out = splats[:, :-1, :D] + rotated_image * (1 - mask).unsqueeze(-1)
+    else:
+        out = splats[:, :-1, :D] / (mask + 1e-10).unsqueeze(-1)
+
+    return out.contiguous().view(*rgb.size()), mask.contiguous().view(*rgb.size()[:-1], 1)
+
+
+def projection_renderer_differentiable_dense(surfels, rgb, camera, rotated_image=None, blur_size=0.15):
+    """Reference implementation of `projection_renderer_differentiable` that weights every surfel
+       for every pixel ([batch_size, H*W, num_surfels] weights).
+
+       Project surfels given in world coordinate to the camera's projection plane
+       in a way that is differentiable w.r.t depth. This is achieved by interpolating
+       the surfel values using a Gaussian filter.
+
     Args:
         surfels: [batch_size, num_surfels, pos]
         rgb: [batch_size, num_surfels, D-channel data] or [batch_size, H, W, D-channel data]
@@ -145,29 +207,75 @@ def projection_renderer_differentiable(surfels, rgb, camera, rotated_image=None,
     if rotated_image is not None:
         rotated_image = rotated_image.view(*rgb_reshaped.size())
         # out = (rotated_image_weight * rotated_image + torch.sum(scale.unsqueeze(-1) * rgb_reshaped.unsqueeze(-3), -2)) / (scale.sum(-1) + rotated_image_weight + 1e-10).unsqueeze(-1)
-        out = torch.sum(scale.unsqueeze(-1) * rgb_reshaped.unsqueeze(-3), -2) + rotated_image * (1 - mask)
+        out = torch.sum(scale.unsqueeze(-1) * rgb_reshaped.unsqueeze(-3), -2) + rotated_image * (1 - mask).unsqueeze(-1)
     else:
         out = torch.sum(scale.unsqueeze(-1) * rgb_reshaped.unsqueeze(-3), -2) / (mask + 1e-10).unsqueeze(-1)
 
     return out.view(*rgb.size()), mask.view(*rgb.size()[:-1], 1)
 
 
-def blur(image, blur_size, kernel=None):
+@functools.lru_cache(maxsize=32)
+def gaussian_blur_kernel(sigma, num_channels, device, dtype):
+    """Normalized 1D Gaussian kernel of radius floor(3 * sigma), as a [num_channels, 1, 1, K] depthwise conv weight"""
+    half_kernel_size = math.floor(sigma * 3)
+    x_range = torch.arange(-half_kernel_size, half_kernel_size + 1, device=device).float()
+    kernel = torch.exp(-x_range**2 / (2 * sigma**2))
+    kernel = (kernel / kernel.sum()).to(dtype) # Normalize
+    return kernel.view(1, 1, 1, -1).repeat(num_channels, 1, 1, 1)
+
+
+@functools.lru_cache(maxsize=32)
+def gaussian_blur_kernel_fft(sigma, length, device, dtype):
+    """rfft of the Gaussian kernel zero-padded to `length`"""
+    return torch.fft.rfft(gaussian_blur_kernel(sigma, 1, device, dtype).view(-1), n=length)
+
+
+def fft_conv1d_same(x, kernel_fft, half_kernel_size, dim):
+    """Zero-padded convolution of x along `dim` with a symmetric kernel given by its rfft (see gaussian_blur_kernel_fft)
+    The output has the same size as x."""
+    size = x.size(dim)
+    length = size + 2 * half_kernel_size
+    shape = [1] * x.dim()
+    shape[dim] = -1
+    y = torch.fft.irfft(torch.fft.rfft(x, n=length, dim=dim) * kernel_fft.view(shape), n=length, dim=dim)
+    return y.narrow(dim, half_kernel_size, size)
+
+
+def blur(image, blur_size, kernel=None, fft_kernel_size=31):
+    """Separable Gaussian blur with zero padding.
+
+    Args:
+        image: [batch_size, C, H, W]
+        blur_size: The std of the Gaussian is blur_size * H / 6, and the kernel is truncated at 3 std
+        kernel: Optional [C, C, 1, K] kernel (applied horizontally, then vertically)
+        fft_kernel_size: Kernels larger than this are applied in the Fourier domain
+
+    Returns:
+        [batch_size, C, H, W] blurred image
+    """
     sigma = blur_size * image.size(-2) / 6
     half_kernel_size = math.floor(sigma * 3)
     if kernel is None:
-        num_channels = image.size(-3)
-        x_range = torch.arange(-half_kernel_size, half_kernel_size + 1, device=image.device).float()
-        kernel = torch.exp(-x_range**2 / (2 * sigma**2))
-        kernel = kernel / kernel.sum() # Normalize
-        kernel = torch.eye(num_channels, device=kernel.device).unsqueeze(-1).unsqueeze(-1) * kernel.view(1, 1, 1, -1)
+        if half_kernel_size == 0:
+            return image
+        if 2 * half_kernel_size + 1 > fft_kernel_size:
+            kernel_fft = gaussian_blur_kernel_fft(sigma, image.size(-1) + 2 * half_kernel_size, image.device, image.dtype)
+            blurred = fft_conv1d_same(image, kernel_fft, half_kernel_size, -1)
+            if image.size(-2) != image.size(-1):
+                kernel_fft = gaussian_blur_kernel_fft(sigma, image.size(-2) + 2 * half_kernel_size, image.device,
+                                                      image.dtype)
+            return fft_conv1d_same(blurred, kernel_fft, half_kernel_size, -2)
+        kernel = gaussian_blur_kernel(sigma, image.size(-3), image.device, image.dtype)
+        groups = image.size(-3)
+    else:
+        groups = 1
     # Mirror padding + 2 1D convolutions of the Gaussian kernel
     padded = torch.nn.functional.pad(image, (half_kernel_size, half_kernel_size, half_kernel_size, half_kernel_size), mode='constant') # zero padding
-    blurred = torch.nn.functional.conv2d(padded, kernel)
-    return torch.nn.functional.conv2d(blurred, kernel.transpose(-1, -2))
+    blurred = torch.nn.functional.conv2d(padded, kernel, groups=groups)
+    return torch.nn.functional.conv2d(blurred, kernel.transpose(-1, -2), groups=groups)
 
 
-def projection_renderer_differentiable_fast(surfels, rgb, camera, rotated_image=None, blur_size=0.15, use_depth=True, use_center_dist=True, compute_new_depth=False, blur_rotated_image=True, detach_mask=False, detach_mask2=False, detach_depth_merge=False):
+def projection_renderer_differentiable_fast(surfels, rgb, camera, rotated_image=None, blur_size=0.15, use_depth=True, use_center_dist=True, compute_new_depth=False, blur_rotated_image=True, detach_mask=False, detach_mask2=False, detach_depth_merge=False, top_k=None):
     """Project surfels given in world coordinate to the camera's projection plane
        in a way that is differentiable w.r.t depth. This is achieved by interpolating
        the surfel values using bilinear interpolation then blurring the output image using a Gaussian filter.
@@ -188,6 +296,7 @@ def projection_renderer_differentiable_fast(surfels, rgb, camera, rotated_image=
                             Set to False if the rotated image is already blurred
         detach_mask: Whether to detach the mask m in I_top + (1 - m) * I_bottom
         detach_mask2: Alternative, to `detach_mask`, Whether to detach the mask m in m * (I_top / m') + (1 - m) * I_bottom
+        top_k: If given, only the `top_k` nearest surfels landing on each output pixel are blended
 
     Returns:
         RGB image of dimensions [batch_size, H, W, 3] from projected surfels
@@ -220,30 +329,27 @@ def projection_renderer_differentiable_fast(surfels, rgb, camera, rotated_image=
 
     depth = px_coord[...,2].detach() if detach_depth_merge else px_coord[...,2]
     center_dist_2 = (x**2 + y**2).squeeze(-1) # squared distance to the nearest pixel center
-    rgb_out = scatter_weighted_blended_oit(rgb_in * (1 - x) * (1 - y), depth, center_dist_2, flat_px(px_idx + tch_var_l([0, 0])), use_depth=use_depth, use_center_dist=use_center_dist)
-    rgb_out += scatter_weighted_blended_oit(rgb_in * (1 - x) * y, depth, center_dist_2, flat_px(px_idx + tch_var_l([0, 1])), use_depth=use_depth, use_center_dist=use_center_dist)
-    rgb_out += scatter_weighted_blended_oit(rgb_in * x * (1 - y), depth, center_dist_2, flat_px(px_idx + tch_var_l([1, 0])), use_depth=use_depth, use_center_dist=use_center_dist)
-    rgb_out += scatter_weighted_blended_oit(rgb_in * x * y, depth, center_dist_2, flat_px(px_idx + tch_var_l([1, 1])), use_depth=use_depth, use_center_dist=use_center_dist)
-
-    soft_mask = scatter_weighted_blended_oit((1 - x) * (1 - y), depth, center_dist_2, flat_px(px_idx + tch_var_l([0, 0])), use_depth=use_depth, use_center_dist=use_center_dist)
-    soft_mask += scatter_weighted_blended_oit((1 - x) * y, depth, center_dist_2, flat_px(px_idx + tch_var_l([0, 1])), use_depth=use_depth, use_center_dist=use_center_dist)
-    soft_mask += scatter_weighted_blended_oit(x * (1 - y), depth, center_dist_2, flat_px(px_idx + tch_var_l([1, 0])), use_depth=use_depth, use_center_dist=use_center_dist)
-    soft_mask += scatter_weighted_blended_oit(x * y, depth, center_dist_2, flat_px(px_idx + tch_var_l([1, 1])), use_depth=use_depth, use_center_dist=use_center_dist)
+    # Scatter rgb, mask and depth to the 4 bilinear corners at once
+    channels = [rgb_in, torch.ones_like(x)] + ([depth.unsqueeze(-1)] if compute_new_depth else [])
+    corners = tch_var_l([[0, 0], [0, 1], [1, 0], [1, 1]])
+    wx = torch.stack((1 - x, 1 - x, x, x), dim=-2)
+    wy = torch.stack((1 - y, y, 1 - y, y), dim=-2)
+    out = scatter_weighted_blended_oit_grouped(torch.cat(channels, -1).unsqueeze(-2) * wx * wy, depth, center_dist_2,
+                                               flat_px(px_idx.unsqueeze(-2) + corners),
+                                               use_depth=use_depth, use_center_dist=use_center_dist, top_k=top_k)
+    out = out[:, 0] + out[:, 1] + out[:, 2] + out[:, 3]
+    D = rgb_in.size(-1)
+    rgb_out, soft_mask = out[..., :D], out[..., D:D + 1]
 
     if compute_new_depth:
-        depth_in = depth.unsqueeze(-1)
-        depth_out = scatter_weighted_blended_oit(depth_in * (1 - x) * (1 - y), depth, center_dist_2, flat_px(px_idx + tch_var_l([0, 0])), use_depth=use_depth, use_center_dist=use_center_dist)
-        depth_out += scatter_weighted_blended_oit(depth_in * (1 - x) * y, depth, center_dist_2, flat_px(px_idx + tch_var_l([0, 1])), use_depth=use_depth, use_center_dist=use_center_dist)
-        depth_out += scatter_weighted_blended_oit(depth_in * x * (1 - y), depth, center_dist_2, flat_px(px_idx + tch_var_l([1, 0])), use_depth=use_depth, use_center_dist=use_center_dist)
-        depth_out += scatter_weighted_blended_oit(depth_in * x * y, depth, center_dist_2, flat_px(px_idx + tch_var_l([1, 1])), use_depth=use_depth, use_center_dist=use_center_dist)
-        depth_out = depth_out.view(*rgb.size()[:-1], 1)
+        depth_out = out[..., D + 1:].contiguous().view(*rgb.size()[:-1], 1)
 
-    rgb_out = rgb_out.view(*rgb.size())
-    soft_mask = soft_mask.view(*rgb.size()[:-1], 1)
+    rgb_out = rgb_out.contiguous().view(*rgb.size())
+    soft_mask = soft_mask.contiguous().view(*rgb.size()[:-1], 1)
 
-    # Blur the rgb and mask images
-    rgb_out = blur(rgb_out.permute(0, 3, 1, 2), blur_size).permute(0, 2, 3, 1)
-    soft_mask = blur(soft_mask.permute(0, 3, 1, 2), blur_size).permute(0, 2, 3, 1)
+    # Blur the rgb and mask images together
+    blurred = blur(torch.cat((rgb_out, soft_mask), -1).permute(0, 3, 1, 2), blur_size).permute(0, 2, 3, 1)
+    rgb_out, soft_mask = blurred[..., :-1], blurred[..., -1:]
 
     # There seems to be a bug in PyTorch where if a single division by 0 occurs in a tensor, the whole thing becomes NaN?
     # Might be related to this issue: https://github.com/pytorch/pytorch/issues/4132
@@ -284,34 +390,66 @@ def projection_reverse_renderer(rgb, in_pos_wc, out_pos_wc, camera1, camera2, ro
     and use them to find the corresponding u,v positions on the input image (rgb). Sample these positions using
     bilinear interpolation.
     """
-    viewport = make_list2np(camera1['viewport'])
-    W = int(viewport[2] - viewport[0])
-    H = int(viewport[3] - viewport[1])
-    _, px_coord = project_image_coordinates(out_pos_wc, camera1)
+    cameras2 = dict(camera2, **{key: camera2[key].unsqueeze(1) for key in ['eye', 'at', 'up']})
+    out, proj_out = projection_reverse_renderer_multiview(
+        rgb, in_pos_wc, out_pos_wc.unsqueeze(1), camera1, cameras2,
+        rotated_images=None if rotated_image is None else rotated_image.unsqueeze(1),
+        compute_new_depth=compute_new_depth, depth_epsilon=depth_epsilon, mask_dropout=mask_dropout)
+    return out[:, 0], {key: value[:, 0] for key, value in proj_out.items()}
 
-    px_coord = px_coord.view(*rgb.size()[:-1], 3)
-    normalized_px_coord = px_coord[...,:2] / torch.tensor([W, H], dtype=torch.float, device=px_coord.device) * 2 - 1
-    out = torch.nn.functional.grid_sample(rgb.permute(0, 3, 1, 2), normalized_px_coord).permute(0, 2, 3, 1)
 
-    # TODO this is a hard mask, should we make it soft by using the bilinear weights (at the edges only or everywhere?)
-    # |- An alternative would be to try Dropout on the mask
+def projection_reverse_renderer_multiview(rgb, in_pos_wc, out_pos_wc, cameras1, cameras2, rotated_images=None, compute_new_depth=False, depth_epsilon=1e-1, mask_dropout=0):
+    """
+    `projection_reverse_renderer` from one source view to V target views. The source image, positions and depth are
+    shared by the views, and each bilinear sampling is done for all the views in a single `grid_sample`.
+
+    Args:
+        rgb: [batch_size, H, W, C] source images (seen from cameras1)
+        in_pos_wc: [batch_size, H*W, 3] world positions of the source pixels
+        out_pos_wc: [batch_size, V, H*W, 3] world positions of the pixels of each target view
+        cameras1: source cameras ('eye', 'at', 'up' of size [batch_size, ...])
+        cameras2: target cameras ('eye', 'at', 'up' of size [batch_size, V, ...])
+        rotated_images: [batch_size, V, H, W, C] images to merge with the warped images
+
+    Returns:
+        [batch_size, V, H, W, C] warped images and a dict with the 'mask', 'image1' (and 'depth') of each view
+    """
+    batch_size, H, W, C = rgb.size()
+    num_views = out_pos_wc.size(1)
+    scale = torch.tensor([W, H], dtype=torch.float, device=rgb.device)
+
+    # Target pixels in the source view, all the views in one projection
+    _, px_coord = project_image_coordinates(out_pos_wc.reshape(batch_size, num_views * H * W, -1), cameras1)
+    px_coord = px_coord.view(batch_size, num_views, H, W, 3)
+    normalized_px_coord = px_coord[..., :2] / scale * 2 - 1
+
+    # The source image is shared by the views, so they are stacked along the rows of the sampling grid
+    out = torch.nn.functional.grid_sample(rgb.permute(0, 3, 1, 2),
+                                          normalized_px_coord.view(batch_size, num_views * H, W, 2))
+    out = out.view(batch_size, C, num_views, H, W).permute(0, 2, 3, 4, 1)
+
     # NOTE: use 0.5 to account for bilinear interpolation
     mask = (px_coord[...,1] < 0.5) | (px_coord[...,0] < 0.5) | (px_coord[...,1] >= H - 0.5) | (px_coord[...,0] >= W - 0.5)
-    mask = 1 - mask.view(*rgb.size()[:-1], 1).float()
-
-    # Use depth to mask out pixels that end up on the same location
-    # This process could be done by averaging the depth of neighboring pixels, but instead uses grid_sample to interpolate (twice) which turns out to be more efficient
-    depth = px_coord[...,2].unsqueeze(-1) # (1) depth from cam1, ordered as cam2 pixels
-    _, px_coord_out = project_image_coordinates(in_pos_wc, camera2) # project the points from the cam1 (top) image to the bottom image space
-    px_coord_out = px_coord_out.view(*rgb.size()[:-1], 3)
-    normalized_px_coord_out = px_coord_out[...,:2] / torch.tensor([W, H], dtype=torch.float, device=px_coord_out.device) * 2 - 1
-    # sample the depth from cam1 (ordered as cam2 pixels) using the points from the cam1 (top) image
+    mask = 1 - mask.unsqueeze(-1).float()
+
+    # Use depth to mask out pixels that end up on the same location (see projection_reverse_renderer)
+    depth = px_coord[..., 2].unsqueeze(-1) # (1) depth from cam1, ordered as cam2 pixels
+    cameras2 = dict(cameras2, **{key: cameras2[key].reshape(batch_size * num_views, -1) for key in ['eye', 'at', 'up']})
+    in_pos_wc = in_pos_wc.unsqueeze(1).expand(-1, num_views, -1, -1).reshape(batch_size * num_views, H * W, -1)
+    _, px_coord_out = project_image_coordinates(in_pos_wc, cameras2) # project the points from the cam1 (top) image to the bottom image space
+    px_coord_out = px_coord_out.view(batch_size * num_views, H, W, 3)
+    normalized_px_coord_out = px_coord_out[..., :2] / scale * 2 - 1
     # we get depth from cam1 (ordered as cam1 pixels)
-    depth_sampled_in = torch.nn.functional.grid_sample(depth.permute(0, 3, 1, 2), normalized_px_coord_out)
-    # we then need to flip the whole thing to get a mask in cam2 space (ordered as cam2 pixels)
-    # sample the depth from cam1 (ordered as cam1 pixels) using the points from the cam2 (bottom) image
-    # we get depth from cam1 (ordered as cam2 pixels)
-    depth_sampled_out = torch.nn.functional.grid_sample(depth_sampled_in, normalized_px_coord).permute(0, 2, 3, 1) # (2)
+    depth_sampled_in = torch.nn.functional.grid_sample(depth.view(batch_size * num_views, H, W, 1).permute(0, 3, 1, 2),
+                                                       normalized_px_coord_out)
+    # The depth from cam1 and the new depth are sampled with the same grid, so they are sampled together
+    channels = [depth_sampled_in]
+    if compute_new_depth:
+        channels.append(px_coord_out[..., 2].unsqueeze(1))
+    sampled = torch.nn.functional.grid_sample(torch.cat(channels, 1),
+                                              normalized_px_coord.view(batch_size * num_views, H, W, 2))
+    sampled = sampled.permute(0, 2, 3, 1).view(batch_size, num_views, H, W, -1)
+    depth_sampled_out = sampled[..., :1] # (2)
     # comparing the two depths images from cam1 (ordered as cam2 pixels) ((1) and (2)), we can get a mask
     mask = mask * (depth <= depth_sampled_out + depth_epsilon).float()
     if mask_dropout > 0:
@@ -322,13 +460,11 @@ def projection_reverse_renderer(rgb, in_pos_wc, out_pos_wc, camera1, camera2, ro
         'image1': out
     }
 
-    if rotated_image is not None:
-        # mask = mask.detach() if detach_mask else mask # NOTE: Right now, it doesnt even matter since mask is non-differentiable
-        out = mask * out + (1 - mask) * rotated_image
+    if rotated_images is not None:
+        out = mask * out + (1 - mask) * rotated_images
 
     if compute_new_depth:
-        depth2 = px_coord_out[...,2].unsqueeze(-1)
-        proj_out['depth'] = torch.nn.functional.grid_sample(depth2.permute(0, 3, 1, 2), normalized_px_coord).permute(0, 2, 3, 1)
+        proj_out['depth'] = sampled[..., 1:]
 
     return out, proj_out
 
@@ -606,6 +742,49 @@ def test_visual_reverse_renderer(scene, batch_size):
     im, _ = projection_reverse_renderer(image, pos_wc, out_pos_wc, original_camera, camera, rotated_image)
     save_image(im.clone().permute(0, 3, 1, 2), 'test-fast-rotated-reprojected-merged.png', nrow=2)
 
+def test_multiview_reverse_renderer(scene, batch_size, num_views=8):
+    """Check `projection_reverse_renderer_multiview` against one `projection_reverse_renderer` call per view, and
+    report the time of both.
+    """
+    import time
+    res = render_scene(scene)
+    scene = make_torch_var(load_scene(scene))
+    camera = scene['camera']
+    camera['eye'] = camera['eye'].repeat(batch_size, 1)
+    camera['at'] = camera['at'].repeat(batch_size, 1)
+    camera['up'] = camera['up'].repeat(batch_size, 1)
+
+    pos_wc = res['pos'].reshape(-1, res['pos'].shape[-1]).repeat(batch_size, 1, 1)
+    image = res['image'].repeat(batch_size, 1, 1, 1)
+
+    cameras, out_pos_wc = [], []
+    for _ in range(num_views):
+        rotated_camera = copy.deepcopy(camera)
+        randomly_rotate_cameras(rotated_camera, theta_range=[-np.pi / 16, np.pi / 16], phi_range=[-np.pi / 8, np.pi / 8])
+        cameras.append(rotated_camera)
+        # NOTE: `render` is not batched, the positions of the first camera are used for all the batch
+        rotated_scene = copy.deepcopy(scene)
+        rotated_scene['camera'] = {key: value[0] if key in ['eye', 'at', 'up'] else value
+                                   for key, value in rotated_camera.items()}
+        res_rotated = render(rotated_scene)
+        out_pos_wc.append(res_rotated['pos'].reshape(-1, res['pos'].shape[-1]).repeat(batch_size, 1, 1))
+    cameras2 = dict(camera, **{key: torch.stack([c[key] for c in cameras], 1) for key in ['eye', 'at', 'up']})
+
+    start = time.time()
+    outputs = [projection_reverse_renderer(image, pos_wc, out_pos_wc[view], camera, cameras[view],
+                                           compute_new_depth=True) for view in range(num_views)]
+    print('{} views, one call per view: {:.4f}s'.format(num_views, time.time() - start))
+    start = time.time()
+    im, proj_out = projection_reverse_renderer_multiview(image, pos_wc, torch.stack(out_pos_wc, 1), camera, cameras2,
+                                                         compute_new_depth=True)
+    print('{} views, multiview: {:.4f}s'.format(num_views, time.time() - start))
+
+    for view, (im_view, proj_out_view) in enumerate(outputs):
+        np.testing.assert_allclose(get_data(im[:, view]), get_data(im_view), atol=1e-6)
+        for key in proj_out_view:
+            np.testing.assert_allclose(get_data(proj_out[key][:, view]), get_data(proj_out_view[key]), atol=1e-6)
+
+
 def test_transformation_consistency(scene, batch_size):
     print('test_transformation_consistency')
     res = render_scene(scene)
@@ -879,6 +1058,48 @@ def test_depth_to_world_consistency(scene, batch_size):
     np.testing.assert_array_almost_equal(get_data(pos_wc1[..., :3]), get_data(pos_wc2[..., :3]))
 
 
+def test_splatting_scaling(scene, sizes=(32, 64, 128, 256), max_dense_size=64, blur_size=0.15):
+    """Compare the local-window `projection_renderer_differentiable` to the dense version, and report the time and
+    memory of both as the resolution grows (the dense version is only run up to `max_dense_size`).
+    """
+    import time
+    for size in sizes:
+        scene_size = load_scene(scene)
+        scene_size['camera']['viewport'] = [0, 0, size, size]
+        scene_size = make_torch_var(scene_size)
+        res = render(scene_size)
+        camera = scene_size['camera']
+        camera['eye'] = camera['eye'].repeat(1, 1)
+        camera['at'] = camera['at'].repeat(1, 1)
+        camera['up'] = camera['up'].repeat(1, 1)
+        pos_wc = res['pos'].reshape(1, -1, 3)
+        image = res['image'][np.newaxis]
+
+        outputs = {}
+        fns = [('local', projection_renderer_differentiable)]
+        if size <= max_dense_size:
+            fns.append(('dense', projection_renderer_differentiable_dense))
+        for name, fn in fns:
+            if torch.cuda.is_available():
+                torch.cuda.reset_peak_memory_stats()
+            start = time.time()
+            outputs[name] = fn(pos_wc, image, camera, blur_size=blur_size)
+            elapsed = time.time() - start
+            memory = ('{:.1f} MB'.format(torch.cuda.max_memory_allocated() / 2 ** 20) if torch.cuda.is_available()
+                      else 'n/a (CPU)')
+            sigma = blur_size * size / 6
+            num_weights = pos_wc.size(1) * (size ** 2 if name == 'dense' else (2 * math.ceil(3 * sigma + 0.5) + 1) ** 2)
+            print('{}x{} {}: {:.3f}s, {} weights, peak memory {}'.format(size, size, name, elapsed, num_weights,
+                                                                        memory))
+        if 'dense' in outputs:
+            # The truncated tails only matter where the mask is small
+            mask = get_data(outputs['dense'][1])
+            covered = np.repeat(mask > 1e-2 * mask.max(), image.shape[-1], axis=-1)
+            np.testing.assert_allclose(get_data(outputs['local'][1]), mask, atol=1e-2 * mask.max())
+            np.testing.assert_allclose(get_data(outputs['local'][0])[covered], get_data(outputs['dense'][0])[covered],
+                                       atol=1e-2)
+
+
 def main():
     import argparse
     import os
@@ -897,6 +1118,8 @@ def main():
     batch_size = 6
 
     # test_depth_to_world_consistency(scene, batch_size)
+    # test_splatting_scaling(scene)
+    # test_multiview_reverse_renderer(scene, batch_size)
     # test_visual_render(scene, 1)
     # test_render_projection_consistency(scene, batch_size)
     # test_raster_coordinates(scene, batch_size)
@@ -34,10 +34,30 @@ def transform_model(obj, scale, rotate, translate):
     return obj
 
 
-def load_scene(scene_filename):
+def model_transform(scale, rotate, translate):
+    """4 x 4 matrix of transform_model, i.e., M = translate * rotate * scale"""
+    M = np.eye(4)
+    if scale is not None:
+        M[:3, :3] = np.diag(scale)
+    if rotate is not None:
+        M[:3, :3] = np.matmul(axis_angle_matrix(axis=rotate['axis'], angle=np.deg2rad(rotate['angle_deg']))[:3, :3],
+                              M[:3, :3])
+    if translate is not None:
+        M[:3, 3] = translate
+    return M
+
+
+def load_scene(scene_filename, instanced=False):
     """Loads a diffrend scene file
     Args:
         fname:
+        instanced: If True, the objects are not baked into world-space triangles but stored in
+            scene['instances'] (see instance_fragments): every model file is loaded once in object
+            space, and every object is an instance of it with the transform of its scale, rotate
+            and translate.
+
+    Objects with "static": true are baked into scene['static_objects'] instead of scene['objects'],
+    so that render traces them as a static layer (see StaticLayerCache).
 
     Returns:
         scene
@@ -50,10 +70,24 @@ def load_scene(scene_filename):
 
     basedir = os.path.dirname(scene_filename)
     objects = scene['objects']['obj']
-    mesh = {'face': None,
-            'normal': None,
-            'material_idx': None
-           }
+    if instanced:
+        if any(get_param_value('static', obj, False) for obj in objects):
+            raise ValueError('static objects are not supported with instanced')
+        instances = {}
+        for obj in objects:
+            if obj['path'] not in instances:
+                mesh = obj_to_triangle_spec(load_obj(os.path.join(basedir, obj['path'])))
+                instances[obj['path']] = {'face': mesh['face'], 'normal': mesh['normal'],
+                                          'transform': [], 'material_idx': []}
+            M = model_transform(get_param_value('scale', obj, None), get_param_value('rotate', obj, None),
+                                get_param_value('translate', obj, None))
+            instances[obj['path']]['transform'].append(M.tolist())
+            instances[obj['path']]['material_idx'].append(int(obj['material_idx']))
+        scene['instances'] = instances
+        del scene['objects']['obj']
+        return scene
+    meshes_by_layer = {False: {'face': None, 'normal': None, 'material_idx': None},
+                       True: {'face': None, 'normal': None, 'material_idx': None}}
     for obj in objects:
         print(obj)
         model_path = os.path.join(basedir, obj['path'])
@@ -65,6 +99,7 @@ def load_scene(scene_filename):
         obj_model = transform_model(obj_model, scale, rotate, translate)
         meshes = obj_to_triangle_spec(obj_model)
         material_idx = np.ones(meshes['face'].shape[0]) * obj['material_idx']
+        mesh = meshes_by_layer[bool(get_param_value('static', obj, False))]
         if mesh['face'] is None:
             mesh['face'] = meshes['face']
             mesh['normal'] = meshes['normal']
@@ -73,7 +108,10 @@ def load_scene(scene_filename):
             mesh['face'] = np.concatenate((mesh['face'], meshes['face']))
             mesh['normal'] = np.concatenate((mesh['normal'], meshes['normal']))
             mesh['material_idx'] = np.concatenate((mesh['material_idx'], material_idx))
-    scene['objects']['triangle'] = mesh
+    if meshes_by_layer[False]['face'] is not None:
+        scene['objects']['triangle'] = meshes_by_layer[False]
+    if meshes_by_layer[True]['face'] is not None:
+        scene['static_objects'] = {'triangle': meshes_by_layer[True]}
     del scene['objects']['obj']
     return scene
 
@@ -1,13 +1,21 @@
 from __future__ import division
+from collections import OrderedDict
+from typing import Optional
 import numpy as np
 import torch
+import torch.utils.checkpoint
+import diffrend.torch.utils as torch_utils
 from diffrend.torch.utils import (tonemap, ray_object_intersections,
-                                  generate_rays, where, backface_labeler,
+                                  ray_object_distances, generate_rays, generate_subpixel_rays, where,
+                                  backface_labeler, select_objects, num_scene_objects,
                                   bincount, tch_var_f, norm_p, normalize,
                                   lookat, reflect_ray, estimate_surface_normals, tensor_dot,
-                                  nonzero_divide, get_data)
+                                  nonzero_divide, get_data, world_to_cam, world_to_cam_batched, make_list2np,
+                                  estimate_surface_normals_plane_fit_batched, no_host_sync, trap_host_sync,
+                                  HostSyncError)
 from diffrend.utils.utils import get_param_value
 from diffrend.torch.ops import perspective, inv_perspective
+from diffrend.torch.bvh import BVH, ray_box_hits
 """
 Scalable Rendering TODO:
 1. Backface culling. Cull splats for which dot((eye - pos), normal) <= 0 [DONE]
@@ -125,6 +133,215 @@ def fragment_shader(frag_normals, light_dir, cam_dir,
     return im_color
 
 
+def fragment_shader_fused(frag_pos, frag_normals, light_pos, cam_dir,
+                          light_attenuation_coeffs, frag_coeffs,
+                          light_colors, ambient_light,
+                          frag_albedo, double_sided: bool,
+                          use_quartic: bool, light_visibility: Optional[torch.Tensor],
+                          light_chunk: int = 1):
+    """Same shading as fragment_shader followed by the sum over the lights.
+
+    The lights are processed `light_chunk` at a time and accumulated into a single [N, 3] buffer,
+    so only [light_chunk, N] and [light_chunk, N, 3] temporaries are alive at any time.
+    The reflected light direction is never formed since
+    dot(cam_dir, reflect(-l, n)) = 2 dot(l, n) dot(cam_dir, n) - dot(cam_dir, l).
+    Only plain tensor ops are used so that it can be passed to torch.jit.script or torch.compile.
+    :param frag_pos: [N, 3] or [1, N, 3] fragment positions
+    :param light_pos: [L, 3] or [L, 4] light positions, or [L, ..., 3/4] per-fragment light positions
+                      (e.g., an expanded [L, B, N', 3] view for a batch of B images of N' fragments)
+    :param light_visibility: [L, N] or None
+    :return: [N, 3] fragment colors
+    """
+    frag_pos = frag_pos.reshape(-1, 3)
+    frag_normals = frag_normals.reshape(-1, 3)
+    cam_dir = cam_dir.reshape(-1, 3)
+    pow_val = 4.0 if use_quartic else 2.0
+
+    cam_dot_normal = torch.sum(cam_dir * frag_normals, dim=-1)
+    if double_sided:
+        # Flip per-fragment normals if needed based on the camera direction
+        sgn = torch.sign(cam_dot_normal)
+    else:
+        sgn = torch.ones_like(cam_dot_normal)
+
+    num_lights = light_pos.shape[0]
+    # fragment_shader adds the ambient term once per light
+    im_color = float(num_lights) * ambient_light[None, :] * frag_albedo
+    for start_idx in range(0, num_lights, light_chunk):
+        end_idx = min(start_idx + light_chunk, num_lights)
+        if light_pos.dim() > 2:
+            light_dir = light_pos[start_idx:end_idx].reshape(end_idx - start_idx, -1,
+                                                             light_pos.shape[-1])[:, :, :3] - frag_pos[None, :, :]
+        else:
+            light_dir = light_pos[start_idx:end_idx, None, :3] - frag_pos[None, :, :]
+        light_dir_norm = torch.sqrt(torch.sum(light_dir ** 2, dim=-1))
+        light_dir = light_dir / torch.where(light_dir_norm > 0, light_dir_norm,
+                                            torch.ones_like(light_dir_norm))[:, :, None]
+        # Attenuate the lights
+        att_coeffs = light_attenuation_coeffs[start_idx:end_idx]
+        att_denom = att_coeffs[:, 0:1] + light_dir_norm * att_coeffs[:, 1:2] + \
+            (light_dir_norm ** pow_val) * att_coeffs[:, 2:3]
+        att_factor = 1 / torch.where(torch.abs(att_denom) > 0, att_denom, torch.ones_like(att_denom))
+
+        normal_dot_light = torch.sum(frag_normals[None, :, :] * light_dir, dim=-1)
+        cam_dot_light = torch.sum(cam_dir[None, :, :] * light_dir, dim=-1)
+        # Diffuse and specular components
+        diffuse = torch.relu(sgn[None, :] * att_factor * normal_dot_light)
+        reflected_cam_dot = torch.relu(sgn[None, :] * (2 * normal_dot_light * cam_dot_normal[None, :] - cam_dot_light))
+        light_weight = frag_coeffs[None, :, 0] * diffuse + \
+            frag_coeffs[None, :, 1] * (reflected_cam_dot ** frag_coeffs[None, :, 2])
+        if light_visibility is not None:
+            light_weight = light_weight * light_visibility[start_idx:end_idx]
+        # sum_l w[l, n] * color[l] * albedo[n] as a single [N, L] x [L, 3] product
+        im_color = im_color + torch.mm(light_weight.transpose(1, 0), light_colors[start_idx:end_idx]) * frag_albedo
+    return im_color
+
+
+def light_cutoff_radius(light_attenuation_coeffs, threshold, use_quartic=False):
+    """Distance beyond which the attenuation 1/(kc + kl * d + kq * d^p) drops below `threshold`.
+
+    For p = 2 this is the positive root of kq d^2 + kl d + kc = 1 / threshold. For p = 4 the
+    smaller of the linear-only and quartic-only radii is used, which is a conservative bound since
+    both terms are non-negative. Lights without distance falloff, or a threshold of 0, get an infinite radius.
+    :param light_attenuation_coeffs: [L, 3] (kc, kl, kq)
+    :param threshold: Attenuation factor below which a light is ignored
+    :return: [L] radius
+    """
+    kc = light_attenuation_coeffs[:, 0]
+    kl = light_attenuation_coeffs[:, 1]
+    kq = light_attenuation_coeffs[:, 2]
+    rhs = torch.nn.functional.relu((1. / threshold if threshold > 0 else float('inf')) - kc)
+    inf = torch.full_like(kc, float('inf'))
+    linear_radius = torch.where(kl > 0, rhs / torch.where(kl > 0, kl, torch.ones_like(kl)), inf)
+    kq_nonzero = torch.where(kq > 0, kq, torch.ones_like(kq))
+    if use_quartic:
+        quadric_radius = torch.where(kq > 0, (rhs / kq_nonzero) ** 0.25, inf)
+        return torch.min(linear_radius, quadric_radius)
+    quadric_radius = (-kl + torch.sqrt(kl ** 2 + 4 * kq * rhs)) / (2 * kq_nonzero)
+    return torch.where(kq > 0, quadric_radius, linear_radius)
+
+
+def build_tile_light_lists(frag_pos, valid_pixels, H, W, light_pos, light_radius, tile_size=16):
+    """Assign lights to screen tiles.
+
+    The fragments of every tile_size x tile_size screen tile are bounded by an axis-aligned box and a
+    light is kept for a tile only if its cutoff sphere overlaps that box.
+    :param frag_pos: [N, 3] or [1, N, 3] fragment positions (N = H * W)
+    :param valid_pixels: [N] or [H, W] mask of the pixels that hit geometry
+    :param light_pos: [L, 3] or [L, 4] light positions
+    :param light_radius: [L] light cutoff radius (see light_cutoff_radius)
+    :return: [T, L] tile-light mask and [N] tile index of every pixel
+    """
+    n_tiles_y = int(np.ceil(H / tile_size))
+    n_tiles_x = int(np.ceil(W / tile_size))
+    pad_h = n_tiles_y * tile_size - H
+    pad_w = n_tiles_x * tile_size - W
+
+    pos = frag_pos.reshape(H, W, 3).detach()
+    valid = valid_pixels.reshape(H, W, 1)
+    inf = float('inf')
+    pos_min = torch.where(valid, pos, torch.full_like(pos, inf))
+    pos_max = torch.where(valid, pos, torch.full_like(pos, -inf))
+    pos_min = torch.nn.functional.pad(pos_min.permute(2, 0, 1), (0, pad_w, 0, pad_h), value=inf)
+    pos_max = torch.nn.functional.pad(pos_max.permute(2, 0, 1), (0, pad_w, 0, pad_h), value=-inf)
+    # [3, n_tiles_y, tile_size, n_tiles_x, tile_size] -> [T, 3]
+    tile_min = pos_min.reshape(3, n_tiles_y, tile_size, n_tiles_x, tile_size).min(4)[0].min(2)[0]
+    tile_max = pos_max.reshape(3, n_tiles_y, tile_size, n_tiles_x, tile_size).max(4)[0].max(2)[0]
+    tile_min = tile_min.reshape(3, -1).transpose(1, 0)
+    tile_max = tile_max.reshape(3, -1).transpose(1, 0)
+    tile_valid = torch.all(tile_min <= tile_max, dim=-1)
+
+    # Sphere-box overlap
+    center = light_pos[:, :3].detach()[np.newaxis, :, :]
+    box_dist = torch.nn.functional.relu(tile_min[:, np.newaxis, :] - center) + \
+        torch.nn.functional.relu(center - tile_max[:, np.newaxis, :])
+    box_dist = torch.where(tile_valid[:, np.newaxis, np.newaxis], box_dist, torch.zeros_like(box_dist))
+    tile_lights = (torch.sum(box_dist ** 2, dim=-1) <= light_radius.detach()[np.newaxis, :] ** 2) * \
+        tile_valid[:, np.newaxis]
+
+    rows = torch.arange(H, device=frag_pos.device)[:, np.newaxis] // tile_size
+    cols = torch.arange(W, device=frag_pos.device)[np.newaxis, :] // tile_size
+    pixel_tile = (rows * n_tiles_x + cols).view(-1)
+    return tile_lights, pixel_tile
+
+
+def tile_light_pairs(tile_lights, pixel_tile):
+    """Compacted list of the (fragment, light) pairs to shade.
+    :param tile_lights: [T, L] tile-light mask (see build_tile_light_lists)
+    :param pixel_tile: [N] tile index of every pixel
+    :return: [P] fragment and [P] light indices of the pairs, grouped by (tile, light)
+    """
+    # Pixels sorted by tile, and the offset of every tile in that order
+    tile_pixels = torch.argsort(pixel_tile)
+    tile_count = torch.bincount(pixel_tile, minlength=tile_lights.shape[0])
+    tile_start = torch.cumsum(tile_count, 0) - tile_count
+
+    tile_idx, light_idx = torch.nonzero(tile_lights, as_tuple=True)
+    pair_count = torch.index_select(tile_count, 0, tile_idx)
+    pair_group = torch.repeat_interleave(torch.arange(tile_idx.shape[0], device=pixel_tile.device), pair_count)
+    # Rank of every pair within its (tile, light) group
+    group_start = torch.cumsum(pair_count, 0) - pair_count
+    rank = torch.arange(pair_group.shape[0], device=pixel_tile.device) - \
+        torch.index_select(group_start, 0, pair_group)
+    pair_start = torch.index_select(torch.index_select(tile_start, 0, tile_idx), 0, pair_group)
+    frag_idx = torch.index_select(tile_pixels, 0, pair_start + rank)
+    return frag_idx, torch.index_select(light_idx, 0, pair_group)
+
+
+def fragment_shader_clustered(frag_pos, frag_normals, light_pos, cam_dir,
+                              light_attenuation_coeffs, frag_coeffs,
+                              light_colors, ambient_light,
+                              frag_albedo, double_sided,
+                              use_quartic, light_visibility,
+                              tile_lights, pixel_tile):
+    """fragment_shader_fused restricted to the lights of every screen tile.
+
+    Every light only shades the fragments in the tiles it was assigned to by build_tile_light_lists.
+    The (fragment, light) pairs are listed once (see tile_light_pairs) and shaded in a single batch,
+    so the cost scales with the number of pairs within the cutoff radius instead of L x N.
+    The attenuation only decides which pairs are culled, the kept pairs are shaded as in fragment_shader_fused.
+    :return: [N, 3] fragment colors
+    """
+    frag_pos = frag_pos.reshape(-1, 3)
+    frag_normals = frag_normals.reshape(-1, 3)
+    cam_dir = cam_dir.reshape(-1, 3)
+    frag_albedo = frag_albedo.expand(frag_pos.shape[0], 3)
+    frag_coeffs = frag_coeffs.expand(frag_pos.shape[0], 3)
+    pow_val = 4.0 if use_quartic else 2.0
+
+    num_lights = light_pos.shape[0]
+    # Ambient term is not culled
+    im_color = float(num_lights) * ambient_light[np.newaxis, :] * frag_albedo
+    frag_idx, light_idx = tile_light_pairs(tile_lights, pixel_tile)
+
+    # Per-fragment terms are computed once and gathered per pair (index_select is much faster than
+    # advanced indexing on the CPU)
+    gather = lambda x, idx: torch.index_select(x, 0, idx)
+    cam_dot_normal = torch.sum(cam_dir * frag_normals, dim=-1)
+    sgn = torch.sign(cam_dot_normal) if double_sided else torch.ones_like(cam_dot_normal)
+    light_dir = gather(light_pos[:, :3], light_idx) - gather(frag_pos, frag_idx)
+    light_dir_norm = torch.sqrt(torch.sum(light_dir ** 2, dim=-1))
+    light_dir = light_dir / torch.where(light_dir_norm > 0, light_dir_norm, torch.ones_like(light_dir_norm))[:, None]
+    att_coeffs = gather(light_attenuation_coeffs, light_idx)
+    att_denom = att_coeffs[:, 0] + light_dir_norm * att_coeffs[:, 1] + (light_dir_norm ** pow_val) * att_coeffs[:, 2]
+    att_factor = 1 / torch.where(torch.abs(att_denom) > 0, att_denom, torch.ones_like(att_denom))
+
+    normal_dot_light = torch.sum(gather(frag_normals, frag_idx) * light_dir, dim=-1)
+    cam_dot_light = torch.sum(gather(cam_dir, frag_idx) * light_dir, dim=-1)
+    pair_sgn = gather(sgn, frag_idx)
+    diffuse = torch.relu(pair_sgn * att_factor * normal_dot_light)
+    reflected_cam_dot = torch.relu(pair_sgn * (2 * normal_dot_light * gather(cam_dot_normal, frag_idx) -
+                                               cam_dot_light))
+    pair_coeffs = gather(frag_coeffs, frag_idx)
+    light_weight = pair_coeffs[:, 0] * diffuse + pair_coeffs[:, 1] * (reflected_cam_dot ** pair_coeffs[:, 2])
+    if light_visibility is not None:
+        light_weight = light_weight * gather(light_visibility.reshape(-1), light_idx * frag_pos.shape[0] + frag_idx)
+    # sum_l w[l, n] * color[l] * albedo[n], with the albedo factored out of the sum
+    light_sum = torch.zeros_like(im_color).index_add(0, frag_idx,
+                                                     light_weight[:, None] * gather(light_colors, light_idx))
+    return im_color + light_sum * frag_albedo
+
+
 def get_as_list(var):
     if type(var) is np.ndarray:
         return var.tolist()
@@ -133,18 +350,450 @@ def get_as_list(var):
     return var
 
 
+def get_as_index(var):
+    """Index for a table lookup. Tensors stay on their device (no host sync)."""
+    if type(var) is torch.Tensor:
+        return var
+    return get_as_list(var)
+
+
+def nearest_fragments(ray_orig, ray_dir, scene_objects, camera, tile_size, checkpoint=False, bvh=None):
+    """Ray-object intersection followed by the selection of the nearest fragment per ray,
+    performed `tile_size` rays at a time.
+    :param ray_orig: [1 x 3] or [N x 3] ray origins
+    :param ray_dir: [3 x N] ray directions
+    :param checkpoint: If True, every tile is run under torch.utils.checkpoint, i.e., its intermediate
+                       [M x tile_size] tensors are not kept for the backward pass but recomputed
+    :param bvh: Optional BVH of scene_objects (see diffrend.torch.bvh). Every tile is then only intersected
+                with the objects of the leaves it hits, and 'ray_dist' only has the rows of these objects
+    :return: Dictionary with the [N] depth, nearest object index and material index and
+             the [1, N, 3] fragment positions and normals
+    """
+    def tile_fragments(ray_orig_subset, ray_dir_subset, tile_objects):
+        obj_intersections, ray_dist, normals, material_idx = ray_object_intersections(ray_orig_subset,
+                                                                                      ray_dir_subset,
+                                                                                      tile_objects)
+        # Valid distances
+        valid_pixels = (camera['near'] <= ray_dist) * (ray_dist <= camera['far'])
+        pixel_dist = where(valid_pixels, ray_dist, camera['far'] + 1)
+
+        # Nearest object depth and index
+        im_depth, nearest_obj = pixel_dist.min(0)
+
+        frag_normals = torch.gather(
+            normals, 0, nearest_obj[np.newaxis, :, np.newaxis].repeat(1, 1, 3))
+        frag_pos = torch.gather(
+            obj_intersections, 0,
+            nearest_obj[np.newaxis, :, np.newaxis].repeat(1, 1, 3))
+        return im_depth, nearest_obj, frag_normals, frag_pos, ray_dist, material_idx
+
+    num_pixels = ray_dir.shape[1]
+    per_ray_orig = ray_orig.shape[0] > 1
+    im_depth_all = []
+    nearest_obj_all = []
+    frag_normals_all = []
+    frag_pos_all = []
+    material_idx_all = []
+    n_partitions = int(np.ceil(num_pixels / tile_size))
+    for idx in range(n_partitions):
+        start_idx = idx * tile_size
+        end_idx = min((idx + 1) * tile_size, num_pixels)
+        ray_orig_subset = ray_orig[start_idx:end_idx] if per_ray_orig else ray_orig
+        ray_dir_subset = ray_dir[:, start_idx:end_idx]
+        if bvh is not None:
+            obj_idx = bvh.candidates(ray_orig_subset, ray_dir_subset, camera['near'], camera['far'])
+            tile_objects = select_objects(scene_objects, obj_idx)
+        else:
+            tile_objects = scene_objects
+        if checkpoint and torch.is_grad_enabled():
+            # Non-reentrant, so that the gradients reach the scene tensors used inside tile_fragments
+            tile = torch.utils.checkpoint.checkpoint(tile_fragments, ray_orig_subset, ray_dir_subset, tile_objects,
+                                                     use_reentrant=False)
+        else:
+            tile = tile_fragments(ray_orig_subset, ray_dir_subset, tile_objects)
+        im_depth, nearest_obj, frag_normals, frag_pos, ray_dist, material_idx = tile
+
+        im_depth_all.append(im_depth)
+        material_idx_all.append(torch.gather(material_idx.long(), 0, nearest_obj))
+        nearest_obj_all.append(nearest_obj if bvh is None else obj_idx[nearest_obj])
+        frag_normals_all.append(frag_normals)
+        frag_pos_all.append(frag_pos)
+    return {'depth': torch.cat(im_depth_all),
+            'nearest': torch.cat(nearest_obj_all),
+            'material_idx': torch.cat(material_idx_all),
+            'pos': torch.cat(frag_pos_all, dim=1),
+            'normal': torch.cat(frag_normals_all, dim=1),
+            'ray_dist': ray_dist,
+            'num_objects': num_scene_objects(scene_objects),
+            }
+
+
+def visible_nearest_fragments(ray_orig, ray_dir, scene_objects, camera, tile_size, sparse_grad=False,
+                              checkpoint=False, bvh=None):
+    """nearest_fragments whose gradients only reach the visible objects, i.e., the objects that are
+    the nearest one for at least one ray. These are found without autograd first, and only they are
+    intersected again with autograd. The gradients of the per-object tensors are accumulated with
+    index_add, or are sparse tensors (e.g., for torch.optim.SparseAdam) if sparse_grad.
+    Same outputs as nearest_fragments, except for 'ray_dist' which only has the rows of the visible objects.
+    """
+    with torch.no_grad():
+        visible = torch.unique(nearest_fragments(ray_orig, ray_dir, scene_objects, camera, tile_size,
+                                                 bvh=bvh)['nearest'])
+    frags = nearest_fragments(ray_orig, ray_dir, select_objects(scene_objects, visible, sparse_grad), camera,
+                              tile_size, checkpoint=checkpoint)
+    return dict(frags, nearest=visible[frags['nearest']], visible=visible, num_objects=num_scene_objects(scene_objects))
+
+
+def object_bound_points(scene_objects):
+    """Points whose convex hull contains all the geometry, or None for unbounded geometry (planes)"""
+    pts = []
+    for obj_type in scene_objects:
+        obj = scene_objects[obj_type]
+        if obj_type == 'triangle':
+            pts.append(obj['face'][:, :, :3].reshape(-1, 3))
+        elif obj_type in ['disk', 'sphere']:
+            # Corners of the bounding box of every disk/sphere
+            corners = tch_var_f([[sx, sy, sz] for sx in [-1, 1] for sy in [-1, 1] for sz in [-1, 1]])
+            pts.append((obj['pos'][:, np.newaxis, :3] +
+                        obj['radius'][:, np.newaxis, np.newaxis] * corners[np.newaxis, :, :]).reshape(-1, 3))
+        else:
+            return None
+    return torch.cat(pts, dim=0).detach()
+
+
+def screen_footprint(scene_objects, camera, H, W):
+    """Indices of the pixels inside the screen-space bounding rectangle of the geometry.
+    Falls back to the full screen when the geometry is unbounded or crosses the camera plane, and in the
+    strict no host sync mode (the rectangle is read back to the host).
+    :return: [K] flat pixel indices
+    """
+    device = camera['eye'].device
+    all_pixels = torch.arange(H * W, device=device)
+    pts = object_bound_points(scene_objects)
+    if pts is None or torch_utils.STRICT_NO_SYNC:
+        return all_pixels
+    pts_CC = world_to_cam(pts, None, camera)['pos']
+    fovy = make_list2np(camera['fovy'])
+    focal_length = make_list2np(camera['focal_length'])
+    h = np.tan(fovy / 2) * 2 * focal_length
+    w = h * W / H
+    if camera['proj_type'] in ['ortho', 'orthographic']:
+        x, y = pts_CC[:, 0], pts_CC[:, 1]
+    else:
+        if get_data(torch.max(pts_CC[:, 2])) >= -1e-6:
+            return all_pixels
+        x = -focal_length * pts_CC[:, 0] / pts_CC[:, 2]
+        y = -focal_length * pts_CC[:, 1] / pts_CC[:, 2]
+    # Inverse of the pixel grid in generate_rays
+    col = (x / (w / 2) + 1) / 2 * (W - 1)
+    row = (1 - y / (h / 2)) / 2 * (H - 1)
+    bounds = get_data(torch.stack((torch.min(col), torch.max(col), torch.min(row), torch.max(row))))
+    c0, r0 = max(int(np.floor(bounds[0])) - 1, 0), max(int(np.floor(bounds[2])) - 1, 0)
+    c1, r1 = min(int(np.ceil(bounds[1])) + 1, W - 1), min(int(np.ceil(bounds[3])) + 1, H - 1)
+    if c0 > c1 or r0 > r1:
+        return all_pixels[:0]
+    rows = torch.arange(r0, r1 + 1, device=device)[:, np.newaxis]
+    cols = torch.arange(c0, c1 + 1, device=device)[np.newaxis, :]
+    return (rows * W + cols).view(-1)
+
+
+class StaticLayerCache:
+    """Per-camera cache of the static layer (see `render` with `static_objects`).
+
+    The layers are kept in least recently used order and the oldest one is dropped once
+    `max_size` cameras are stored. The cached layers do not depend on the camera parameters
+    through autograd.
+    """
+    CAMERA_KEYS = ['proj_type', 'viewport', 'fovy', 'focal_length', 'eye', 'at', 'up', 'near', 'far']
+
+    def __init__(self, max_size=16):
+        self.max_size = max_size
+        self.layers = OrderedDict()
+
+    @staticmethod
+    def camera_key(camera):
+        return tuple((k, tuple(np.ravel(get_data(camera[k])).tolist()))
+                     for k in StaticLayerCache.CAMERA_KEYS if k in camera)
+
+    def get(self, camera, layer_fn):
+        key = self.camera_key(camera)
+        if key in self.layers:
+            self.layers.move_to_end(key)
+        else:
+            self.layers[key] = layer_fn()
+            if len(self.layers) > self.max_size:
+                self.layers.popitem(last=False)
+        return self.layers[key]
+
+    def clear(self):
+        self.layers.clear()
+
+    def __len__(self):
+        return len(self.layers)
+
+
+def get_static_layer(scene, ray_orig, ray_dir, tile_size, static_cache=None, checkpoint=False):
+    """Nearest fragments of scene['static_objects'] for the scene camera, from `static_cache` if given"""
+    def layer_fn():
+        return nearest_fragments(ray_orig, ray_dir, scene['static_objects'], scene['camera'], tile_size,
+                                 checkpoint=checkpoint)
+
+    if static_cache is None:
+        return layer_fn()
+    return static_cache.get(scene['camera'], layer_fn)
+
+
+def depth_composite(back, front, pixel_idx):
+    """Fragments of `back` replaced by the ones of `front`, which were only traced for the rays `pixel_idx`,
+    where these are nearer. The object indices of both must already be in the same index space.
+    """
+    bg_depth = torch.index_select(back['depth'], 0, pixel_idx)
+    use_fg = front['depth'] < bg_depth
+    depth = back['depth'].index_copy(0, pixel_idx, torch.where(use_fg, front['depth'], bg_depth))
+    nearest = back['nearest'].index_copy(
+        0, pixel_idx, torch.where(use_fg, front['nearest'], back['nearest'][pixel_idx]))
+    material_idx = back['material_idx'].index_copy(
+        0, pixel_idx, torch.where(use_fg, front['material_idx'], back['material_idx'][pixel_idx]))
+    use_fg_3 = use_fg[np.newaxis, :, np.newaxis]
+    pos = back['pos'].index_copy(
+        1, pixel_idx, torch.where(use_fg_3, front['pos'], back['pos'][:, pixel_idx]))
+    normal = back['normal'].index_copy(
+        1, pixel_idx, torch.where(use_fg_3, front['normal'], back['normal'][:, pixel_idx]))
+    return dict(back, depth=depth, nearest=nearest, material_idx=material_idx, pos=pos, normal=normal)
+
+
+def render_dynamic_layer(scene_objects, camera, ray_orig, ray_dir, H, W, tile_size, static_layer, checkpoint=False):
+    """Trace the dynamic objects only within their screen footprint and depth-composite them
+    over the static layer. The object indices of the static layer are offset by the number of
+    dynamic objects, i.e., the dynamic objects come first.
+    """
+    if len(scene_objects) == 0:
+        return static_layer
+    pixel_idx = screen_footprint(scene_objects, camera, H, W)
+    if pixel_idx.numel() == 0:
+        return static_layer
+    per_ray_orig = ray_orig.shape[0] > 1
+    frags = nearest_fragments(ray_orig[pixel_idx] if per_ray_orig else ray_orig, ray_dir[:, pixel_idx],
+                              scene_objects, camera, tile_size, checkpoint=checkpoint)
+    num_objects = frags['num_objects']
+    layer = depth_composite(dict(static_layer, nearest=static_layer['nearest'] + num_objects), frags, pixel_idx)
+    return dict(layer, ray_dist=frags['ray_dist'], num_objects=num_objects + static_layer['num_objects'])
+
+
+def empty_fragments(num_rays, camera, device):
+    """Fragments of rays that hit nothing, in the format of nearest_fragments"""
+    return {'depth': torch.full((num_rays,), camera['far'] + 1, device=device),
+            'nearest': torch.zeros(num_rays, dtype=torch.long, device=device),
+            'material_idx': torch.zeros(num_rays, dtype=torch.long, device=device),
+            'pos': torch.zeros(1, num_rays, 3, device=device),
+            'normal': torch.zeros(1, num_rays, 3, device=device),
+            'ray_dist': None,
+            'num_objects': 0,
+            }
+
+
+def instance_fragments(ray_orig, ray_dir, instances, camera, tile_size, layer, checkpoint=False):
+    """Two-level instancing: trace the mesh instances of scene['instances'] and depth-composite them
+    over `layer` (the fragments of scene['objects']).
+
+    scene['instances'] maps a mesh name to its object-space triangles ('face', 'normal') and to the
+    [K x 4 x 4] object-to-world 'transform' and [K] 'material_idx' of its K instances. The mesh BVH
+    is built on the first call and kept in instances[name]['bvh'], so moving an instance only changes
+    the top level, i.e., its transform. The rays are culled with the world-space bounds of every
+    instance, and the remaining (instance, ray) pairs of a mesh are transformed into the object space
+    of their instance, where they all traverse the mesh BVH in one batch. The ray distances are the
+    same in both spaces, so the nearest pair of every pixel is the one with the smallest depth.
+
+    The nearest object index of an instance is layer['num_objects'] plus its index among all the
+    instances (ordered by mesh, then by instance).
+    """
+    per_ray_orig = ray_orig.shape[0] > 1
+    corner_idx = torch.tensor([[i, j, k] for i in range(2) for j in range(2) for k in range(2)],
+                              device=ray_dir.device)
+    num_objects = layer['num_objects']
+    for name in instances:
+        group = instances[name]
+        mesh = {'triangle': {'face': group['face'], 'normal': group['normal'],
+                             'material_idx': torch.zeros(group['face'].shape[0], dtype=torch.long,
+                                                         device=ray_dir.device)}}
+        if 'bvh' not in group:
+            group['bvh'] = BVH(mesh)
+        transforms = group['transform']
+        inv_transforms = torch.inverse(transforms)
+
+        # Top level: world-space bounds of the corners of the object-space root box
+        root = group['bvh'].levels[0][0]
+        corners = root[corner_idx, torch.arange(3, device=ray_dir.device)]
+        world_corners = torch.matmul(corners, transforms[:, :3, :3].transpose(2, 1)) + transforms[:, np.newaxis, :3, 3]
+        world_bounds = torch.stack((torch.min(world_corners, dim=1)[0], torch.max(world_corners, dim=1)[0]), dim=1)
+        hits = ray_box_hits(ray_orig, ray_dir, world_bounds.detach(), camera['near'], camera['far'])
+
+        # Bottom level: all the (instance, ray) pairs that hit the bounds of their instance are traced at once,
+        # every ray in the object space of its instance
+        inst_idx, pair_pixel = torch.nonzero(hits, as_tuple=True)
+        if inst_idx.numel() > 0:
+            inv_rot = torch.index_select(inv_transforms[:, :3, :3], 0, inst_idx)
+            num_pairs = inst_idx.shape[0]
+            orig = torch.index_select(ray_orig, 0, pair_pixel) if per_ray_orig else ray_orig.expand(num_pairs, -1)
+            obj_ray_orig = (torch.matmul(inv_rot, orig[:, :3, np.newaxis])[..., 0] +
+                            torch.index_select(inv_transforms[:, :3, 3], 0, inst_idx))
+            obj_ray_dir = torch.matmul(inv_rot, torch.index_select(ray_dir, 1, pair_pixel).t()[..., np.newaxis])[..., 0]
+            frags = nearest_fragments(obj_ray_orig, obj_ray_dir.t(), mesh, camera, tile_size, checkpoint=checkpoint,
+                                      bvh=group['bvh'])
+
+            # Nearest pair of every pixel
+            pixel_idx, pair_slot = torch.unique(pair_pixel, return_inverse=True)
+            pair_depth = frags['depth'].detach()
+            min_depth = torch.full_like(pixel_idx, float('inf'), dtype=pair_depth.dtype).scatter_reduce(
+                0, pair_slot, pair_depth, 'amin')
+            pair_ids = torch.arange(num_pairs, device=ray_dir.device)
+            winner = torch.full_like(pixel_idx, -1).scatter_reduce(
+                0, pair_slot, torch.where(pair_depth <= min_depth[pair_slot], pair_ids, -1), 'amax')
+            win_inst = torch.index_select(inst_idx, 0, winner)
+
+            # Back to world space (the normals with the inverse transpose)
+            rot = torch.index_select(transforms[:, :3, :3], 0, win_inst)
+            pos = (torch.matmul(rot, torch.index_select(frags['pos'][0, :, :3], 0, winner)[..., np.newaxis])[..., 0] +
+                   torch.index_select(transforms[:, :3, 3], 0, win_inst))
+            normal = torch.matmul(torch.index_select(frags['normal'][0, :, :3], 0, winner)[:, np.newaxis, :],
+                                  torch.index_select(inv_transforms[:, :3, :3], 0, win_inst))[:, 0]
+            frags = {'depth': torch.index_select(frags['depth'], 0, winner),
+                     'pos': pos[np.newaxis],
+                     'normal': normalize(normal[np.newaxis]),
+                     'nearest': num_objects + win_inst,
+                     'material_idx': torch.index_select(group['material_idx'], 0, win_inst)}
+            layer = depth_composite(layer, frags, pixel_idx)
+        num_objects += transforms.shape[0]
+    return dict(layer, num_objects=num_objects)
+
+
+def primary_rays(camera, **params):
+    """Primary rays for the full image or, if params['pixel_indices'] is given, for those pixels only.
+    :return: ray origins, ray directions, H, W ([1, P] for a pixel subset)
+    """
+    pixel_jitter = get_param_value('pixel_jitter', params, None)
+    pixel_indices = get_param_value('pixel_indices', params, None)
+    if pixel_indices is None:
+        ray_orig, ray_dir, H, W = generate_rays(camera, pixel_jitter)
+        return ray_orig, ray_dir, int(H), int(W)
+    offsets = torch.zeros(pixel_indices.shape[0], 1, 2, device=pixel_indices.device)
+    if pixel_jitter is not None:
+        offsets = offsets + torch.tensor(pixel_jitter, dtype=torch.float, device=pixel_indices.device)
+    ray_orig, ray_dir = generate_subpixel_rays(camera, pixel_indices, offsets)
+    return ray_orig, ray_dir, 1, pixel_indices.shape[0]
+
+
+def render_depth(scene, **params):
+    """Depth-only rendering.
+
+    Ray distances are reduced straight to the nearest depth, so no intersection points,
+    normals, or shading are computed. Unlike render, the result has no 'normal', 'pos' or 'gbuffer',
+    and 'image' is the [H, W] normalized depth. params['vis_stat'] returns res['obj_pixel_count'] as
+    in render, but params['visibility_tracker'] and params['bvh'] are ignored.
+    :param scene: Scene description
+    :return: [H, W] normalized depth image
+    """
+    if 'instances' in scene:
+        raise ValueError('instances are not supported in render_depth')
+    camera = scene['camera']
+    ray_orig, ray_dir, H, W = primary_rays(camera, **params)
+    num_pixels = H * W
+
+    # Static objects (if any) come after the dynamic ones, as in render
+    object_sets = [objs for objs in [scene['objects'], get_param_value('static_objects', scene, None)] if objs]
+    per_ray_orig = ray_orig.shape[0] > 1
+
+    if get_param_value('tiled', params, True):
+        tile_size = get_param_value('tile_size', params, 4096)
+    else:
+        tile_size = num_pixels
+    im_depth_all = []
+    nearest_obj_all = []
+    n_partitions = int(np.ceil(num_pixels / tile_size))
+    for idx in range(n_partitions):
+        start_idx = idx * tile_size
+        end_idx = min((idx + 1) * tile_size, num_pixels)
+        ray_orig_subset = ray_orig[start_idx:end_idx] if per_ray_orig else ray_orig
+        ray_dist = torch.cat([ray_object_distances(ray_orig_subset, ray_dir[:, start_idx:end_idx], objs)[0]
+                              for objs in object_sets], dim=0)
+        valid_pixels = (camera['near'] <= ray_dist) * (ray_dist <= camera['far'])
+        pixel_dist = where(valid_pixels, ray_dist, camera['far'] + 1)
+        im_depth, nearest_obj = pixel_dist.min(0)
+        im_depth_all.append(im_depth)
+        nearest_obj_all.append(nearest_obj)
+    im_depth = torch.cat(im_depth_all).view(H, W)
+    nearest_obj = torch.cat(nearest_obj_all)
+    num_objects = ray_dist.shape[0]
+
+    min_depth = torch.min(im_depth)
+    norm_depth_image = where(im_depth >= camera['far'], min_depth, im_depth)
+    norm_depth_image = (norm_depth_image - min_depth) / (torch.max(im_depth) - min_depth)
+    res = {
+        'image': norm_depth_image,
+        'depth': im_depth,
+        'ray_dist': ray_dist,
+        'obj_dist': pixel_dist,
+        'nearest': nearest_obj.view(H, W),
+        'ray_dir': ray_dir,
+        'valid_pixels': valid_pixels,
+    }
+    if get_param_value('vis_stat', params, False):
+        covered = (camera['near'] <= im_depth) * (im_depth <= camera['far'])
+        res['obj_pixel_count'] = torch.zeros(num_objects, device=im_depth.device).index_add_(
+            0, nearest_obj, covered.view(-1).float())
+    if get_param_value('pixel_indices', params, None) is not None:
+        for key in ['image', 'depth', 'nearest']:
+            res[key] = res[key][0]
+    return res
+
+
 def render(scene, **params):
     """Render.
 
+    Geometry in scene['static_objects'] (same format as scene['objects']) is treated as a static
+    layer. It is traced once per camera and cached in params['static_cache'] (a StaticLayerCache)
+    if given, while the objects in scene['objects'] are only traced within their screen footprint
+    and then depth-composited with the static layer.
+
+    params['pixel_jitter'] shifts all the primary rays by a (column, row) offset in pixels
+    (see render_progressive). With params['aa_samples'] > 1, the pixels on object or depth
+    discontinuities are anti-aliased with aa_samples x aa_samples extra rays (see adaptive_supersample).
+
+    With params['pixel_indices'] ([P] flat pixel indices, e.g., from stratified_pixel_sampler), only
+    the rays of those pixels are traced and the outputs are per pixel, in the same order, i.e., the
+    image is [P, 3] and the depth [P].
+
+    With params['checkpoint_tiles'], the intersection and gather of every tile (see params['tile_size'])
+    are recomputed in the backward pass instead of being stored, so the memory of a training step is
+    bounded by one tile plus the outputs.
+
+    With params['visible_grad_only'], the gradients of the scene objects are only computed for the
+    objects that win at least one pixel (returned in res['visible'], see visible_nearest_fragments),
+    and with params['sparse_grad'] they are sparse tensors, so that a torch.optim.SparseAdam step
+    costs O(visible) instead of O(M).
+
+    params['vis_stat'] returns the number of pixels covered by each object in res['obj_pixel_count'], and
+    params['visibility_tracker'] (a VisibilityTracker) accumulates it over the iterations of an
+    optimization, and skips the objects that it marks as dormant.
+
+    params['bvh'] (a diffrend.torch.bvh.BVH of scene['objects']) is refit to the objects at every
+    call (and rebuilt if it degraded), and every tile of rays is only intersected with the objects
+    of the BVH leaves it hits.
+
+    The mesh instances of scene['instances'] (see load_scene with instanced=True) are traced with
+    two-level instancing and depth-composited over scene['objects'] (see instance_fragments).
     :param scene: Scene description
     :return: [H, W, 3] image
     """
+    if get_param_value('norm_depth_image_only', params, False):
+        return render_depth(scene, **params)
+
     # Construct rays from the camera's eye position through the screen
     # coordinates
     camera = scene['camera']
-    ray_orig, ray_dir, H, W = generate_rays(camera)
-    H = int(H)
-    W = int(W)
+    pixel_jitter = get_param_value('pixel_jitter', params, None)
+    pixel_indices = get_param_value('pixel_indices', params, None)
+    ray_orig, ray_dir, H, W = primary_rays(camera, **params)
     num_pixels = H * W
 
     scene_objects = scene['objects']
@@ -159,131 +808,149 @@ def render(scene, **params):
         scene_objects = backface_labeler(ray_orig, scene_objects)
 
     # Ray-object intersections
-    disable_normals = get_param_value('norm_depth_image_only', params, False)
     if get_param_value('tiled', params, True):
-        im_depth_all = []
-        nearest_obj_all = []
-        frag_normals_all = []
-        frag_pos_all = []
         tile_size = get_param_value('tile_size', params, 4096)
-        n_partitions = int(np.ceil(num_pixels / tile_size))
-        for idx in range(n_partitions):
-            start_idx = idx * tile_size
-            end_idx = min((idx + 1) * tile_size, num_pixels)
-            ray_dir_subset = ray_dir[:, start_idx:end_idx]
-            obj_intersections, ray_dist, normals, material_idx = ray_object_intersections(ray_orig, ray_dir_subset,
-                                                                                          scene_objects,
-                                                                                          disable_normals=disable_normals)
-            # num_objects = obj_intersections.size()[0]
-            # Valid distances
-            valid_pixels = (camera['near'] <= ray_dist) * (ray_dist <= camera['far'])
-            pixel_dist = where(valid_pixels, ray_dist, camera['far'] + 1)
-
-            # Nearest object depth and index
-            im_depth, nearest_obj = pixel_dist.min(0)
-
-            frag_normals = torch.gather(
-                normals, 0, nearest_obj[np.newaxis, :, np.newaxis].repeat(1, 1, 3))
-            frag_pos = torch.gather(
-                obj_intersections, 0,
-                nearest_obj[np.newaxis, :, np.newaxis].repeat(1, 1, 3))
-
-            im_depth_all.append(im_depth)
-            nearest_obj_all.append(nearest_obj)
-            frag_normals_all.append(frag_normals)
-            frag_pos_all.append(frag_pos)
-
-            del obj_intersections
-            del valid_pixels
-            del pixel_dist
-        im_depth = torch.cat(im_depth_all)
-        nearest_obj = torch.cat(nearest_obj_all)
-        frag_pos = torch.cat(frag_pos_all, dim=1)
-        frag_normals = torch.cat(frag_normals_all, dim=1)
     else:
-        obj_intersections, ray_dist, normals, material_idx = ray_object_intersections(ray_orig, ray_dir, scene_objects,
-                                                                                      disable_normals=disable_normals)
-        #num_objects = obj_intersections.size()[0]
-        # Valid distances
-        valid_pixels = (camera['near'] <= ray_dist) * (ray_dist <= camera['far'])
-        pixel_dist = where(valid_pixels, ray_dist, camera['far'] + 1)
-
-        # Nearest object depth and index
-        im_depth, nearest_obj = pixel_dist.min(0)
-
-        frag_normals = torch.gather(
-            normals, 0, nearest_obj[np.newaxis, :, np.newaxis].repeat(1, 1, 3))
-        frag_pos = torch.gather(
-            obj_intersections, 0,
-            nearest_obj[np.newaxis, :, np.newaxis].repeat(1, 1, 3))
-
-        del valid_pixels
-        del pixel_dist
-        del obj_intersections
-        del normals
-        valid_pixels = None
-        pixel_dist = None
+        tile_size = num_pixels
+    checkpoint_tiles = get_param_value('checkpoint_tiles', params, False)
+    sparse_grad = get_param_value('sparse_grad', params, False)
+    visible_grad_only = (get_param_value('visible_grad_only', params, False) or sparse_grad) and torch.is_grad_enabled()
+    if visible_grad_only and ('static_objects' in scene or get_param_value('aa_samples', params, 1) > 1):
+        raise ValueError('visible_grad_only is not supported with static_objects or aa_samples')
+    if pixel_indices is not None and ('static_objects' in scene or get_param_value('aa_samples', params, 1) > 1):
+        raise ValueError('pixel_indices is not supported with static_objects or aa_samples')
+    visibility_tracker = get_param_value('visibility_tracker', params, None)
+    if visibility_tracker is not None and 'static_objects' in scene:
+        raise ValueError('visibility_tracker is not supported with static_objects')
+    bvh = get_param_value('bvh', params, None)
+    if bvh is not None and ('static_objects' in scene or visibility_tracker is not None):
+        raise ValueError('bvh is not supported with static_objects or visibility_tracker')
+    if bvh is not None:
+        # The objects may have moved since the last render
+        bvh.refit(scene_objects)
+    if 'instances' in scene and ('static_objects' in scene or get_param_value('shadow', params, False) or
+                                 get_param_value('aa_samples', params, 1) > 1):
+        raise ValueError('instances are not supported with static_objects, shadow or aa_samples')
+    if 'static_objects' in scene:
+        if get_param_value('shadow', params, False):
+            raise ValueError('Shadows are not supported with static_objects')
+        if get_param_value('aa_samples', params, 1) > 1:
+            raise ValueError('Adaptive supersampling is not supported with static_objects')
+        # The cached layer is only valid for the unjittered rays
+        static_cache = get_param_value('static_cache', params, None) if pixel_jitter is None else None
+        static_layer = get_static_layer(scene, ray_orig, ray_dir, tile_size, static_cache, checkpoint=checkpoint_tiles)
+        frags = render_dynamic_layer(scene_objects, camera, ray_orig, ray_dir, H, W, tile_size, static_layer,
+                                     checkpoint=checkpoint_tiles)
+    elif len(scene_objects) == 0:
+        frags = empty_fragments(ray_dir.shape[1], camera, ray_dir.device)
+    else:
+        # The dormant objects of the visibility tracker are not traced
+        active = None if visibility_tracker is None else visibility_tracker.active_objects(
+            num_scene_objects(scene_objects))
+        traced_objects = scene_objects if active is None else select_objects(scene_objects, active)
+        if visible_grad_only:
+            frags = visible_nearest_fragments(ray_orig, ray_dir, traced_objects, camera, tile_size,
+                                              sparse_grad=sparse_grad, checkpoint=checkpoint_tiles, bvh=bvh)
+        else:
+            frags = nearest_fragments(ray_orig, ray_dir, traced_objects, camera, tile_size, checkpoint=checkpoint_tiles,
+                                      bvh=bvh)
+        if active is not None:
+            frags = dict(frags, nearest=active[frags['nearest']], num_objects=num_scene_objects(scene_objects))
+            if visible_grad_only:
+                frags['visible'] = active[frags['visible']]
+    if 'instances' in scene:
+        frags = instance_fragments(ray_orig, ray_dir, scene['instances'], camera, tile_size, frags,
+                                   checkpoint=checkpoint_tiles)
+    im_depth = frags['depth']
+    nearest_obj = frags['nearest']
+    frag_pos = frags['pos']
+    frag_normals = frags['normal']
+    ray_dist = frags['ray_dist']
 
     # Reshape to image for visualization
     # use nearest_obj for gather/select the pixel color
     # im_depth = torch.gather(pixel_dist, 0, nearest_obj[np.newaxis, :]).view(H, W)
     im_depth = im_depth.view(H, W)
 
-    # Find the number of pixels covered by each object
-    if get_param_value('vis_stat', params, False):
-        raise RuntimeError('Removed Support for vis_stat')
-        pixel_obj_count = torch.sum(valid_pixels, dim=0)
-        valid_pixels_mask = pixel_obj_count > 0
-        nearest_obj_only = torch.masked_select(nearest_obj, valid_pixels_mask)
-        obj_pixel_count = bincount(nearest_obj_only, num_objects)
-        valid_pixels_mask = valid_pixels_mask.view(H, W)
+    # Find the number of pixels covered by each object (bincount of the nearest object of the valid pixels)
+    if get_param_value('vis_stat', params, False) or visibility_tracker is not None:
+        valid_pixels = (camera['near'] <= im_depth) * (im_depth <= camera['far'])
+        obj_pixel_count = torch.zeros(frags['num_objects'], device=im_depth.device).index_add_(
+            0, nearest_obj, valid_pixels.view(-1).float())
+        if visibility_tracker is not None:
+            visibility_tracker.add(obj_pixel_count)
     else:
         obj_pixel_count = None
-        pixel_obj_count = None
-        valid_pixels_mask = None
 
-    if get_param_value('norm_depth_image_only', params, False):
-        min_depth = torch.min(im_depth)
-        norm_depth_image = where(im_depth >= camera['far'], min_depth, im_depth)
-        norm_depth_image = (norm_depth_image - min_depth) / (torch.max(im_depth) - min_depth)
-        return {
-            'image': norm_depth_image,
-            'depth': im_depth,
-            'ray_dist': ray_dist,
-            'obj_dist': pixel_dist,
-            'nearest': nearest_obj.view(H, W),
-            'ray_dir': ray_dir,
-            'valid_pixels': valid_pixels,
-            'obj_pixel_count': obj_pixel_count,
-            'pixel_obj_count': pixel_obj_count,
-            'valid_pixels_mask': valid_pixels_mask,
-        }
+    # Everything that shading needs. Can be reused with `shade` while the geometry and camera stay fixed.
+    gbuffer = {'pos': frag_pos,
+               'normal': frag_normals,
+               'material_idx': frags['material_idx'],
+               'nearest': nearest_obj,
+               'depth': im_depth,
+               'camera': camera,
+               'objects': scene_objects,
+               'colors': scene['colors'],
+               }
+    if 'tonemap' in scene:
+        gbuffer['tonemap'] = scene['tonemap']
+
+    res = shade(gbuffer, scene['lights'], scene['materials'], **params)
+    if get_param_value('aa_samples', params, 1) > 1:
+        res['image'] = adaptive_supersample(gbuffer, res['image'], scene['lights'], scene['materials'], **params)
+    if pixel_indices is not None:
+        for key in ['image', 'depth', 'normal', 'pos', 'nearest']:
+            res[key] = res[key][0]
+    res['ray_dist'] = ray_dist
+    res['ray_dir'] = ray_dir
+    if visible_grad_only:
+        res['visible'] = frags['visible']
+    if get_param_value('vis_stat', params, False):
+        res['obj_pixel_count'] = obj_pixel_count
+    if get_param_value('return_gbuffer', params, False):
+        res['gbuffer'] = gbuffer
+    return res
+
+
+def shade(gbuffer, lights, materials, **params):
+    """Shade a G-buffer returned by `render(scene, return_gbuffer=True)`.
+
+    Only the fragment processing is performed, so lighting and material variants of the same view
+    do not redo the ray-object intersections (except for the shadow rays if `shadow` is set).
+    :param gbuffer: G-buffer (see render)
+    :param lights: Lights in the same format as scene['lights']
+    :param materials: Materials in the same format as scene['materials']
+    :return: Same outputs as render except for the ray information
+    """
+    camera = gbuffer['camera']
+    frag_pos = gbuffer['pos']
+    frag_normals = gbuffer['normal']
+    nearest_obj = gbuffer['nearest']
+    im_depth = gbuffer['depth']
+    scene_objects = gbuffer['objects']
+    H, W = im_depth.shape
+    num_pixels = H * W
 
     ##############################
     # Fragment processing
     ##############################
     # Lighting
-    color_table = scene['colors']
-    light_pos = scene['lights']['pos'][:, :3]
-    light_clr_idx = get_as_list(scene['lights']['color_idx'])
+    color_table = gbuffer['colors']
+    light_pos = lights['pos'][:, :3]
+    light_clr_idx = get_as_index(lights['color_idx'])
     light_colors = color_table[light_clr_idx]
-    light_attenuation_coeffs = scene['lights']['attenuation']
-    #if 'ambient' not in scene['lights']:
-    #    ambient_light = tch_var_f([0.0, 0.0, 0.0])
-    #else:
-    ambient_light = scene['lights']['ambient']
+    light_attenuation_coeffs = lights['attenuation']
+    ambient_light = lights['ambient']
 
-    material_albedo = scene['materials']['albedo']
-    material_coeffs = scene['materials']['coeffs']
+    material_albedo = materials['albedo']
+    material_coeffs = materials['coeffs']
 
     # Generate the fragments
     """
     Get the normal and material for the visible objects.
     """
-
-    tmp_idx = torch.gather(material_idx.long(), 0, nearest_obj)
-    frag_albedo = torch.index_select(material_albedo, 0, tmp_idx)
-    frag_coeffs = torch.index_select(material_coeffs, 0, tmp_idx)
+    frag_albedo = torch.index_select(material_albedo, 0, gbuffer['material_idx'])
+    frag_coeffs = torch.index_select(material_coeffs, 0, gbuffer['material_idx'])
 
     # TODO: SOFT light visibility from fragment position
     # Generate rays from fragment position towards the light sources
@@ -308,53 +975,259 @@ def render(scene, **params):
                 valid_dist = (ray_dist > 0) * (ray_dist < frag_to_light_dist[start_idx:end_idx])
                 ray_dist = where(valid_dist, ray_dist, 1001)
                 nearest_depth, nobj_idx = ray_dist.min(0)
-                b_light_visible = (((nearest_depth == 1001) + (nobj_idx == nearest_obj[start_idx:end_idx])) > 0).type(torch.cuda.FloatTensor)
+                b_light_visible = (((nearest_depth == 1001) + (nobj_idx == nearest_obj[start_idx:end_idx])) > 0).float()
                 single_light_vis.append(b_light_visible)
             light_visibility.append(torch.cat(single_light_vis))
         light_visibility = torch.stack(light_visibility, dim=0)
     else:
         light_visibility = None  # tch_var_f(np.ones((num_lights, H * W)))
 
-    im_color = fragment_shader(frag_normals=frag_normals,
-                               light_dir=light_pos[:, np.newaxis, :] - frag_pos,
-                               cam_dir=normalize(camera['eye'][np.newaxis, np.newaxis, :3] - frag_pos[:, :, :3]),
-                               light_attenuation_coeffs=light_attenuation_coeffs,
-                               frag_coeffs=frag_coeffs,
-                               light_colors=light_colors,
-                               ambient_light=ambient_light,
-                               frag_albedo=frag_albedo,
-                               double_sided=get_param_value('double_sided', params, False),
-                               use_quartic=get_param_value('use_quartic', params, False),
-                               light_visibility=light_visibility)
+    valid_pixels = (camera['near'] <= im_depth) * (im_depth <= camera['far'])
 
-    im = torch.sum(im_color, dim=0).view(int(H), int(W), 3)
+    shader_params = dict(frag_pos=frag_pos,
+                         frag_normals=frag_normals,
+                         light_pos=light_pos,
+                         cam_dir=normalize(camera['eye'][np.newaxis, np.newaxis, :3] - frag_pos[:, :, :3]),
+                         light_attenuation_coeffs=light_attenuation_coeffs,
+                         frag_coeffs=frag_coeffs,
+                         light_colors=light_colors,
+                         ambient_light=ambient_light,
+                         frag_albedo=frag_albedo,
+                         double_sided=get_param_value('double_sided', params, False),
+                         use_quartic=get_param_value('use_quartic', params, False),
+                         light_visibility=light_visibility)
+    light_cutoff = get_param_value('light_cutoff', params, None)
+    if light_cutoff is not None:
+        # Clustered shading: only evaluate the lights whose cutoff sphere reaches a screen tile
+        light_radius = light_cutoff_radius(light_attenuation_coeffs, light_cutoff,
+                                           use_quartic=shader_params['use_quartic'])
+        tile_lights, pixel_tile = build_tile_light_lists(frag_pos, valid_pixels, H, W, light_pos, light_radius,
+                                                         tile_size=get_param_value('light_tile_size', params, 16))
+        im = fragment_shader_clustered(tile_lights=tile_lights, pixel_tile=pixel_tile, **shader_params)
+    else:
+        im = fragment_shader_fused(light_chunk=get_param_value('light_chunk', params, 1), **shader_params)
+
+    im = im.view(int(H), int(W), 3)
 
-    valid_pixels = (camera['near'] <= im_depth) * (im_depth <= camera['far'])
     im = valid_pixels[:, :, np.newaxis].float() * im
 
     # clip non-negative
     im = torch.nn.functional.relu(im)
 
     # Tonemapping
-    if 'tonemap' in scene:
-        im = tonemap(im, **scene['tonemap'])
+    if 'tonemap' in gbuffer:
+        im = tonemap(im, **gbuffer['tonemap'])
 
     return {
         'image': im,
         'depth': im_depth,
         'normal': frag_normals.view(H, W, 3),
         'pos': frag_pos.view(H, W, 3),
-        'ray_dist': ray_dist,
-        #'obj_dist': pixel_dist,
         'nearest': nearest_obj.view(H, W),
-        'ray_dir': ray_dir,
-        #'valid_pixels': valid_pixels,
-        #'obj_pixel_count': obj_pixel_count,
-        #'pixel_obj_count': pixel_obj_count,
-        #'valid_pixels_mask': valid_pixels_mask,
     }
 
 
+def object_edges(labels, width=1):
+    """[H, W] mask of the pixels within `width` pixels of a boundary between labels (e.g., nearest)."""
+    padded = torch.nn.functional.pad(labels[np.newaxis, np.newaxis].float(), (1, 1, 1, 1), mode='replicate')[0, 0]
+    center = padded[1:-1, 1:-1]
+    edges = ((padded[:-2, 1:-1] != center) | (padded[2:, 1:-1] != center) |
+             (padded[1:-1, :-2] != center) | (padded[1:-1, 2:] != center))
+    if width > 1:
+        edges = torch.nn.functional.max_pool2d(edges[np.newaxis, np.newaxis].float(), 2 * width - 1,
+                                               stride=1, padding=width - 1)[0, 0] > 0
+    return edges
+
+
+def depth_edges(depth, threshold):
+    """[H, W] mask of the pixels whose depth differs from a 4-neighbour by more than `threshold`
+    (relative to the smaller of the two depths).
+    """
+    padded = torch.nn.functional.pad(depth[np.newaxis, np.newaxis], (1, 1, 1, 1), mode='replicate')[0, 0]
+    center = padded[1:-1, 1:-1]
+    edges = torch.zeros_like(center, dtype=torch.bool)
+    for neighbour in [padded[:-2, 1:-1], padded[2:, 1:-1], padded[1:-1, :-2], padded[1:-1, 2:]]:
+        edges = edges | (torch.abs(neighbour - center) > threshold * torch.min(neighbour, center))
+    return edges
+
+
+def adaptive_supersample(gbuffer, image, lights, materials, **params):
+    """Anti-alias the discontinuities of a rendered image.
+
+    Pixels on a boundary of `nearest` or on a depth discontinuity get aa_samples x aa_samples
+    stratified, jittered sub-pixel rays, which are traced, shaded and resolved with a box filter
+    (one pixel wide) or a tent filter (two pixels wide). The other pixels keep their single sample.
+    :param gbuffer: G-buffer of the primary pass (see render)
+    :param image: [H, W, 3] image of the primary pass
+    :return: [H, W, 3] image
+    """
+    camera = gbuffer['camera']
+    im_depth = gbuffer['depth']
+    H, W = im_depth.shape
+    k = get_param_value('aa_samples', params, 2)
+    aa_filter = get_param_value('aa_filter', params, 'box')
+
+    valid_pixels = (camera['near'] <= im_depth) * (im_depth <= camera['far'])
+    labels = torch.where(valid_pixels, gbuffer['nearest'].view(H, W), torch.full_like(gbuffer['nearest'].view(H, W), -1))
+    edges = object_edges(labels) | depth_edges(im_depth, get_param_value('aa_depth_threshold', params, 0.05))
+    pixel_idx = torch.nonzero(edges.view(-1)).view(-1)
+    num_edge_pixels = pixel_idx.shape[0]
+    if num_edge_pixels == 0:
+        return image
+
+    # Stratified jitter over the filter support
+    support = 2. if aa_filter == 'tent' else 1.
+    grid = (torch.arange(k, dtype=torch.float, device=im_depth.device) + 0.5) / k
+    strata = torch.stack(torch.meshgrid(grid, grid, indexing='xy'), dim=-1).view(-1, 2)
+    jitter = (torch.rand(num_edge_pixels, k * k, 2, device=im_depth.device) - 0.5) / k
+    offsets = (strata[np.newaxis] + jitter - 0.5) * support
+    ray_orig, ray_dir = generate_subpixel_rays(camera, pixel_idx, offsets)
+
+    if get_param_value('tiled', params, True):
+        tile_size = get_param_value('tile_size', params, 4096)
+    else:
+        tile_size = ray_dir.shape[1]
+    frags = nearest_fragments(ray_orig, ray_dir, gbuffer['objects'], camera, tile_size)
+    sub_gbuffer = dict(gbuffer, pos=frags['pos'], normal=frags['normal'], material_idx=frags['material_idx'],
+                       nearest=frags['nearest'], depth=frags['depth'].view(1, -1))
+    samples = shade(sub_gbuffer, lights, materials, **params)['image'].view(num_edge_pixels, k * k, 3)
+
+    if aa_filter == 'tent':
+        weights = torch.prod(1 - torch.abs(offsets), dim=-1)
+    else:
+        weights = torch.ones_like(offsets[..., 0])
+    weights = weights / torch.sum(weights, dim=1, keepdim=True)
+    filtered = torch.sum(weights[..., np.newaxis] * samples, dim=1)
+    return image.view(-1, 3).index_copy(0, pixel_idx, filtered).view(H, W, 3)
+
+
+def halton(index, base):
+    """Element `index` (starting at 1) of the van der Corput sequence in `base`, i.e., one coordinate of
+    the Halton sequence."""
+    result = 0.
+    f = 1.
+    while index > 0:
+        f /= base
+        result += f * (index % base)
+        index //= base
+    return result
+
+
+class VisibilityTracker:
+    """Per-object pixel coverage over the iterations of an optimization (see `render` with
+    params['visibility_tracker']).
+
+    The coverage of all the renders (e.g., views) of an iteration is accumulated until `step`. Objects
+    that cover no pixel for `max_invisible` consecutive iterations become dormant and are not traced
+    anymore, except every `retest_interval` iterations where all the objects are traced, and the
+    dormant objects that cover pixels again become active.
+    """
+    def __init__(self, max_invisible=10, retest_interval=10):
+        self.max_invisible = max_invisible
+        self.retest_interval = retest_interval
+        self.iteration = 0
+        self.invisible_iters = None
+        self.coverage = None
+        self.active = None
+
+    def is_retest(self):
+        return self.iteration % self.retest_interval == 0
+
+    def active_objects(self, num_objects):
+        """[K] indices of the objects to trace in the current iteration, or None for all of them"""
+        if self.invisible_iters is None or self.invisible_iters.shape[0] != num_objects:
+            self.invisible_iters = None
+            return None
+        if self.is_retest():
+            return None
+        if self.active is None:
+            self.active = torch.nonzero(self.invisible_iters < self.max_invisible).view(-1)
+        # Nothing to trace would be an empty scene
+        return self.active if self.active.numel() > 0 else None
+
+    def add(self, obj_pixel_count):
+        self.coverage = obj_pixel_count if self.coverage is None else self.coverage + obj_pixel_count
+
+    def step(self):
+        """End of an iteration. The objects that were not traced count as invisible."""
+        if self.coverage is not None:
+            if self.invisible_iters is None:
+                self.invisible_iters = torch.zeros_like(self.coverage, dtype=torch.long)
+            self.invisible_iters = torch.where(self.coverage > 0, torch.zeros_like(self.invisible_iters),
+                                               self.invisible_iters + 1)
+        self.coverage = None
+        self.active = None
+        self.iteration += 1
+
+    def dormant(self):
+        """[D] indices of the dormant objects"""
+        if self.invisible_iters is None:
+            return torch.zeros(0, dtype=torch.long)
+        return torch.nonzero(self.invisible_iters >= self.max_invisible).view(-1)
+
+
+class ProgressiveAccumulator:
+    """Running per-pixel mean and variance (Welford) of a series of images."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def add(self, image):
+        self.count += 1
+        if self.mean is None:
+            self.mean = image
+            self.m2 = torch.zeros_like(image.detach())
+            return
+        delta = image - self.mean
+        self.mean = self.mean + delta / self.count
+        self.m2 = self.m2 + delta.detach() * (image - self.mean).detach()
+
+    def variance(self):
+        """Mean over the pixels of the variance of the running mean estimate."""
+        if self.count < 2:
+            return float('inf')
+        return float(torch.mean(self.m2) / (self.count * (self.count - 1)))
+
+
+def render_progressive(scene, **params):
+    """Progressive stochastic anti-aliasing.
+
+    Each pass renders the scene with the primary rays jittered within the pixel footprint, following
+    a Halton (2, 3) sequence (the first pass is not jittered), and accumulates the images into a
+    running mean. Stops after params['aa_max_passes'] passes, or earlier once the variance of the
+    mean drops below params['aa_var_threshold'] or the time spent reaches params['aa_time_budget']
+    seconds.
+    :param scene: Scene description
+    :return: Output of render for the first pass, with the accumulated 'image', the number of
+             'passes' and the final 'variance'
+    """
+    from time import time
+    if 'pixel_jitter' in params:
+        raise ValueError('render_progressive sets the pixel_jitter of every pass')
+    max_passes = get_param_value('aa_max_passes', params, 16)
+    var_threshold = get_param_value('aa_var_threshold', params, None)
+    time_budget = get_param_value('aa_time_budget', params, None)
+    start_time = time()
+    accumulator = ProgressiveAccumulator()
+    res = None
+    for idx in range(max_passes):
+        jitter = None if idx == 0 else (halton(idx + 1, 2) - 0.5, halton(idx + 1, 3) - 0.5)
+        pass_res = render(scene, pixel_jitter=jitter, **params)
+        if res is None:
+            res = pass_res
+        accumulator.add(pass_res['image'])
+        if var_threshold is not None and accumulator.variance() <= var_threshold:
+            break
+        if time_budget is not None and time() - start_time >= time_budget:
+            break
+    res['image'] = accumulator.mean
+    res['passes'] = accumulator.count
+    res['variance'] = accumulator.variance()
+    return res
+
+
 def render_splats_NDC(scene, **params):
     """Render splats specified in the camera's normalized coordinate system
 
@@ -432,8 +1305,9 @@ def render_splats_NDC(scene, **params):
     frag_coeffs = torch.index_select(material_coeffs, 0, material_idx)
     light_visibility = None
     # TODO: CHECK fragment_shader call
-    im_color = fragment_shader(frag_normals=frag_normals,
-                               light_dir=light_pos_CC[:, np.newaxis, :3] - frag_pos[:, :3],
+    im = fragment_shader_fused(frag_pos=frag_pos,
+                               frag_normals=frag_normals,
+                               light_pos=light_pos_CC,
                                cam_dir=-frag_pos[:, :3],
                                light_attenuation_coeffs=light_attenuation_coeffs,
                                frag_coeffs=frag_coeffs,
@@ -442,7 +1316,8 @@ def render_splats_NDC(scene, **params):
                                frag_albedo=frag_albedo,
                                double_sided=get_param_value('double_sided', params, False),
                                use_quartic=get_param_value('use_quartic', params, False),
-                               light_visibility=light_visibility)
+                               light_visibility=light_visibility,
+                               light_chunk=get_param_value('light_chunk', params, 1))
     # # Fragment shading
     # light_dir = light_pos_CC[:, np.newaxis, :3] - frag_pos[:, :3]
     # light_dir_norm = torch.sqrt(torch.sum(light_dir ** 2, dim=-1))[:, :, np.newaxis]
@@ -457,7 +1332,7 @@ def render_splats_NDC(scene, **params):
     # im_color = frag_normal_dot_light[:, :, np.newaxis] * \
     #            light_colors[:, np.newaxis, :] * frag_albedo[np.newaxis, :, :]
 
-    im = torch.sum(im_color, dim=0).view(int(H), int(W), 3)
+    im = im.view(int(H), int(W), 3)
 
     # clip non-negative
     im = torch.nn.functional.relu(im)
@@ -474,13 +1349,6 @@ def render_splats_NDC(scene, **params):
     }
 
 
-def reshape_upsampled_data(x, H, W, C, K):
-    x = x.view(H, W, C, K, K)
-    # In numpy transpose(0, 3, 1, 4, 2)
-    x = x.transpose(3, 1).transpose(3, 2).transpose(4, 3)
-    return x.contiguous().view(H * W * K * K, C)
-
-
 def z_to_pcl_CC(z, camera):
     viewport = np.array(get_data(camera['viewport']))
     W, H = int(viewport[2] - viewport[0]), int(viewport[3] - viewport[1])
@@ -534,6 +1402,45 @@ def z_to_pcl_CC_batched(z, camera):
     return torch.stack((X, Y, Z), dim=-1)
 
 
+def supersample_splats(pos_CC, normals_CC, x, y, H, W, w, h, focal_length, samples):
+    """Intersect samples x samples sub-pixel rays per pixel with the splat planes.
+    :param pos_CC: [..., H*W, 3] splat positions in the camera coordinate
+    :param normals_CC: [..., H*W, 3+] splat normals in the camera coordinate
+    :param x, y: [H*W] pixel centers on the projection plane
+    :return: [..., H*K*W*K, 3] positions and normals, in the [H, K, W, K] sub-pixel layout
+    """
+    batch_shape = pos_CC.shape[:-2]
+    # plane parameter
+    d = torch.sum(pos_CC * normals_CC[..., :3], dim=-1).view(*batch_shape, H, 1, W, 1)
+
+    # Find ray-plane intersection for the plane bounded by the frustum
+    # The width and height of the projection plane are w and h
+    dx = w / (samples * W - 1)  # subpixel width
+    dy = h / (samples * H - 1)  # subpixel height
+    # Sub-pixel grid of shape [H, K, W, K]: the first K indexes the x offsets and the second
+    # one the y offsets. Per-pixel quantities are broadcast over both K dimensions.
+    # TODO (fmannan): generalize (the div by 2) for samples > 3
+    deltax = tch_var_f(np.linspace(-1, 1, samples) * dx / 2).view(1, samples, 1, 1)
+    deltay = tch_var_f(np.linspace(1, -1, samples) * dy / 2).view(1, 1, 1, samples)
+    xx = x.view(H, 1, W, 1) + deltax
+    yy = y.view(H, 1, W, 1) + deltay
+    xx, yy = torch.broadcast_tensors(xx, yy)
+    # unit ray going through sub-pixels
+    pos_CC_projplane = normalize(torch.stack((xx, yy, torch.full_like(xx, -focal_length)), dim=-1))
+    pixel_normals = normals_CC[..., :3].reshape(*batch_shape, H, 1, W, 1, 3)
+    t = d / torch.sum(pos_CC_projplane * pixel_normals, dim=-1)
+    pos_CC = (t[..., np.newaxis] * pos_CC_projplane).view(*batch_shape, -1, 3)
+    normals_CC = pixel_normals.expand(*batch_shape, H, samples, W, samples, 3).reshape(*batch_shape, -1, 3)
+    return pos_CC, normals_CC
+
+
+def upsample_pixel_data(x, H, W, samples):
+    """Broadcast per-pixel data [..., H*W] to the sub-pixel layout of supersample_splats."""
+    batch_shape = x.shape[:-1]
+    return x.view(*batch_shape, H, 1, W, 1).expand(*batch_shape, H, samples, W, samples).reshape(
+        *batch_shape, -1)
+
+
 def render_splats_along_ray(scene, **params):
     """Render splats specified in the camera's coordinate system
 
@@ -621,54 +1528,10 @@ def render_splats_along_ray(scene, **params):
         n_x t u_x + ... = d0
         t = d0 / dot(n, ray)
         """
-        # plane parameter
-        d = torch.sum(pos_CC * normals_CC[:, :3], dim=1)
-        z = tch_var_f(np.ones(x.shape) * -focal_length)
-        # # Test consistency
-        # pos_CC_projplane = torch.stack((x, y, z), dim=1)
-        # dot_ray_normal = torch.sum(pos_CC_projplane * normals_CC[:, :3], dim=1)
-        # t = d / dot_ray_normal
-        # pos_CC_test = t[:, np.newaxis] * pos_CC_projplane
-        # diff = torch.mean(torch.abs(pos_CC_test - pos_CC))
-        # print(diff)
-        # # End of consistency check
-
-        # Find ray-plane intersection for the plane bounded by the frustum
-        # The width and height of the projection plane are w and h
-        dx = w / (samples * W - 1)  # subpixel width
-        dy = h / (samples * H - 1)  # subpixel height
-        pos_CC_supersampled = []
-        normals_CC_supersampled = []
-        material_idx_supersampled = []
-        if light_visibility is not None:
-            light_visibility_supersampled = []
-            light_visibility = light_visibility.transpose(1, 0)
-        for c, deltax in enumerate(np.linspace(-1, 1, samples)):
-            # TODO (fmannan): generalize (the div by 2) for samples > 3
-            xx = x + deltax * dx / 2  # Shift by half of the subpixel size
-            for r, deltay in enumerate(np.linspace(1, -1, samples)):
-                yy = y + deltay * dy / 2
-                # unit ray going through sub-pixels
-                pos_CC_projplane = normalize(torch.stack((xx, yy, z), dim=1))
-                dot_ray_normal = torch.sum(pos_CC_projplane * normals_CC[:, :3], dim=1)
-                t = d / dot_ray_normal
-
-                pos_CC_supersampled.append(t[:, np.newaxis] * pos_CC_projplane)
-                normals_CC_supersampled.append(normals_CC[:, :3])
-                material_idx_supersampled.append(material_idx[:, np.newaxis])
-                if light_visibility is not None:
-                    light_visibility_supersampled.append(light_visibility)
-        pos_CC_supersampled = torch.stack(pos_CC_supersampled, dim=2)
-        normals_CC_supersampled = torch.stack(normals_CC_supersampled, dim=2)
-        material_idx_supersampled = torch.stack(material_idx_supersampled, dim=2)
-        if light_visibility is not None:
-            light_visibility_supersampled = torch.stack(light_visibility_supersampled, dim=2)
-
-        pos_CC = reshape_upsampled_data(pos_CC_supersampled, H, W, 3, samples)
-        normals_CC = reshape_upsampled_data(normals_CC_supersampled, H, W, 3, samples)
-        material_idx = reshape_upsampled_data(material_idx_supersampled, H, W, 1, samples).view(-1)
+        pos_CC, normals_CC = supersample_splats(pos_CC, normals_CC, x, y, H, W, w, h, focal_length, samples)
+        material_idx = upsample_pixel_data(material_idx, H, W, samples)
         if light_visibility is not None:
-            light_visibility = reshape_upsampled_data(light_visibility_supersampled, H, W, light_visibility.shape[1], samples).transpose(1, 0)
+            light_visibility = upsample_pixel_data(light_visibility, H, W, samples)
         H *= samples
         W *= samples
         ####
@@ -722,8 +1585,9 @@ def render_splats_along_ray(scene, **params):
     # frag_albedo = torch.index_select(material_albedo, 0, material_idx)
     # frag_coeffs = torch.index_select(material_coeffs, 0, material_idx)
 
-    im_color = fragment_shader(frag_normals=frag_normals,
-                               light_dir=light_pos_CC[:, np.newaxis, :3] - frag_pos[:, :3],
+    im = fragment_shader_fused(frag_pos=frag_pos,
+                               frag_normals=frag_normals,
+                               light_pos=light_pos_CC,
                                cam_dir=-normalize(frag_pos[np.newaxis, :, :3]),
                                light_attenuation_coeffs=light_attenuation_coeffs,
                                frag_coeffs=frag_coeffs,
@@ -732,9 +1596,10 @@ def render_splats_along_ray(scene, **params):
                                frag_albedo=frag_albedo,
                                double_sided=False,
                                use_quartic=get_param_value('use_quartic', params, False),
-                               light_visibility=light_visibility)
+                               light_visibility=light_visibility,
+                               light_chunk=get_param_value('light_chunk', params, 1))
 
-    im = torch.sum(im_color, dim=0).view(int(H), int(W), 3)
+    im = im.view(int(H), int(W), 3)
 
     # clip non-negative
     im = torch.nn.functional.relu(im)
@@ -751,6 +1616,107 @@ def render_splats_along_ray(scene, **params):
     }
 
 
+def render_splats_along_ray_batched(scene, pos, normal, cameras, lights, **params):
+    """Batched render_splats_along_ray: one vectorized call for B sets of splats, cameras and lights.
+
+    :param scene: Scene description for the shared colors, materials and splat material indices
+                  (scene['objects']['disk']['material_idx'] is [N] or [B, N], and the optional
+                  'light_vis' is [L, N] or [B, L, N])
+    :param pos: [B, N] splat depths along the pixel rays (or [B, N, 3] with the depth in [..., 2])
+    :param normal: [B, N, 3] splat normals in the camera coordinate, or None to estimate them
+    :param cameras: Camera with [B, ...] 'eye', 'at' and 'up' (as in the projection layer)
+    :param lights: Lights with [B, L, 3/4] or [L, 3/4] 'pos'
+    :return: [B, H, W, 3] image, [B, H, W] depth, [B, H, W, 3] pos and normal
+    """
+    viewport = np.array(get_data(cameras['viewport']))
+    W, H = int(viewport[2] - viewport[0]), int(viewport[3] - viewport[1])
+    batch_size = pos.shape[0]
+    aspect_ratio = W / H
+    focal_length = cameras['focal_length']
+    h = np.tan(cameras['fovy'] / 2) * 2 * focal_length
+    w = h * aspect_ratio
+
+    if pos.dim() == 3:
+        pos = pos[..., 2]
+    pos_CC = z_to_pcl_CC_batched(pos, cameras)
+
+    if normal is None:
+        if get_param_value('normal_estimation_method', params, 'plane') != 'plane':
+            raise ValueError('Only plane fit normal estimation is supported in batched mode')
+        normal = estimate_surface_normals_plane_fit_batched(pos_CC.view(batch_size, H, W, 3)).view(batch_size, -1, 3)
+    normals_CC = normal[..., :3]
+
+    splats = scene['objects']['disk']
+    material_idx = splats['material_idx']
+    if material_idx.dim() == 1:
+        material_idx = material_idx[np.newaxis].expand(batch_size, -1)
+    light_visibility = get_param_value('light_vis', splats, None)
+
+    samples = get_param_value('samples', params, 1)
+    if samples > 1:
+        y, x = torch.meshgrid(torch.linspace(1, -1, H, device=pos.device),
+                              torch.linspace(-1, 1, W, device=pos.device), indexing='ij')
+        pos_CC, normals_CC = supersample_splats(pos_CC, normals_CC, x.flatten() * w / 2, y.flatten() * h / 2,
+                                                H, W, w, h, focal_length, samples)
+        material_idx = upsample_pixel_data(material_idx, H, W, samples)
+        if light_visibility is not None:
+            light_visibility = upsample_pixel_data(light_visibility, H, W, samples)
+        H *= samples
+        W *= samples
+    im_depth = norm_p(pos_CC).view(batch_size, H, W)
+
+    if get_param_value('norm_depth_image_only', params, False):
+        min_depth = im_depth.view(batch_size, -1).min(dim=1)[0].view(-1, 1, 1)
+        max_depth = im_depth.view(batch_size, -1).max(dim=1)[0].view(-1, 1, 1)
+        norm_depth_image = torch.where(im_depth >= cameras['far'], min_depth.expand_as(im_depth), im_depth)
+        norm_depth_image = (norm_depth_image - min_depth) / (max_depth - min_depth)
+        return {
+            'image': norm_depth_image,
+            'depth': im_depth,
+            'pos': pos_CC.view(batch_size, H, W, 3),
+            'normal': normals_CC.contiguous().view(batch_size, H, W, 3)
+        }
+
+    # Lights in the camera coordinate of each image
+    light_pos = lights['pos']
+    if light_pos.dim() == 2:
+        light_pos = light_pos[np.newaxis].expand(batch_size, -1, -1)
+    light_pos_CC = world_to_cam_batched(light_pos, None, cameras)['pos'][..., :3]
+    num_fragments = pos_CC.shape[1]
+    # Per-fragment light positions as a broadcast [L, B, N, 3] view
+    light_pos_CC = light_pos_CC.transpose(1, 0)[:, :, np.newaxis, :].expand(-1, -1, num_fragments, -1)
+    if light_visibility is not None:
+        if light_visibility.dim() == 2:
+            light_visibility = light_visibility[np.newaxis].expand(batch_size, -1, -1)
+        light_visibility = light_visibility.transpose(1, 0).reshape(light_visibility.shape[1], -1)
+
+    frag_pos = pos_CC.reshape(-1, 3)
+    material_idx = material_idx.reshape(-1)
+    im = fragment_shader_fused(frag_pos=frag_pos,
+                               frag_normals=normals_CC.reshape(-1, 3),
+                               light_pos=light_pos_CC,
+                               cam_dir=-normalize(frag_pos),
+                               light_attenuation_coeffs=lights['attenuation'],
+                               frag_coeffs=torch.index_select(scene['materials']['coeffs'], 0, material_idx),
+                               light_colors=scene['colors'][lights['color_idx']],
+                               ambient_light=lights['ambient'],
+                               frag_albedo=torch.index_select(scene['materials']['albedo'], 0, material_idx),
+                               double_sided=False,
+                               use_quartic=get_param_value('use_quartic', params, False),
+                               light_visibility=light_visibility,
+                               light_chunk=get_param_value('light_chunk', params, 1))
+
+    # clip non-negative
+    im = torch.nn.functional.relu(im.view(batch_size, H, W, 3))
+
+    return {
+        'image': im,
+        'depth': im_depth,
+        'pos': pos_CC.view(batch_size, H, W, 3),
+        'normal': normals_CC.contiguous().view(batch_size, H, W, 3)
+    }
+
+
 def test_render_splat_NDC_0():
     fovy = np.deg2rad(45)
     aspect_ratio = 1
@@ -770,3 +1736,123 @@ def test_render_splat_NDC_0():
     pos_CC = pos_CC / pos_CC[..., 3][:, np.newaxis]
 
     pixel_dist = norm_p(pos_CC[..., :3])
+
+
+def test_render_no_host_sync(scene, normal_estimation_method='plane'):
+    """render (also with a static layer) and render_splats_along_ray must not read tensors back to the host
+    in the strict mode. Out of this scope, a StaticLayerCache (camera keys) and a VisibilityTracker (active
+    objects) do read values back, and trap_host_sync must catch them.
+    :param scene: Scene with torch variables (see make_torch_var)
+    """
+    splats_scene = dict(scene)
+    viewport = make_list2np(scene['camera']['viewport'])
+    num_pixels = int((viewport[2] - viewport[0]) * (viewport[3] - viewport[1]))
+    splats_scene['objects'] = {'disk': {'pos': tch_var_f(-2 - np.random.rand(num_pixels)),
+                                        'normal': None,
+                                        'material_idx': torch.zeros(num_pixels, dtype=torch.long,
+                                                                    device=scene['lights']['pos'].device)}}
+    # The same objects as a static layer and as dynamic objects traced within their screen footprint
+    static_scene = dict(scene, static_objects=scene['objects'])
+    with no_host_sync(), trap_host_sync():
+        render(scene)
+        render(static_scene)
+        render_splats_along_ray(splats_scene, normal_estimation_method=normal_estimation_method)
+
+    tracker = VisibilityTracker(max_invisible=1)
+    render(scene, visibility_tracker=tracker)
+    tracker.step()
+    for sync_scene, params in [(static_scene, {'static_cache': StaticLayerCache()}),
+                               (scene, {'visibility_tracker': tracker})]:
+        try:
+            with no_host_sync(), trap_host_sync():
+                render(sync_scene, **params)
+        except HostSyncError:
+            continue
+        raise AssertionError('No host synchronization with ' + ', '.join(params))
+    # The trapped functions are restored after an exception
+    assert torch.nonzero(torch.ones(1)).numel() == 1 and torch.ones(1).item() == 1
+
+
+def test_render_visible_grad(scene):
+    """render with visible_grad_only/sparse_grad must give the same outputs and gradients as the dense backward,
+    with zero gradients for the objects that do not win any pixel.
+    :param scene: Scene with torch variables (see make_torch_var) whose objects all have a 'pos' (no triangles)
+    """
+    grads = []
+    for params in [{}, {'visible_grad_only': True}, {'sparse_grad': True}]:
+        params_scene = dict(scene, objects={obj_type: dict(obj) for obj_type, obj in scene['objects'].items()})
+        pos = [obj['pos'].detach().clone().requires_grad_(True) for obj in params_scene['objects'].values()]
+        for obj, obj_pos in zip(params_scene['objects'].values(), pos):
+            obj['pos'] = obj_pos
+        res = render(params_scene, **params)
+        torch.sum(res['image']).backward()
+        grads.append([p.grad.to_dense() if p.grad.is_sparse else p.grad for p in pos])
+        if params:
+            assert all(p.grad.is_sparse for p in pos) == params.get('sparse_grad', False)
+            visible = torch.zeros(sum(p.shape[0] for p in pos), dtype=torch.bool)
+            visible[res['visible'].cpu()] = True
+            assert not torch.any(torch.cat(grads[-1]).cpu()[~visible])
+    for dense_grad, visible_grad, sparse_grad in zip(*grads):
+        np.testing.assert_allclose(get_data(visible_grad), get_data(dense_grad))
+        np.testing.assert_allclose(get_data(sparse_grad), get_data(dense_grad))
+
+
+def test_render_instanced(scene_filename):
+    """render with two-level instancing must match render with the objects baked into world-space triangles.
+    :param scene_filename: diffrend scene file (see load_scene)
+    """
+    from diffrend.torch.render import load_scene, make_torch_var
+    res = render(make_torch_var(load_scene(scene_filename)))
+    res_instanced = render(make_torch_var(load_scene(scene_filename, instanced=True)))
+    np.testing.assert_allclose(get_data(res_instanced['image']), get_data(res['image']), atol=1e-5)
+    np.testing.assert_allclose(get_data(res_instanced['depth']), get_data(res['depth']), rtol=1e-5)
+
+
+def test_render_progressive(scene_filename, max_passes=4, ref_grid=4, atol=5e-3):
+    """render_progressive must run on a scene loaded from file (tensor viewport). Away from the object and
+    depth edges, the accumulated image must match the single sample render, and it must get closer to a
+    supersampled reference (the mean of a ref_grid x ref_grid grid of jittered renders) as passes are added.
+    :param scene_filename: diffrend scene file (see load_scene)
+    """
+    from diffrend.torch.render import load_scene, make_torch_var
+    scene = make_torch_var(load_scene(scene_filename))
+    camera = scene['camera']
+    res = render(scene)
+    H, W = res['depth'].shape
+    valid_pixels = (camera['near'] <= res['depth']) * (res['depth'] <= camera['far'])
+    labels = torch.where(valid_pixels, res['nearest'].view(H, W), torch.full_like(res['nearest'].view(H, W), -1))
+    # Half a pixel of jitter reaches one pixel past the edges
+    edges = object_edges(labels, width=2) | depth_edges(res['depth'], 0.05)
+    edges = torch.nn.functional.max_pool2d(edges[np.newaxis, np.newaxis].float(), 3, stride=1, padding=1)[0, 0] > 0
+    interior = ~get_data(edges)
+
+    offsets = (np.arange(ref_grid) + 0.5) / ref_grid - 0.5
+    reference = get_data(torch.stack([render(scene, pixel_jitter=(float(x), float(y)))['image']
+                                      for y in offsets for x in offsets]).mean(dim=0))
+    errors = []
+    passes = 1
+    while passes <= max_passes:
+        res_progressive = render_progressive(scene, aa_max_passes=passes)
+        assert res_progressive['passes'] == passes
+        assert res_progressive['image'].shape == res['image'].shape
+        np.testing.assert_array_equal(get_data(res_progressive['depth']), get_data(res['depth']))
+        image = get_data(res_progressive['image'])
+        np.testing.assert_allclose(image[interior], get_data(res['image'])[interior], atol=atol)
+        errors.append(float(np.mean(np.abs(image - reference))))
+        passes *= 2
+    print('Mean error to the reference: {}'.format(errors))
+    assert np.all(np.diff(errors) < 0)
+
+
+def test_render_light_cutoff(scene_filename):
+    """Clustered shading with a light_cutoff of 0 culls no light, so it must match the unculled shading.
+    The lights get a distance falloff and the materials a specular term, so that both take part in the comparison.
+    :param scene_filename: diffrend scene file (see load_scene)
+    """
+    from diffrend.torch.render import load_scene, make_torch_var
+    scene = make_torch_var(load_scene(scene_filename))
+    scene['lights']['attenuation'] = tch_var_f([[0.5, 0.1, 0.05]] * scene['lights']['pos'].shape[0])
+    scene['materials']['coeffs'] = tch_var_f([[0.6, 0.4, 8.0]] * scene['materials']['coeffs'].shape[0])
+    res = render(scene)
+    res_clustered = render(scene, light_cutoff=0)
+    np.testing.assert_allclose(get_data(res_clustered['image']), get_data(res['image']), rtol=1e-5, atol=1e-6)
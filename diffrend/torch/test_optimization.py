@@ -1,12 +1,13 @@
 from diffrend.torch.params import SCENE_BASIC, SCENE_1, SCENE_2
-from diffrend.torch.renderer import render, render_splats_NDC, render_splats_along_ray, z_to_pcl_CC
+from diffrend.torch.renderer import render, render_splats_NDC, render_splats_along_ray, z_to_pcl_CC, VisibilityTracker
 from diffrend.torch.utils import (tch_var_f, tch_var_l, CUDA, get_data, get_normalmap_image,
                                   world_to_cam, cam_to_world, normalize, unit_norm2_L2loss,
                                   normalize_maxmin, normal_consistency_cost, away_from_camera_penalty,
                                   spatial_3x3, depth_rgb_gradient_consistency, grad_spatial2d,
-                                  estimate_surface_normals_plane_fit)
+                                  estimate_surface_normals_plane_fit, stratified_pixel_sampler)
 from diffrend.torch.ops import sph2cart_unit
 from diffrend.utils.utils import save_xyz
+import torch
 import torch.nn as nn
 from torch import optim
 import torch.nn.functional as F
@@ -19,6 +20,7 @@ import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import os
+import time
 import argparse
 
 
@@ -27,7 +29,7 @@ def render_scene(scene, output_folder, norm_depth_image_only=False, backface_cul
         os.mkdir(output_folder)
 
     # main render run
-    res = render(scene, norm_depth_image_only=norm_depth_image_only, backface_culling=backface_culling)
+    res = render(scene, norm_depth_image_only=norm_depth_image_only, backface_culling=backface_culling, vis_stat=True)
     im = get_data(res['image'])
     im_nearest = get_data(res['nearest'])
     obj_pixel_count = get_data(res['obj_pixel_count']) if 'obj_pixel_count' in res else None
@@ -66,11 +68,93 @@ def render_scene(scene, output_folder, norm_depth_image_only=False, backface_cul
     return res
 
 
+class CoarseToFineSchedule:
+    """Resolution schedule of a coarse-to-fine optimization.
+
+    Level l renders (width, height) / 2^(num_levels - 1 - l) images with samples[l] supersampling, i.e., with a
+    grid of size / samples[l] splats. The next level starts after level_iters iterations at the current one, or as
+    soon as the loss plateaus: when the best loss of the last plateau_window iterations is not lower than
+    (1 - plateau_tol) times the best one before them.
+    """
+    def __init__(self, width, height, num_levels=3, samples=None, level_iters=None, plateau_window=20,
+                 plateau_tol=1e-2):
+        self.width = width
+        self.height = height
+        self.num_levels = num_levels
+        self.samples = samples if samples is not None else [1] * num_levels
+        assert len(self.samples) == num_levels
+        self.level_iters = level_iters
+        self.plateau_window = plateau_window
+        self.plateau_tol = plateau_tol
+        self.level = 0
+        self.losses = []
+
+    def size(self, level=None):
+        """(width, height) of the images rendered at a level (the current one by default)"""
+        scale = 2 ** (self.num_levels - 1 - (self.level if level is None else level))
+        return max(self.width // scale, 1), max(self.height // scale, 1)
+
+    def splat_grid(self, level=None):
+        """(width, height) of the grid of splats at a level (the current one by default)"""
+        level = self.level if level is None else level
+        width, height = self.size(level)
+        return max(width // self.samples[level], 1), max(height // self.samples[level], 1)
+
+    def plateaued(self):
+        if len(self.losses) <= self.plateau_window:
+            return False
+        best_before = min(self.losses[:-self.plateau_window])
+        return min(self.losses[-self.plateau_window:]) >= (1 - self.plateau_tol) * best_before
+
+    def step(self, loss):
+        """Records the loss of an iteration at the current level.
+        :return: True if the next level starts
+        """
+        if self.level == self.num_levels - 1:
+            return False
+        self.losses.append(loss)
+        if (self.level_iters is not None and len(self.losses) >= self.level_iters) or self.plateaued():
+            self.level += 1
+            self.losses = []
+            return True
+        return False
+
+
+def downsample_image(im, width, height):
+    """Area-averaged [height x width x C] version of an [H x W x C] image"""
+    if tuple(im.shape[:2]) == (height, width):
+        return im
+    im = F.interpolate(im.permute(2, 0, 1)[np.newaxis], size=(height, width), mode='area')
+    return im[0].permute(1, 2, 0)
+
+
+def resize_splat_params(x, size, new_size):
+    """Bilinear resampling of per-splat parameters to a new grid of splats.
+    :param x: [h * w] or [h * w x C] parameters of a grid of splats of size (w, h)
+    :param new_size: (new_w, new_h)
+    :return: [new_h * new_w] or [new_h * new_w x C] leaf tensor that requires grad
+    """
+    (w, h), (new_w, new_h) = size, new_size
+    channels = x.contiguous().view(h * w, -1).shape[1]
+    grid = x.detach().contiguous().view(1, h, w, channels).permute(0, 3, 1, 2)
+    grid = F.interpolate(grid, size=(new_h, new_w), mode='bilinear', align_corners=True)
+    x_new = grid.permute(0, 2, 3, 1).contiguous().view((new_h * new_w,) + tuple(x.shape[1:]))
+    return x_new.requires_grad_()
+
+
 def optimize_scene(input_scene, target_scene, out_dir, max_iter=100, lr=1e-3, print_interval=10,
-                   imsave_interval=10):
+                   imsave_interval=10, num_pixel_samples=None, checkpoint_tiles=False, visibility_tracker=None,
+                   schedule=None):
     """A demo function to check if the differentiable renderer can optimize.
     :param scene:
     :param out_dir:
+    :param num_pixel_samples: If given, the loss of each iteration is estimated on this many stratified
+                              random pixels, and only those are rendered
+    :param checkpoint_tiles: Recompute the ray-object intersections of every tile in the backward pass
+                             instead of storing them (see `render`)
+    :param visibility_tracker: Optional VisibilityTracker, the objects that stay invisible are not traced
+    :param schedule: Optional CoarseToFineSchedule, every iteration renders at the size of the current level
+                     and compares with the downsampled target
     :return:
     """
     if not os.path.exists(out_dir):
@@ -96,33 +180,58 @@ def optimize_scene(input_scene, target_scene, out_dir, max_iter=100, lr=1e-3, pr
     h0 = plt.figure()
     h1 = plt.figure()
     loss_per_iter = []
-    for iter in range(max_iter):
-        res = render(input_scene)
-        im_out = res['image']
-
-        optimizer.zero_grad()
-        loss = criterion(im_out, target_im)
-
-        im_out_ = get_data(im_out)
-        loss_ = get_data(loss)
-        loss_per_iter.append(loss_)
-
-        if iter == 0:
-            plt.figure(h0.number)
-            plt.imshow(im_out_)
-            plt.title('Initial')
-
-        if iter % print_interval == 0:
-            print('%d. loss= %f' % (iter, loss_))
-            print(input_scene['materials'])
-
-            plt.figure(h1.number)
-            plt.imshow(im_out_)
-            plt.title('%d. loss= %f' % (iter, loss_))
-            plt.savefig(out_dir + '/fig_%05d.png' % iter)
-
-        loss.backward()
-        optimizer.step()
+    H, W = target_im.shape[:2]
+    target = target_im
+    viewport = input_scene['camera']['viewport']
+    try:
+        for iter in range(max_iter):
+            if schedule is not None:
+                W, H = schedule.size()
+                input_scene['camera']['viewport'] = [0, 0, W, H]
+                target = downsample_image(target_im, W, H)
+            if num_pixel_samples is not None:
+                pixel_indices = stratified_pixel_sampler(H, W, num_pixel_samples)
+                im_out = render(input_scene, pixel_indices=pixel_indices, checkpoint_tiles=checkpoint_tiles,
+                                visibility_tracker=visibility_tracker)['image']
+                optimizer.zero_grad()
+                loss = criterion(im_out, target.contiguous().view(-1, 3)[pixel_indices])
+                if iter == 0 or iter % print_interval == 0:
+                    with torch.no_grad():
+                        im_out = render(input_scene)['image']
+            else:
+                res = render(input_scene, checkpoint_tiles=checkpoint_tiles, visibility_tracker=visibility_tracker)
+                im_out = res['image']
+
+                optimizer.zero_grad()
+                loss = criterion(im_out, target)
+
+            im_out_ = get_data(im_out)
+            loss_ = get_data(loss)
+            loss_per_iter.append(loss_)
+
+            if iter == 0:
+                plt.figure(h0.number)
+                plt.imshow(im_out_)
+                plt.title('Initial')
+
+            if iter % print_interval == 0:
+                print('%d. loss= %f' % (iter, loss_))
+                print(input_scene['materials'])
+
+                plt.figure(h1.number)
+                plt.imshow(im_out_)
+                plt.title('%d. loss= %f' % (iter, loss_))
+                plt.savefig(out_dir + '/fig_%05d.png' % iter)
+
+            loss.backward()
+            optimizer.step()
+            if visibility_tracker is not None:
+                visibility_tracker.step()
+            if schedule is not None and schedule.step(float(loss_)):
+                print('%d. level %d: %dx%d' % (iter, schedule.level, *schedule.size()))
+    finally:
+        # Leave the caller's scene at its own resolution, whichever level the schedule reached
+        input_scene['camera']['viewport'] = viewport
 
     plt.figure()
     plt.plot(loss_per_iter, linewidth=2)
@@ -623,6 +732,132 @@ def optimize_splats_along_ray_shadow_with_normalest_test(out_dir, width, height,
     plt.show()
 
 
+def optimize_splats_coarse_to_fine(width, height, schedule=None, max_iter=500, lr=1e-2, scale=10, eval_interval=10,
+                                   print_interval=50):
+    """Optimizes the depth and normals of splats rendered along ray (as in
+    optimize_splats_along_ray_shadow_with_normalest_test, without shadows) with a coarse-to-fine schedule.
+    When the level changes, the splat parameters are resampled to the new grid of splats and Adam restarts.
+    :param schedule: CoarseToFineSchedule, or None to optimize at full resolution from the first iteration
+    :param eval_interval: Every eval_interval iterations the splats are resampled to the grid of the last level,
+                          and the L1 loss of their image against the full resolution target is recorded.
+                          This evaluation is not included in the timings.
+    :return: List of (optimization time in seconds, iteration, full resolution L1 loss)
+    """
+    import copy
+    from diffrend.torch.params import SCENE_SPHERE_HALFBOX_0
+
+    if schedule is None:
+        schedule = CoarseToFineSchedule(width, height, num_levels=1)
+
+    scene = copy.deepcopy(SCENE_SPHERE_HALFBOX_0)
+    scene['camera']['viewport'] = [0, 0, width, height]
+    scene['camera']['fovy'] = np.deg2rad(45)
+    scene['camera']['focal_length'] = 1
+    scene['camera']['eye'] = tch_var_f([2, 1, 2, 1])
+    scene['camera']['at'] = tch_var_f([0, 0.8, 0, 1])
+    target_im = normalize_maxmin(render(scene, tiled=True)['image']).detach()
+
+    input_scene = copy.deepcopy(scene)
+    z_min = scene['camera']['focal_length']
+    z_max = 3
+    criterion = nn.L1Loss()
+
+    def splats(z, normal_angles):
+        phi = torch.sigmoid(normal_angles[:, 0]) * 2 * np.pi
+        theta = torch.sigmoid(normal_angles[:, 1]) * np.pi / 2
+        return {'disk': {'pos': -F.relu(-z) - z_min,
+                         'normal': sph2cart_unit(torch.stack((phi, theta), dim=1)),
+                         'material_idx': tch_var_l(np.ones(z.shape[0]) * 3)}}
+
+    grid = schedule.splat_grid()
+    num_splats = grid[0] * grid[1]
+    z = tch_var_f(-np.ones(num_splats) * (z_min + z_max) / 2)
+    z.requires_grad = True
+    normal_angles = tch_var_f(np.random.rand(num_splats, 2))
+    normal_angles.requires_grad = True
+    optimizer = optim.Adam([z, normal_angles], lr=lr)
+
+    last_level = schedule.num_levels - 1
+    full_grid = schedule.splat_grid(last_level)
+    elapsed = 0.
+    history = []
+    for iter in range(max_iter):
+        if iter % eval_interval == 0:
+            with torch.no_grad():
+                input_scene['camera']['viewport'] = [0, 0, *full_grid]
+                input_scene['objects'] = splats(resize_splat_params(z, grid, full_grid),
+                                                resize_splat_params(normal_angles, grid, full_grid))
+                res = render_splats_along_ray(input_scene, samples=schedule.samples[last_level])
+                im_out = downsample_image(normalize_maxmin(res['image']), width, height)
+                history.append((elapsed, iter, float(get_data(criterion(im_out, target_im)))))
+
+        start = time.time()
+        input_scene['camera']['viewport'] = [0, 0, *grid]
+        input_scene['objects'] = splats(z, normal_angles)
+        res = render_splats_along_ray(input_scene, samples=schedule.samples[schedule.level])
+        im_out = normalize_maxmin(res['image'])
+        target = downsample_image(target_im, im_out.shape[1], im_out.shape[0])
+        z_pos = res['pos'][..., 2]
+        z_loss = torch.mean((10 * F.relu(z_min - torch.abs(z_pos))) ** 2 +
+                            (10 * F.relu(torch.abs(z_pos) - z_max)) ** 2)
+        loss = criterion(scale * im_out, scale * target) + z_loss
+
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        loss_ = float(get_data(loss))
+        if schedule.step(loss_):
+            new_grid = schedule.splat_grid()
+            z = resize_splat_params(z, grid, new_grid)
+            normal_angles = resize_splat_params(normal_angles, grid, new_grid)
+            optimizer = optim.Adam([z, normal_angles], lr=lr)
+            grid = new_grid
+            print('%d. level %d: %dx%d, %d splats' % (iter, schedule.level, *schedule.size(), grid[0] * grid[1]))
+        elapsed += time.time() - start
+
+        if iter % print_interval == 0:
+            print('%d. loss= %f (%dx%d) time= %.2fs' % (iter, loss_, im_out.shape[1], im_out.shape[0], elapsed))
+
+    return history
+
+
+def compare_coarse_to_fine(out_dir, width, height, num_levels=3, samples=1, level_iters=None, max_iter=500, lr=1e-2,
+                           eval_interval=10, print_interval=50):
+    """Optimizes the same splats at full resolution (the baseline) and coarse-to-fine, and reports the optimization
+    time that each takes to reach the final loss of the baseline.
+    :param samples: Supersampling of the finest level, the coarser levels are not supersampled
+    """
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+
+    np.random.seed(0)
+    baseline = optimize_splats_coarse_to_fine(width, height, CoarseToFineSchedule(width, height, 1, [samples]),
+                                              max_iter=max_iter, lr=lr, eval_interval=eval_interval,
+                                              print_interval=print_interval)
+    np.random.seed(0)
+    schedule = CoarseToFineSchedule(width, height, num_levels, [1] * (num_levels - 1) + [samples], level_iters)
+    coarse_to_fine = optimize_splats_coarse_to_fine(width, height, schedule, max_iter=max_iter, lr=lr,
+                                                    eval_interval=eval_interval, print_interval=print_interval)
+
+    target_loss = baseline[-1][2]
+    time_to_loss = lambda history: next((t for t, _, loss in history if loss <= target_loss), None)
+    baseline_time = time_to_loss(baseline)
+    c2f_time = time_to_loss(coarse_to_fine)
+    print('Time to loss %f: full resolution %.2fs, coarse-to-fine %s' %
+          (target_loss, baseline_time, 'not reached' if c2f_time is None else
+           '%.2fs (%.1fx)' % (c2f_time, baseline_time / max(c2f_time, 1e-6))))
+
+    plt.figure()
+    for history, label in [(baseline, 'Full resolution'), (coarse_to_fine, 'Coarse-to-fine')]:
+        plt.plot([t for t, _, _ in history], [loss for _, _, loss in history], linewidth=2, label=label)
+    plt.xlabel('Optimization time (s)', fontsize=14)
+    plt.title('Full resolution L1 loss', fontsize=12)
+    plt.legend()
+    plt.grid(True)
+    plt.savefig(out_dir + '/coarse_to_fine_loss.png')
+    return baseline, coarse_to_fine
+
+
 def test_scalability(filename, out_dir='./test_scale'):
     # GTX 980 8GB
     # 320 x 240 250 objs
@@ -688,6 +923,18 @@ if __name__ == '__main__':
     parser.add_argument('--xyz-save-interval', type=int, default=200, help='XYZ save interval.')
     parser.add_argument('--width', type=int, default=64)
     parser.add_argument('--height', type=int, default=64)
+    parser.add_argument('--pixel-samples', type=int, help='Number of stratified random pixels per iteration '
+                                                          '(renders the full image if not given).')
+    parser.add_argument('--checkpoint-tiles', action='store_true', help='Recompute the ray-object intersections of '
+                                                                        'every tile in the backward pass.')
+    parser.add_argument('--prune-invisible', type=int, nargs=2, metavar=('MAX_INVISIBLE', 'RETEST_INTERVAL'),
+                        help='Stop tracing the objects that cover no pixel for MAX_INVISIBLE iterations, '
+                             'except every RETEST_INTERVAL iterations.')
+    parser.add_argument('--c2f-levels', type=int, help='Optimize coarse-to-fine with this many resolution levels.')
+    parser.add_argument('--c2f-level-iters', type=int, help='Iterations per coarse-to-fine level (by default the '
+                                                            'next level starts when the loss plateaus).')
+    parser.add_argument('--opt-c2f-test', action='store_true', help='Compare the time to a loss of the full '
+                                                                    'resolution and coarse-to-fine optimizations.')
 
     args = parser.parse_args()
     print(args)
@@ -711,7 +958,12 @@ if __name__ == '__main__':
             [0.9, 0.1, 0.1],
         ])
         optimize_scene(input_scene, scene, args.out_dir, max_iter=args.max_iter, lr=args.lr,
-                       print_interval=args.print_interval)
+                       print_interval=args.print_interval, num_pixel_samples=args.pixel_samples,
+                       checkpoint_tiles=args.checkpoint_tiles,
+                       visibility_tracker=VisibilityTracker(*args.prune_invisible) if args.prune_invisible else None,
+                       schedule=CoarseToFineSchedule(scene['camera']['viewport'][2], scene['camera']['viewport'][3],
+                                                     args.c2f_levels, level_iters=args.c2f_level_iters)
+                       if args.c2f_levels else None)
     if args.test_scale:
         test_scalability(filename=args.model_filename, out_dir=args.out_dir)
 
@@ -728,3 +980,9 @@ if __name__ == '__main__':
                                                              print_interval=args.print_interval,
                                                              imsave_interval = args.imsave_interval,
                                                              xyz_save_interval = args.xyz_save_interval)
+
+    if args.opt_c2f_test:
+        compare_coarse_to_fine(out_dir=args.out_dir, width=args.width, height=args.height,
+                               num_levels=args.c2f_levels or 3, samples=args.samples,
+                               level_iters=args.c2f_level_iters, max_iter=args.max_iter, lr=args.lr,
+                               print_interval=args.print_interval)
@@ -0,0 +1,468 @@
+"""Temporal reprojection for rendering camera trajectories.
+
+Consecutive frames of a trajectory see mostly the same surfaces, so instead of tracing every ray
+of every frame, the G-buffer of the previous frame is warped into the new view and only the
+disoccluded or invalid pixels are re-traced. Shading is always redone for the whole frame, so
+view-dependent terms stay correct.
+"""
+from time import time
+import numpy as np
+import torch
+from diffrend.torch.utils import (generate_rays, normalize, get_data, screen_size, world_to_cam, select_objects,
+                                  ray_object_distances)
+from diffrend.torch.renderer import render, shade, nearest_fragments, object_edges
+from diffrend.torch.projection_layer import project_image_coordinates, projection_reverse_renderer
+from diffrend.torch.bvh import object_bounds
+from diffrend.torch.render import make_torch_var
+from diffrend.utils.utils import get_param_value
+
+
+def load_camera_trajectory(filename):
+    """Loads a camera trajectory, i.e., a json list of camera dictionaries
+    (see tools/scenenet/generate_camera_trajectory.py).
+    """
+    import json
+    with open(filename, 'r') as fid:
+        cameras = json.load(fid)
+    return [make_torch_var(camera) for camera in cameras]
+
+
+def batch_camera(camera):
+    """Adds the batch dimension expected by the projection layer to a single camera."""
+    camera = dict(camera)
+    for key in ['eye', 'at', 'up']:
+        camera[key] = camera[key][np.newaxis, ...]
+    return camera
+
+
+def forward_warp_indices(pos, valid, camera):
+    """For every pixel of `camera`, find the nearest previous-frame fragment that projects into it.
+
+    :param pos: [N, 3] world positions of the previous frame's fragments
+    :param valid: [N] boolean mask of the fragments that hit an object
+    :param camera: New camera
+    :return: ([H*W] source pixel index per target pixel, -1 if nothing projects there,
+              [H*W] depth of the warped fragment in the new view)
+    """
+    viewport = get_data(camera['viewport'])
+    W = int(viewport[2] - viewport[0])
+    H = int(viewport[3] - viewport[1])
+    num_pixels = H * W
+    px_idx, px_coord = project_image_coordinates(pos[np.newaxis, ...], batch_camera(camera))
+    px_idx = px_idx[0].long()
+    z = px_coord[0, :, 2]
+    # Out of view, behind the camera or background fragments go to the dump index num_pixels
+    px_idx = torch.where(valid & (z > 0), px_idx, torch.full_like(px_idx, num_pixels))
+
+    # z-buffer: keep the closest fragment per target pixel
+    z_min = torch.full((num_pixels + 1,), float('inf'), device=z.device)
+    z_min = z_min.scatter_reduce(0, px_idx, z.detach(), reduce='amin')
+    winner = (z.detach() <= z_min[px_idx]) & (px_idx < num_pixels)
+    src_idx = torch.full((num_pixels + 1,), -1, dtype=torch.long, device=z.device)
+    src_idx[px_idx[winner]] = torch.nonzero(winner).view(-1)
+    return src_idx[:num_pixels], z_min[:num_pixels]
+
+
+def fill_warp_holes(src_idx, z, H, W, iterations):
+    """Give every hole of the forward warp the fragment of its nearest (smallest warped depth) neighbor in a
+    3 x 3 window, `iterations` times. Surfaces that are magnified in the new view leave holes between their
+    warped fragments; the filled pixels are only candidates, which the inside and occluder tests validate.
+    :return: source pixel index and warped depth per target pixel, as forward_warp_indices
+    """
+    for _ in range(iterations):
+        hole = src_idx < 0
+        neg_z, argmax = torch.nn.functional.max_pool2d(-z.view(1, 1, H, W), 3, stride=1, padding=1,
+                                                       return_indices=True)
+        neighbor = argmax.view(-1)
+        filled = hole & (src_idx[neighbor] >= 0)
+        src_idx = torch.where(filled, src_idx[neighbor], src_idx)
+        z = torch.where(filled, -neg_z.view(-1), z)
+    return src_idx, z
+
+
+def primitive_fragments(nearest, scene_objects, obj_type, invalid):
+    """Find the valid pixels whose warped fragment lies on an object of `obj_type`.
+    :return: ([N] mask of those pixels, [N] index of their object within scene_objects[obj_type], 0 elsewhere),
+             or (None, None) if the scene has no such objects
+    """
+    offset = 0
+    for curr_type in scene_objects:
+        if curr_type == obj_type:
+            break
+        offset += scene_objects[curr_type]['material_idx'].shape[0]
+    else:
+        return None, None
+    obj_idx = nearest - offset
+    on_type = ~invalid & (obj_idx >= 0) & (obj_idx < scene_objects[obj_type]['material_idx'].shape[0])
+    return on_type, torch.where(on_type, obj_idx, torch.zeros_like(obj_idx))
+
+
+def clip_planar_fragments(gbuffer, scene_objects, invalid):
+    """Invalidate the pixels whose new ray crosses the plane of their warped triangle or disk outside of it,
+    with the same inside tests as ray_triangle_intersection and ray_disk_intersection.
+    """
+    pos = gbuffer['pos'][0]
+    on_triangle, triangle_idx = primitive_fragments(gbuffer['nearest'], scene_objects, 'triangle', invalid)
+    if on_triangle is not None:
+        triangles = scene_objects['triangle']
+        face = torch.index_select(triangles['face'][:, :, :3], 0, triangle_idx)
+        normal = torch.index_select(normalize(triangles['normal'][:, :3]), 0, triangle_idx)
+        inside = torch.ones_like(on_triangle)
+        for idx in range(3):
+            edge = face[:, (idx + 1) % 3] - face[:, idx]
+            inside = inside & (torch.sum(torch.cross(edge, pos - face[:, idx], dim=-1) * normal, dim=-1) >= 0)
+        invalid = invalid | (on_triangle & ~inside)
+
+    on_disk, disk_idx = primitive_fragments(gbuffer['nearest'], scene_objects, 'disk', invalid)
+    if on_disk is not None:
+        center = torch.index_select(scene_objects['disk']['pos'][:, :3], 0, disk_idx)
+        radius = torch.index_select(scene_objects['disk']['radius'], 0, disk_idx)
+        inside = torch.sum((pos - center) ** 2, dim=-1) <= radius ** 2
+        invalid = invalid | (on_disk & ~inside)
+    return invalid
+
+
+def refine_sphere_fragments(gbuffer, scene_objects, ray_orig, ray_dir, invalid):
+    """Replace the tangent-plane approximation by the exact intersection for the pixels whose
+    warped fragment lies on a sphere.
+    """
+    on_sphere, sphere_idx = primitive_fragments(gbuffer['nearest'], scene_objects, 'sphere', invalid)
+    if on_sphere is None:
+        return gbuffer, invalid
+    spheres = scene_objects['sphere']
+    center = torch.index_select(spheres['pos'][:, :3], 0, sphere_idx)
+    radius = torch.index_select(spheres['radius'], 0, sphere_idx)
+    ray_dir = ray_dir.transpose(1, 0)
+    pos_tilde = ray_orig - center
+    b = torch.sum(pos_tilde * ray_dir, dim=-1)
+    d_sqr = b ** 2 - torch.sum(pos_tilde ** 2, dim=-1) + radius ** 2
+    d = torch.sqrt(torch.clamp(d_sqr, min=0))
+    # Nearest positive root
+    depth = torch.where(-b - d >= 0, -b - d, -b + d)
+    hit = (d_sqr >= 0) & (depth >= 0)
+    invalid = invalid | (on_sphere & ~hit)
+    on_sphere = on_sphere & hit
+
+    pos = ray_orig + depth[:, np.newaxis] * ray_dir
+    gbuffer = dict(gbuffer)
+    gbuffer['pos'] = torch.where(on_sphere[np.newaxis, :, np.newaxis], pos[np.newaxis], gbuffer['pos'])
+    gbuffer['normal'] = torch.where(on_sphere[np.newaxis, :, np.newaxis], normalize(pos - center)[np.newaxis],
+                                    gbuffer['normal'])
+    gbuffer['depth'] = torch.where(on_sphere, depth, gbuffer['depth'].view(-1)).view(gbuffer['depth'].shape)
+    return gbuffer, invalid
+
+
+def potential_occluders(gbuffer, scene_objects):
+    """Objects that may appear in front of a reused fragment: the ones that no pixel of the previous frame saw,
+    and the ones that are not entirely within the previous view frustum (part of them was never seen).
+    :return: [K] sorted object indices
+    """
+    camera = gbuffer['camera']
+    bounds = object_bounds(scene_objects)
+    num_objects = bounds.shape[0]
+    visible = torch.zeros(num_objects, dtype=torch.bool, device=bounds.device)
+    hit = gbuffer['depth'].view(-1) <= camera['far']
+    visible[gbuffer['nearest'].view(-1)[hit]] = True
+
+    # The 8 corners of every box, in the previous camera's coordinates
+    corners = torch.stack([torch.stack((bounds[:, i, 0], bounds[:, j, 1], bounds[:, k, 2]), dim=-1)
+                           for i in range(2) for j in range(2) for k in range(2)], dim=1)
+    corners = world_to_cam(corners.view(-1, 3), None, camera)['pos'][:, :3].view(num_objects, 8, 3)
+    w, h = screen_size(camera)
+    if camera['proj_type'] in ['ortho', 'orthographic']:
+        scale = torch.ones_like(corners[..., 2])
+    else:
+        scale = -corners[..., 2] / float(get_data(camera['focal_length']))
+    inside = ((-corners[..., 2] >= camera['near']) & (-corners[..., 2] <= camera['far']) &
+              (torch.abs(corners[..., 0]) <= scale * w / 2) & (torch.abs(corners[..., 1]) <= scale * h / 2))
+    return torch.nonzero(~(visible & torch.all(inside, dim=1))).view(-1)
+
+
+def screen_rects(bounds, camera, H, W):
+    """Conservative screen-space rectangles of boxes, as in screen_footprint.
+    :param bounds: [K x 2 x 3] boxes
+    :return: ([K x 4] (first column, last column, first row, last row), [K] lower bound of the distance along
+             any ray to a point of the box). Boxes that cross the camera plane or are unbounded cover the screen.
+    """
+    num_boxes = bounds.shape[0]
+    corners = torch.stack([torch.stack((bounds[:, i, 0], bounds[:, j, 1], bounds[:, k, 2]), dim=-1)
+                           for i in range(2) for j in range(2) for k in range(2)], dim=1)
+    finite = torch.all(torch.isfinite(corners.view(num_boxes, -1)), dim=1)
+    corners = torch.where(finite[:, np.newaxis, np.newaxis], corners, torch.zeros_like(corners))
+    corners = world_to_cam(corners.view(-1, 3), None, camera)['pos'][:, :3].view(num_boxes, 8, 3)
+    w, h = screen_size(camera)
+    z = -corners[..., 2]
+    if camera['proj_type'] in ['ortho', 'orthographic']:
+        x, y = corners[..., 0], corners[..., 1]
+        in_front = finite
+    else:
+        in_front = finite & torch.all(z > 1e-6, dim=1)
+        focal_length = float(get_data(camera['focal_length']))
+        z_safe = torch.where(z > 1e-6, z, torch.ones_like(z))
+        x, y = focal_length * corners[..., 0] / z_safe, focal_length * corners[..., 1] / z_safe
+    # Inverse of the pixel grid in generate_rays, one pixel larger on every side
+    col = (x / (w / 2) + 1) / 2 * (W - 1)
+    row = (1 - y / (h / 2)) / 2 * (H - 1)
+    rects = torch.stack((torch.floor(torch.min(col, dim=1)[0]) - 1, torch.ceil(torch.max(col, dim=1)[0]) + 1,
+                         torch.floor(torch.min(row, dim=1)[0]) - 1, torch.ceil(torch.max(row, dim=1)[0]) + 1), dim=1)
+    full_screen = torch.tensor([0, W - 1, 0, H - 1], dtype=rects.dtype, device=rects.device)
+    rects = torch.where(in_front[:, np.newaxis], rects, full_screen)
+    # The distance along a ray is at least the distance along the optical axis
+    min_dist = torch.where(in_front, torch.min(z, dim=1)[0], torch.full_like(z[:, 0], -float('inf')))
+    return rects, min_dist
+
+
+def occluded_fragments(depth, scene_objects, occluders, camera, ray_orig, ray_dir, invalid, block_size=16,
+                       rel_epsilon=1e-4):
+    """Invalidate the reused pixels whose new ray hits one of the `occluders` in front of their fragment.
+    The reused pixels are grouped into `block_size` x `block_size` screen tiles, and every tile is only
+    intersected with the occluders whose screen rectangle overlaps it and which are not behind all of its
+    fragments (see screen_rects).
+    """
+    pixel_idx = torch.nonzero(~invalid).view(-1)
+    if pixel_idx.numel() == 0 or occluders.numel() == 0:
+        return invalid
+    H, W = depth.shape
+    occluder_objects = select_objects(scene_objects, occluders)
+    rects, min_dist = screen_rects(object_bounds(occluder_objects), camera, H, W)
+
+    # Reused pixels sorted by tile
+    blocks_x = (W + block_size - 1) // block_size
+    rows, cols = pixel_idx // W, pixel_idx % W
+    block = (rows // block_size) * blocks_x + cols // block_size
+    block, order = torch.sort(block, stable=True)
+    pixel_idx = pixel_idx[order]
+    blocks, counts = torch.unique_consecutive(block, return_counts=True)
+    pixel_depth = torch.index_select(depth.view(-1), 0, pixel_idx)
+    _, block_of_pixel = torch.unique_consecutive(block, return_inverse=True)
+    max_depth = torch.zeros(blocks.shape[0], dtype=pixel_depth.dtype, device=depth.device).scatter_reduce(
+        0, block_of_pixel, pixel_depth, 'amax', include_self=False)
+
+    # [K x B] occluders that may hide a fragment of the tile
+    r0 = (blocks // blocks_x) * block_size
+    c0 = (blocks % blocks_x) * block_size
+    overlap = ((rects[:, 0:1] <= (c0 + block_size - 1)) & (rects[:, 1:2] >= c0) &
+               (rects[:, 2:3] <= (r0 + block_size - 1)) & (rects[:, 3:4] >= r0) &
+               (min_dist[:, np.newaxis] < max_depth[np.newaxis, :]))
+    tile_occluders = [torch.nonzero(has_occluders).view(-1) for has_occluders in overlap.t()]
+
+    occluded = []
+    for tile_idx, obj_idx in zip(torch.split(pixel_idx, counts.tolist()), tile_occluders):
+        if obj_idx.numel() == 0:
+            continue
+        tile_orig = torch.index_select(ray_orig, 0, tile_idx) if ray_orig.shape[0] > 1 else ray_orig
+        ray_dist = ray_object_distances(tile_orig, torch.index_select(ray_dir, 1, tile_idx),
+                                        select_objects(occluder_objects, obj_idx))[0]
+        ray_dist = torch.where((camera['near'] <= ray_dist) & (ray_dist <= camera['far']), ray_dist,
+                               torch.full_like(ray_dist, float('inf')))
+        tile_depth = torch.index_select(depth.view(-1), 0, tile_idx)
+        occluded.append(tile_idx[torch.min(ray_dist, dim=0)[0] < tile_depth * (1 - rel_epsilon)])
+    if not occluded:
+        return invalid
+    return invalid.index_fill(0, torch.cat(occluded), True)
+
+
+def reproject_gbuffer(gbuffer, image, camera, scene_objects, ray_orig, ray_dir, depth_epsilon=1e-1,
+                      edge_width=1, block_size=16, hole_fill=2):
+    """Warp the G-buffer of the previous frame into the view of `camera`.
+
+    Target pixels receive the nearest previous fragment that projects into them (the holes between the
+    fragments of magnified surfaces take the fragment of a neighbor, see fill_warp_holes), and the fragment
+    is moved to where the new ray crosses its tangent plane (exact for planar primitives), or
+    re-intersected with its sphere. A pixel is invalid, i.e., has to be re-traced, if no fragment
+    lands on it, if it fails the depth-epsilon test of `projection_reverse_renderer` (the surface
+    was occluded in the previous view), if the new ray misses the triangle, disk or sphere of the
+    fragment, if the new ray hits an object that the previous frame did not fully see in front of
+    the fragment (see potential_occluders, tested per `block_size` x `block_size` tile of pixels), or if
+    it lies within `edge_width` pixels of an object boundary, where sub-pixel shifts and surfaces seen
+    edge-on change the visible object.
+    :param gbuffer: G-buffer of the previous frame (see render)
+    :param image: [H, W, 3] previous frame, used for the visibility test
+    :param camera: New camera
+    :param scene_objects: Scene geometry
+    :param ray_orig: [1 x 3] or [N x 3] ray origins of the new camera
+    :param ray_dir: [3 x N] ray directions of the new camera
+    :return: (warped G-buffer in the new view, [H*W] boolean mask of the pixels to re-trace)
+    """
+    prev_camera = gbuffer['camera']
+    H, W = gbuffer['depth'].shape
+    pos = gbuffer['pos'].view(-1, 3)
+    valid = (prev_camera['near'] <= gbuffer['depth'].view(-1)) & (gbuffer['depth'].view(-1) <= prev_camera['far'])
+    src_idx, warp_depth = forward_warp_indices(pos, valid, camera)
+    src_idx, _ = fill_warp_holes(src_idx, warp_depth, H, W, hole_fill)
+    hole = src_idx < 0
+    src_idx = torch.where(hole, torch.zeros_like(src_idx), src_idx)
+
+    warped_pos = torch.index_select(pos, 0, src_idx)
+    _, proj_out = projection_reverse_renderer(image[np.newaxis, ...], pos[np.newaxis, ...],
+                                              warped_pos[np.newaxis, ...],
+                                              batch_camera(prev_camera), batch_camera(camera),
+                                              depth_epsilon=depth_epsilon)
+    invalid = hole | (proj_out['mask'].view(-1) < 0.5)
+    nearest = torch.index_select(gbuffer['nearest'].view(-1), 0, src_idx)
+    if edge_width > 0:
+        invalid = invalid | object_edges(torch.where(invalid, torch.full_like(nearest, -1), nearest).view(H, W),
+                                         edge_width).view(-1)
+
+    # Intersect the new rays with the tangent plane of the warped fragments
+    normal = torch.index_select(gbuffer['normal'].view(-1, 3), 0, src_idx)
+    ray_dir_n = ray_dir.transpose(1, 0)
+    cos_theta = torch.sum(ray_dir_n * normal, dim=-1)
+    invalid = invalid | (torch.abs(cos_theta) < 1e-6)
+    cos_theta = torch.where(invalid, torch.ones_like(cos_theta), cos_theta)
+    depth = torch.sum((warped_pos - ray_orig) * normal, dim=-1) / cos_theta
+    depth = torch.where(invalid, torch.full_like(depth, float(get_data(camera['far'])) + 1), depth)
+    warped = dict(gbuffer)
+    warped.update({'pos': (ray_orig + depth[:, np.newaxis] * ray_dir_n)[np.newaxis, ...],
+                   'normal': normal[np.newaxis, ...],
+                   'material_idx': torch.index_select(gbuffer['material_idx'], 0, src_idx),
+                   'nearest': nearest,
+                   'depth': depth.view(H, W),
+                   'camera': camera,
+                   })
+    invalid = clip_planar_fragments(warped, scene_objects, invalid)
+    warped, invalid = refine_sphere_fragments(warped, scene_objects, ray_orig, ray_dir, invalid)
+    invalid = occluded_fragments(warped['depth'], scene_objects, potential_occluders(gbuffer, scene_objects), camera,
+                                 ray_orig, ray_dir, invalid, block_size)
+    return warped, invalid
+
+
+def retrace_pixels(gbuffer, scene_objects, ray_orig, ray_dir, pixel_idx, tile_size):
+    """Trace the rays of `pixel_idx` and write the nearest fragments into the G-buffer."""
+    H, W = gbuffer['depth'].shape
+    if ray_orig.shape[0] > 1:
+        ray_orig = torch.index_select(ray_orig, 0, pixel_idx)
+    frags = nearest_fragments(ray_orig, torch.index_select(ray_dir, 1, pixel_idx), scene_objects,
+                              gbuffer['camera'], tile_size)
+    gbuffer = dict(gbuffer)
+    gbuffer['pos'] = gbuffer['pos'].index_copy(1, pixel_idx, frags['pos'])
+    gbuffer['normal'] = gbuffer['normal'].index_copy(1, pixel_idx, frags['normal'])
+    gbuffer['material_idx'] = gbuffer['material_idx'].index_copy(0, pixel_idx, frags['material_idx'])
+    gbuffer['nearest'] = gbuffer['nearest'].index_copy(0, pixel_idx, frags['nearest'])
+    gbuffer['depth'] = gbuffer['depth'].view(-1).index_copy(0, pixel_idx, frags['depth']).view(H, W)
+    return gbuffer
+
+
+def render_trajectory(scene, cameras, **params):
+    """Render the scene from each camera of a trajectory using temporal reprojection.
+
+    The first frame (and every `refresh_interval` frames if given) is fully rendered with `render`.
+    For the other frames the previous G-buffer is warped into the new view (see reproject_gbuffer)
+    and only the invalid pixels are re-traced before shading, unless less than params['min_reuse']
+    (a fraction of the pixels, 0.1 by default) could be reused, in which case the frame is fully rendered.
+    Not supported with `static_objects`, `instances` or `backface_culling`, since the reprojection and the
+    re-traced rays skip those code paths.
+    :param scene: Scene description. scene['camera'] is ignored.
+    :param cameras: List of cameras
+    :return: Generator of (render output, percentage of rays saved) per frame
+    """
+    if 'static_objects' in scene or 'instances' in scene or get_param_value('backface_culling', params, False):
+        raise ValueError('render_trajectory is not supported with static_objects, instances or backface_culling')
+    depth_epsilon = get_param_value('depth_epsilon', params, 1e-1)
+    refresh_interval = get_param_value('refresh_interval', params, None)
+    edge_width = get_param_value('edge_width', params, 1)
+    hole_fill = get_param_value('hole_fill', params, 2)
+    block_size = get_param_value('block_size', params, 16)
+    min_reuse = get_param_value('min_reuse', params, 0.1)
+    tile_size = get_param_value('tile_size', params, 4096)
+    scene = dict(scene)
+    params = dict(params, return_gbuffer=True)
+    gbuffer = None
+    image = None
+    for frame, camera in enumerate(cameras):
+        if gbuffer is None or (refresh_interval is not None and frame % refresh_interval == 0):
+            scene['camera'] = camera
+            res = render(scene, **params)
+            rays_saved = 0.
+        else:
+            ray_orig, ray_dir, _, _ = generate_rays(camera)
+            gbuffer, invalid = reproject_gbuffer(gbuffer, image, camera, scene['objects'], ray_orig, ray_dir,
+                                                 depth_epsilon=depth_epsilon, edge_width=edge_width,
+                                                 block_size=block_size, hole_fill=hole_fill)
+            pixel_idx = torch.nonzero(invalid).view(-1)
+            rays_saved = 100. * (1. - pixel_idx.numel() / float(invalid.numel()))
+            if rays_saved < 100. * min_reuse:
+                # Re-tracing most of the frame costs as much as a full render
+                scene['camera'] = camera
+                res = render(scene, **params)
+                rays_saved = 0.
+            else:
+                if pixel_idx.numel() > 0:
+                    gbuffer = retrace_pixels(gbuffer, scene['objects'], ray_orig, ray_dir, pixel_idx, tile_size)
+                res = shade(gbuffer, scene['lights'], scene['materials'], **params)
+                res['gbuffer'] = gbuffer
+        gbuffer = res['gbuffer']
+        image = res['image']
+        yield res, rays_saved
+
+
+def test_trajectory_consistency(scene, num_frames=4, angle_step=0.05, cameras=None):
+    """The reprojected frames must match full renders pixel by pixel along an orbit around
+    scene['camera']['at'] (or along the given cameras, e.g., from load_camera_trajectory).
+    Prints the rays saved and the time of every frame next to the time of the full render.
+    """
+    import copy
+    from diffrend.torch.projection_layer import rotate_cameras
+    if cameras is None:
+        cameras = []
+        for idx in range(num_frames):
+            camera = copy.deepcopy(scene['camera'])
+            batched = batch_camera(camera)
+            rotate_cameras(batched, phi=idx * angle_step)
+            camera['eye'] = batched['eye'][0]
+            cameras.append(camera)
+
+    frames = render_trajectory(scene, cameras)
+    for frame, camera in enumerate(cameras):
+        start_time = time()
+        res, rays_saved = next(frames)
+        frame_time = time() - start_time
+        start_time = time()
+        ref = render(dict(scene, camera=camera))
+        ref_time = time() - start_time
+        np.testing.assert_array_equal(get_data(res['nearest']).reshape(-1), get_data(ref['nearest']).reshape(-1))
+        np.testing.assert_allclose(get_data(res['depth']), get_data(ref['depth']), rtol=1e-5)
+        np.testing.assert_allclose(get_data(res['image']), get_data(ref['image']), atol=1e-5)
+        print('Frame {}: {:.1f}% rays saved, {:.2f} s (full render {:.2f} s)'.format(frame, rays_saved, frame_time,
+                                                                                 ref_time))
+
+
+def main():
+    import argparse
+    import os
+    from imageio import imsave
+    from diffrend.torch.render import load_scene
+
+    parser = argparse.ArgumentParser(usage="trajectory_renderer.py --scene scene_filename --trajectory "
+                                           "trajectory_filename --out_dir output_dir")
+    parser.add_argument('--scene', type=str, default='../../scenes/halfbox_sphere_cube.json', help='Path to the scene file')
+    parser.add_argument('--trajectory', type=str, default='../../scenes/camera_trajectory.json',
+                        help='Path to the camera trajectory file')
+    parser.add_argument('--out_dir', type=str, default='./trajectory_samples/', help='Directory for rendered images.')
+    parser.add_argument('--depth_epsilon', type=float, default=1e-1, help='Depth tolerance of the reprojection.')
+    parser.add_argument('--refresh_interval', type=int, default=None, help='Fully render every N frames.')
+    parser.add_argument('--edge_width', type=int, default=1, help='Re-trace pixels this close to object boundaries.')
+    parser.add_argument('--hole_fill', type=int, default=2, help='Fill the holes of the warp from their neighbors.')
+    parser.add_argument('--min_reuse', type=float, default=0.1,
+                        help='Fully render the frames where a smaller fraction of the pixels can be reused.')
+    args = parser.parse_args()
+    print(args)
+
+    scene = make_torch_var(load_scene(args.scene))
+    cameras = load_camera_trajectory(args.trajectory)
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+
+    frames = render_trajectory(scene, cameras, depth_epsilon=args.depth_epsilon,
+                               refresh_interval=args.refresh_interval, edge_width=args.edge_width,
+                               hole_fill=args.hole_fill, min_reuse=args.min_reuse)
+    for frame in range(len(cameras)):
+        start_time = time()
+        res, rays_saved = next(frames)
+        print('Frame {}: {:.1f}% rays saved, {:.2f} s'.format(frame, rays_saved, time() - start_time))
+        img = np.uint8(255 * np.clip(get_data(res['image']), 0, 1))
+        imsave(os.path.join(args.out_dir, 'im_{:05d}.png'.format(frame)), img)
+
+
+if __name__ == '__main__':
+    main()
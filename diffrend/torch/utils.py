@@ -1,3 +1,4 @@
+from contextlib import contextmanager
 import numpy as np
 import torch
 from torch.autograd import Variable
@@ -32,6 +33,58 @@ def np_var(x, req_grad=False):
 # np_var_f = lambda x: np_var(x, FloatTensor, False)
 # np_var_l = lambda x: np_var(x, LongTensor, False)
 
+# Strict "no host sync" mode: the hot paths skip their host-side checks and
+# conversions so that a whole render or training step stays on the device
+STRICT_NO_SYNC = False
+
+
+@contextmanager
+def no_host_sync():
+    """Enable the strict no host sync mode inside the block."""
+    global STRICT_NO_SYNC
+    prev, STRICT_NO_SYNC = STRICT_NO_SYNC, True
+    try:
+        yield
+    finally:
+        STRICT_NO_SYNC = prev
+
+
+class HostSyncError(RuntimeError):
+    pass
+
+
+# Tensor methods that copy data to the host
+HOST_SYNC_METHODS = ['numpy', 'item', 'tolist', 'nonzero', '__bool__', '__int__', '__float__']
+
+
+@contextmanager
+def trap_host_sync():
+    """Raise HostSyncError on any device to host synchronization in the block.
+    On CUDA this uses torch.cuda.set_sync_debug_mode('error'). Since nothing synchronizes on the CPU,
+    the tensor to host conversions (HOST_SYNC_METHODS and torch.nonzero) raise instead, so that the
+    same code paths can be tested without a GPU. These are patched process-wide while the block runs
+    (i.e., in all threads) and are restored on exit, even if the block raises.
+    """
+    def trap(name):
+        def fn(*args, **kwargs):
+            raise HostSyncError('Host synchronization in a guarded region: ' + name)
+        return fn
+
+    saved = [(torch.Tensor, name, getattr(torch.Tensor, name)) for name in HOST_SYNC_METHODS]
+    saved.append((torch, 'nonzero', torch.nonzero))
+    prev_mode = torch.cuda.get_sync_debug_mode() if CUDA else None
+    try:
+        if CUDA:
+            torch.cuda.set_sync_debug_mode('error')
+        for obj, name, _ in saved:
+            setattr(obj, name, trap(name))
+        yield
+    finally:
+        for obj, name, fn in saved:
+            setattr(obj, name, fn)
+        if CUDA:
+            torch.cuda.set_sync_debug_mode(prev_mode)
+
 
 def get_data(x):
     if type(x) is np.ndarray or \
@@ -161,21 +214,39 @@ def scatter_mean_dim0(x, idx):
     """
     new_shape = (x.size(0), x.size(1) + 1, x.size(2))
 
-    x_padding = tch_var_f(np.zeros((x.size(0), 1, x.size(2))))
+    x_padding = torch.zeros(x.size(0), 1, x.size(2), device=x.device, dtype=x.dtype)
     x = torch.cat((x, x_padding), -2)
 
     # Fill the index with the max index which will be thrown out after
-    idx_padding = tch_var_l(np.full((*idx.size()[:-1], 1), idx.size(-1)))
+    idx_padding = torch.full((*idx.size()[:-1], 1), idx.size(-1), device=idx.device, dtype=idx.dtype)
     idx = torch.cat((idx, idx_padding), -1)
     idx = idx.unsqueeze(-1).repeat(1, 1, x.size(-1))
 
-    freq = tch_var_f(np.zeros(new_shape)).scatter_add_(-2, idx.long(), torch.ones_like(x))
-    out = tch_var_f(np.zeros(new_shape)).scatter_add_(-2, idx.long(), x)
+    freq = torch.zeros(*new_shape, device=x.device, dtype=x.dtype).scatter_add_(-2, idx.long(), torch.ones_like(x))
+    out = torch.zeros(*new_shape, device=x.device, dtype=x.dtype).scatter_add_(-2, idx.long(), x)
     mask = freq == 0
     return nonzero_divide(out, freq)[...,:-1,:], mask[...,:-1,:]
 
 
-def scatter_weighted_blended_oit(x, z, center_dist_2, idx, sigma=0.5, z_scale=2, use_depth=True, use_center_dist=True):
+def segmented_topk_mask(idx, z, k):
+    """
+    Mask of the `k` elements with the smallest `z` among the elements with the same `idx` (e.g., the k nearest
+    surfels of every pixel). The elements are sorted by (idx, z) and ranked within their segment.
+
+    :param idx: [batch_size, n] segment (destination index) of every element
+    :param z: [batch_size, n] sort key
+    :param k: number of elements to keep per segment
+    :return: [batch_size, n] boolean mask
+    """
+    order = torch.argsort(z.detach(), dim=-1, stable=True)
+    order = order.gather(-1, torch.argsort(idx.gather(-1, order), dim=-1, stable=True))
+    sorted_idx = idx.gather(-1, order).contiguous()
+    # Position of every element relative to the start of its segment
+    rank = torch.arange(idx.size(-1), device=idx.device) - torch.searchsorted(sorted_idx, sorted_idx)
+    return torch.zeros_like(idx, dtype=torch.bool).scatter(-1, order, rank < k)
+
+
+def scatter_weighted_blended_oit(x, z, center_dist_2, idx, sigma=0.5, z_scale=2, use_depth=True, use_center_dist=True, top_k=None):
     """
     Similarly to `scatter_mean_dim0`, scatter elements in `x` to their destination `idx`.
     The difference is when more than one element maps to the same destination. Instead
@@ -190,7 +261,10 @@ def scatter_weighted_blended_oit(x, z, center_dist_2, idx, sigma=0.5, z_scale=2,
     :param z_scale: extinction coefficient for the Beer-Lambert law used to evaluate a weight based on depth (~= importance given to the depth)
     :param use_depth: whether to use depth `z` to weight the surfels `x`
     :param use_center_dist: whether to use the distance to the nearest pixel center (`center_dist_2`) to weight the surfels `x`
+    :param top_k: if given, only the `top_k` nearest surfels of every pixel are blended (the others are thrown out)
     """
+    if top_k is not None:
+        idx = torch.where(segmented_topk_mask(idx, z, top_k), idx, torch.full_like(idx, idx.size(-1)))
     new_shape = (x.size(0), x.size(1) + 1, x.size(2))
     x_padding = torch.zeros(x.size(0), 1, x.size(2), device=x.device, dtype=x.dtype)
     x = torch.cat((x, x_padding), -2)
@@ -215,6 +289,40 @@ def scatter_weighted_blended_oit(x, z, center_dist_2, idx, sigma=0.5, z_scale=2,
     return nonzero_divide(C_times_w, alpha_times_w, epsilon=1e-8)[...,:-1,:]
 
 
+def scatter_weighted_blended_oit_grouped(x, z, center_dist_2, idx, sigma=0.5, z_scale=2, use_depth=True, use_center_dist=True, top_k=None):
+    """
+    Same as `scatter_weighted_blended_oit` for K groups of elements (e.g., the 4 bilinear corners of each surfel)
+    that share their depth and distance to the pixel center, in a single `scatter_add_`. Each group is normalized
+    on its own, so the output of group k is the output of `scatter_weighted_blended_oit(x[:, :, k], ..., idx[:, :, k])`.
+
+    :param x: [batch_size, nsurfels, K, surfel_size] surfels to scatter
+    :param z: [batch_size, nsurfels] depth of these surfels
+    :param center_dist_2: [batch_size, nsurfels] squared distance of that surfel to the nearest pixel center
+    :param idx: [batch_size, nsurfels, K] destination index for each surfel and group, in the range [0, nsurfels]
+    :param top_k: if given, only the `top_k` nearest surfels of every pixel and group are blended
+    :return: [batch_size, K, nsurfels, surfel_size]
+    """
+    batch_size, nsurfels, K, C = x.shape
+    group_offset = torch.arange(K, device=idx.device, dtype=idx.dtype) * (nsurfels + 1)
+    if top_k is not None:
+        keep = segmented_topk_mask((idx + group_offset).view(batch_size, -1),
+                                   z.unsqueeze(-1).expand(-1, -1, K).reshape(batch_size, -1), top_k)
+        idx = torch.where(keep.view(idx.shape), idx, torch.full_like(idx, nsurfels))
+
+    alpha = 1 / (2 * np.pi * sigma**2) * torch.exp(-center_dist_2 / (2 * sigma**2))[..., np.newaxis, np.newaxis] if use_center_dist else 1
+    w = torch.exp(-z_scale * z)[..., np.newaxis, np.newaxis] if use_depth else torch.ones_like(z)[..., np.newaxis, np.newaxis]
+    alpha_times_w = (alpha * w).expand(batch_size, nsurfels, K, 1)
+
+    # Scatter the weights along with x, and give each group its own nsurfels + 1 destinations (the last one is thrown out)
+    values = torch.cat((x * alpha * w, alpha_times_w), -1).view(batch_size, -1, C + 1)
+    dest = idx + group_offset
+    dest = dest.view(batch_size, -1, 1).expand(-1, -1, C + 1)
+    out = torch.zeros(batch_size, K * (nsurfels + 1), C + 1, device=x.device, dtype=x.dtype).scatter_add_(-2, dest, values)
+    out = out.view(batch_size, K, nsurfels + 1, C + 1)
+
+    return nonzero_divide(out[..., :C], out[..., C:], epsilon=1e-8)[..., :-1, :]
+
+
 def reflect_ray(incident, normal):
     """
     :param incident: L x N x 3 matrix
@@ -373,6 +481,109 @@ intersection_fn = {'disk': ray_disk_intersection,
                    }
 
 
+def ray_point_dot(ray_orig, ray_dir, pts):
+    """dot(ray_orig - pts, ray_dir) for every point and ray without forming the M x N x 3 offsets
+    :param ray_orig: [1 x 3] or [N x 3] ray origins
+    :param ray_dir: [3 x N] ray directions
+    :param pts: [M x 3] points
+    :return: [M x N] matrix
+    """
+    orig_dot_dir = torch.sum(ray_orig.permute(1, 0) * ray_dir, dim=0)
+    return orig_dot_dir[np.newaxis, :] - torch.mm(pts, ray_dir)
+
+
+def ray_point_dist_sqr(ray_orig, pts):
+    """Squared distance between the ray origins and the points
+    :param ray_orig: [1 x 3] or [N x 3] ray origins
+    :param pts: [M x 3] points
+    :return: [M x 1] or [M x N] matrix
+    """
+    return torch.sum(ray_orig ** 2, dim=-1)[np.newaxis, :] + torch.sum(pts ** 2, dim=-1)[:, np.newaxis] - \
+        2 * torch.mm(pts, ray_orig.permute(1, 0))
+
+
+def ray_sphere_distance(ray_orig, ray_dir, sphere, **kwargs):
+    """Same as ray_sphere_intersection but only returns the [M x N] ray distances"""
+    pos = sphere['pos'][:, :3]
+    radius = sphere['radius']
+
+    a = torch.sum(ray_dir ** 2, dim=0)
+    b = 2 * ray_point_dot(ray_orig, ray_dir, pos)
+    c = ray_point_dist_sqr(ray_orig, pos) - radius[:, np.newaxis] ** 2
+
+    d_sqr = b ** 2 - 4 * a * c
+    intersection_mask = d_sqr >= 0
+
+    d_sqr = where(intersection_mask, d_sqr, 0)
+
+    d = torch.sqrt(d_sqr)
+    inv_denom = 1. / (2 * a)
+
+    t1 = (-b - d) * inv_denom
+    t2 = (-b + d) * inv_denom
+
+    # get the nearest positive depth
+    max_val = torch.max(torch.max(t1, t2)) + 1
+    t1 = where(intersection_mask * (t1 >= 0), t1, max_val)
+    t2 = where(intersection_mask * (t2 >= 0), t2, max_val)
+
+    ray_dist = torch.min(t1, t2)
+    return where(intersection_mask, ray_dist, 1001)
+
+
+def ray_plane_distance(ray_orig, ray_dir, plane, **kwargs):
+    """Same as ray_plane_intersection but only returns the [M x N] ray distances"""
+    pos = plane['pos'][:, :3]
+    normal = normalize(plane['normal'][:, :3])
+    dist = torch.sum(pos * normal, dim=1)
+
+    denom = torch.mm(normal, ray_dir)
+    return (dist.unsqueeze(-1) - torch.mm(normal, ray_orig.permute(1, 0))) / denom
+
+
+def ray_disk_distance(ray_orig, ray_dir, disks, **kwargs):
+    """Same as ray_disk_intersection but only returns the [M x N] ray distances.
+    The squared distance to the disk center is expanded as
+    |o - c|^2 + 2 t dot(o - c, d) + t^2 |d|^2 so that it stays M x N.
+    """
+    ray_dist = ray_plane_distance(ray_orig, ray_dir, disks)
+
+    centers = disks['pos'][:, :3]
+    radius = disks['radius']
+    dist_sqr = ray_point_dist_sqr(ray_orig, centers) + 2 * ray_dist * ray_point_dot(ray_orig, ray_dir, centers) + \
+        ray_dist ** 2 * torch.sum(ray_dir ** 2, dim=0)[np.newaxis, :]
+
+    intersection_mask = (dist_sqr <= radius[:, np.newaxis] ** 2)
+    return where(intersection_mask, ray_dist, 1001)
+
+
+def ray_triangle_distance(ray_orig, ray_dir, triangles, **kwargs):
+    """Same as ray_triangle_intersection but only returns the [M x N] ray distances.
+    The inside test dot(cross(v01, p - v0), n) >= 0 is rewritten as dot(cross(n, v01), p - v0) >= 0
+    with p = o + t d, which only needs M x N matrix products.
+    """
+    face = triangles['face']
+    normal = normalize(triangles['normal'][:, :3])
+    ray_dist = ray_plane_distance(ray_orig, ray_dir, {'pos': face[:, 0, :], 'normal': normal})
+
+    intersection_mask = None
+    for v_start, v_end in [(0, 1), (1, 2), (2, 0)]:
+        edge_normal = torch.cross(normal, face[:, v_end, :3] - face[:, v_start, :3], dim=-1)
+        cond = torch.mm(edge_normal, ray_orig.permute(1, 0)) - \
+            torch.sum(edge_normal * face[:, v_start, :3], dim=-1)[:, np.newaxis] + \
+            ray_dist * torch.mm(edge_normal, ray_dir) >= 0
+        intersection_mask = cond if intersection_mask is None else intersection_mask * cond
+
+    return where(intersection_mask, ray_dist, 1001)
+
+
+distance_fn = {'disk': ray_disk_distance,
+               'plane': ray_plane_distance,
+               'sphere': ray_sphere_distance,
+               'triangle': ray_triangle_distance,
+               }
+
+
 def lookat(eye, at, up):
     """Returns a lookat matrix
     :param eye:
@@ -436,24 +647,28 @@ def make_list2np(var):
     return np.array(var) if type(var) is list else var
 
 
-def generate_rays(camera):
+def screen_size(camera):
+    """Width and height of the image plane at the focal length."""
     viewport = make_list2np(camera['viewport'])
     W, H = viewport[2] - viewport[0], viewport[3] - viewport[1]
     aspect_ratio = float(W) / float(H)
 
-    x, y = np.meshgrid(np.linspace(-1, 1, W), np.linspace(1, -1, H))
-    n_pixels = x.size
-
     fovy = make_list2np(camera['fovy'])
     focal_length = make_list2np(camera['focal_length'])
     h = np.tan(fovy / 2) * 2 * focal_length
     w = h * aspect_ratio
+    return w, h
 
-    x = tch_var_f(x.ravel())
-    y = tch_var_f(y.ravel())
 
-    x *= w / 2
-    y *= h / 2
+def screen_rays(camera, x, y):
+    """Rays through the points (x, y) of the image plane (camera coordinates).
+    :param camera: Camera
+    :param x: [N] horizontal image plane coordinates
+    :param y: [N] vertical image plane coordinates
+    :return: [1 x 3] (perspective) or [N x 3] (orthographic) ray origins and [3 x N] ray directions
+    """
+    n_pixels = x.shape[0]
+    focal_length = make_list2np(camera['focal_length'])
 
     eye = camera['eye'][:3]
     at = camera['at'][:3]
@@ -475,9 +690,67 @@ def generate_rays(camera):
         # normalize ray direction
         ray_dir /= torch.sqrt(torch.sum(ray_dir ** 2, dim=0))
 
+    return ray_orig, ray_dir
+
+
+def generate_rays(camera, jitter=None):
+    """Primary rays through the pixel centers, shifted by `jitter` ((column, row) offset in pixels) if given."""
+    viewport = make_list2np(camera['viewport'])
+    W, H = int(viewport[2] - viewport[0]), int(viewport[3] - viewport[1])
+
+    x, y = np.meshgrid(np.linspace(-1, 1, W), np.linspace(1, -1, H))
+    if jitter is not None:
+        x = x + 2. * jitter[0] / (W - 1)
+        y = y - 2. * jitter[1] / (H - 1)
+    w, h = screen_size(camera)
+
+    x = tch_var_f(x.ravel())
+    y = tch_var_f(y.ravel())
+
+    x *= w / 2
+    y *= h / 2
+
+    ray_orig, ray_dir = screen_rays(camera, x, y)
     return ray_orig, ray_dir, H, W
 
 
+def generate_subpixel_rays(camera, pixel_idx, offsets):
+    """Rays through sub-pixel positions of a set of pixels (same pixel grid as generate_rays).
+    :param camera: Camera
+    :param pixel_idx: [P] flat pixel indices
+    :param offsets: [P x S x 2] (column, row) offsets from the pixel centers, in pixels
+    :return: Ray origins and [3 x P*S] ray directions (see screen_rays), ordered as pixel_idx x S
+    """
+    viewport = make_list2np(camera['viewport'])
+    W, H = int(viewport[2] - viewport[0]), int(viewport[3] - viewport[1])
+    w, h = screen_size(camera)
+    col = (pixel_idx % W).float()[:, np.newaxis] + offsets[..., 0]
+    row = (pixel_idx // W).float()[:, np.newaxis] + offsets[..., 1]
+    x = (2 * col / (W - 1) - 1) * w / 2
+    y = (1 - 2 * row / (H - 1)) * h / 2
+    return screen_rays(camera, x.contiguous().view(-1), y.contiguous().view(-1))
+
+
+def stratified_pixel_sampler(H, W, num_samples):
+    """Stratified random pixel indices for stochastic image losses. The image is split into a grid
+    of at most `num_samples` strata of (almost) equal size and one pixel is drawn per stratum.
+    :return: [P] flat pixel indices, P <= num_samples
+    """
+    strata_h = int(np.clip(np.floor(np.sqrt(num_samples * H / float(W))), 1, H))
+    strata_w = int(np.clip(num_samples // strata_h, 1, W))
+    row_edges = np.floor(np.arange(strata_h + 1) * H / float(strata_h)).astype(int)
+    col_edges = np.floor(np.arange(strata_w + 1) * W / float(strata_w)).astype(int)
+    rows = (row_edges[:-1, np.newaxis] +
+            np.floor(np.random.rand(strata_h, strata_w) * np.diff(row_edges)[:, np.newaxis]).astype(int))
+    cols = col_edges[:-1] + np.floor(np.random.rand(strata_h, strata_w) * np.diff(col_edges)).astype(int)
+    return tch_var_l((rows * W + cols).ravel())
+
+
+def uniform_pixel_sampler(H, W, num_samples):
+    """`num_samples` distinct pixel indices drawn uniformly at random."""
+    return tch_var_l(np.random.choice(H * W, num_samples, replace=False))
+
+
 def ray_object_intersections(eye, ray_dir, scene_objects, **kwargs):
     obj_intersections = None
     ray_dist = None
@@ -512,6 +785,70 @@ def ray_object_intersections(eye, ray_dir, scene_objects, **kwargs):
     return obj_intersections, ray_dist, normals, material_idx
 
 
+def ray_object_distances(eye, ray_dir, scene_objects):
+    """Depth-only counterpart of ray_object_intersections. Only the [M x N] ray distances
+    are computed, i.e., no intersection points or normals.
+    """
+    ray_dist = []
+    material_idx = []
+    for obj_type in scene_objects:
+        curr_ray_dist = distance_fn[obj_type](eye, ray_dir, scene_objects[obj_type])
+        if curr_ray_dist.dim() == 1:
+            curr_ray_dist = curr_ray_dist[np.newaxis, :]
+        ray_dist.append(curr_ray_dist)
+        material_idx.append(scene_objects[obj_type]['material_idx'])
+
+    return torch.cat(ray_dist, dim=0), torch.cat(material_idx, dim=0)
+
+
+class SparseIndexSelect(torch.autograd.Function):
+    """torch.index_select along dim 0 whose gradient is a sparse tensor, e.g., for torch.optim.SparseAdam"""
+    @staticmethod
+    def forward(ctx, x, index):
+        ctx.save_for_backward(index)
+        ctx.shape = x.shape
+        return torch.index_select(x, 0, index)
+
+    @staticmethod
+    def backward(ctx, grad):
+        index, = ctx.saved_tensors
+        return torch.sparse_coo_tensor(index[np.newaxis], grad, ctx.shape).coalesce(), None
+
+
+def num_scene_objects(scene_objects):
+    """Total number of objects of all the types, i.e., the number of rows of ray_object_intersections"""
+    return sum([scene_objects[obj_type]['material_idx'].shape[0] for obj_type in scene_objects])
+
+
+def select_objects(scene_objects, obj_idx, sparse_grad=False):
+    """Subset of the scene geometry.
+
+    The objects are indexed in the order of ray_object_intersections. The gradients of the per-object
+    tensors are only non-zero for the selected objects, and are accumulated with index_add
+    (or are sparse tensors if sparse_grad).
+    :param scene_objects: Dictionary of scene geometry
+    :param obj_idx: [K] sorted object indices, e.g., unique(nearest)
+    :return: Dictionary of the scene geometry of the K objects
+    """
+    subset = {}
+    offset = 0
+    for obj_type in scene_objects:
+        num_objects = scene_objects[obj_type]['material_idx'].shape[0]
+        idx = obj_idx[(obj_idx >= offset) * (obj_idx < offset + num_objects)] - offset
+        offset += num_objects
+        if idx.numel() == 0:
+            continue
+        subset[obj_type] = {}
+        for key, value in scene_objects[obj_type].items():
+            if type(value) is not torch.Tensor or value.dim() == 0 or value.shape[0] != num_objects:
+                subset[obj_type][key] = value
+            elif sparse_grad and value.requires_grad:
+                subset[obj_type][key] = SparseIndexSelect.apply(value, idx)
+            else:
+                subset[obj_type][key] = torch.index_select(value, 0, idx)
+    return subset
+
+
 def backface_labeler(eye, scene_objects):
     """Add a binary label per planar geometry.
        0: Facing the camera.
@@ -745,6 +1082,21 @@ def away_from_camera_penalty(pos, normal, camera_pos=None):
     return torch.sum(torch.nn.functional.relu(-tensor_dot(normal.view(-1, 3), cam_dir, axis=-1)))
 
 
+def away_from_camera_penalty_batched(pos, normal):
+    """
+    Args:
+        pos: [B, ..., 3] positions in the camera's coordinate system
+        normal: [B, ..., 3] normals
+
+    Returns:
+        [B] penalty of each sample
+    """
+    B = pos.shape[0]
+    cam_dir = normalize(-pos.contiguous().view(B, -1, 3))
+    return torch.sum(torch.nn.functional.relu(
+        -tensor_dot(normal.contiguous().view(B, -1, 3), cam_dir, axis=-1)), dim=-1)
+
+
 def pad2d(x, pad, pad_type):
     FN_PADDING_TYPE_MAP = {'replicate': torch.nn.ReplicationPad2d,
                            'reflect': torch.nn.ReflectionPad2d,
@@ -769,6 +1121,50 @@ def pad2d(x, pad, pad_type):
     return xx
 
 
+# Neighbor offsets (dy, dx) of a 3x3 window, in the order of grad_spatial2d
+# 0 1 2
+# 3 - 4
+# 5 6 7
+NEIGHBOR_OFFSETS_3x3 = [(dy, dx) for dy in [-1, 0, 1] for dx in [-1, 0, 1]
+                        if dx != 0 or dy != 0]
+
+
+def spatial_neighbor_diffs(x, pad_type='reflect', order=None):
+    """Yields the neighbor differences of grad_spatial2d one at a time.
+    Args:
+        x: [H, W, C] or [batch, H, W, C] Tensor
+        order: indices into NEIGHBOR_OFFSETS_3x3 (default: all, in order)
+
+    Returns:
+        generator of [..., H, W, C] Tensors
+
+    """
+    x = pad2d(x, (1, 1, 1, 1), pad_type)
+    H, W = x.shape[-3:-1]
+    center = x[..., 1:-1, 1:-1, :]
+    for k in range(len(NEIGHBOR_OFFSETS_3x3)) if order is None else order:
+        dy, dx = NEIGHBOR_OFFSETS_3x3[k]
+        yield x[..., 1 + dy:H + dy - 1, 1 + dx:W + dx - 1, :] - center
+
+
+def grad_spatial2d_reduce(x, fn, pad_type='reflect'):
+    """Sum of fn over the 8 neighbor differences, without materializing
+    the [8, H, W, C] tensor of grad_spatial2d.
+    Args:
+        x: [H, W, C] or [batch, H, W, C] Tensor
+        fn: function of a [..., H, W, C] neighbor difference
+
+    Returns:
+        sum_k fn(grad_spatial2d(x)[k])
+
+    """
+    total = None
+    for diff in spatial_neighbor_diffs(x, pad_type):
+        value = fn(diff)
+        total = value if total is None else total + value
+    return total
+
+
 def grad_spatial2d(x, pad_type='reflect'):
     """
     Args:
@@ -778,18 +1174,7 @@ def grad_spatial2d(x, pad_type='reflect'):
         4D Tensor [8, H, W, C]
 
     """
-    x = pad2d(x, (1, 1, 1, 1), pad_type)
-    H, W = x.shape[:2]
-    center = x[1:-1, 1:-1, :]
-    nbhr_diff = []
-    delta = [-1, 0, 1]
-    for dy in delta:
-        for dx in delta:
-            if dx == 0 and dy == 0:
-                continue
-            nbhr_diff.append(x[1 + dy:H + dy - 1, 1 + dx:W + dx - 1, :] - center)
-
-    return torch.stack(nbhr_diff, dim=0)
+    return torch.stack(list(spatial_neighbor_diffs(x, pad_type)), dim=0)
 
 def grad_spatial2d_batched(x, pad_type='reflect'):
     """
@@ -800,23 +1185,19 @@ def grad_spatial2d_batched(x, pad_type='reflect'):
         5D Tensor [batch, 8, H, W, C]
 
     """
-    x = pad2d(x, (1, 1, 1, 1), pad_type)
-    H, W = x.shape[-3:-1]
-    center = x[..., 1:-1, 1:-1, :]
-    nbhr_diff = []
-    delta = [-1, 0, 1]
-    for dy in delta:
-        for dx in delta:
-            if dx == 0 and dy == 0:
-                continue
-            nbhr_diff.append(x[..., 1 + dy:H + dy - 1, 1 + dx:W + dx - 1, :] - center)
+    return torch.stack(list(spatial_neighbor_diffs(x, pad_type)), dim=-4)
+
 
-    return torch.stack(nbhr_diff, dim=-4)
+def _spatial_3x3_cost(norm):
+    return lambda diff: torch.pow(torch.sum(torch.abs(diff) ** norm, dim=-1), 1 / norm)
 
 
 def spatial_3x3(pos, norm=1):
-    nbhr_diff = grad_spatial2d(pos)
-    return torch.mean(torch.pow(torch.sum(torch.abs(nbhr_diff) ** norm, dim=-1), 1 / norm))
+    return torch.mean(grad_spatial2d_reduce(pos, _spatial_3x3_cost(norm))) / 8
+
+
+def _gradient_consistency_cost(diff):
+    return torch.abs(torch.abs(diff[..., 0]) - torch.abs(diff[..., 1]))
 
 
 def depth_rgb_gradient_consistency(image, depth):
@@ -828,9 +1209,15 @@ def depth_rgb_gradient_consistency(image, depth):
     Returns: consistency loss. The gradients should be the same for diffusely lit scene
 
     """
-    im_grad = grad_spatial2d(torch.mean(image, dim=-1)[..., np.newaxis])
-    depth_grad = grad_spatial2d(depth[..., np.newaxis])
-    return torch.mean(torch.abs(torch.abs(im_grad) - torch.abs(depth_grad)))
+    im_depth = torch.cat([torch.mean(image, dim=-1, keepdim=True),
+                          depth[..., np.newaxis]], dim=-1)
+    return torch.mean(grad_spatial2d_reduce(im_depth, _gradient_consistency_cost)) / 8
+
+
+def _normal_consistency_cost(normal, norm):
+    # Per-pixel |cosine difference|^norm between the unit vectors on the
+    # grid and the normal. We want it to be exactly zero
+    return lambda diff: torch.abs(torch.sum(normalize(diff, 1e-10) * normal, dim=-1)) ** norm
 
 
 def normal_consistency_cost(pos, normal, norm):
@@ -843,12 +1230,47 @@ def normal_consistency_cost(pos, normal, norm):
         mean of cosine difference from the true normal
 
     """
-    # Unit vectors on a grid
-    pos_vector = normalize(grad_spatial2d(pos), 1e-10)
-    # Per-pixel cosine difference
-    dot_prod = torch.sum(pos_vector * normal[np.newaxis, ...], dim=-1)
-    # We want the |cosine_difference|^norm value to be exactly zero
-    return torch.mean(torch.abs(dot_prod) ** norm)
+    return torch.mean(grad_spatial2d_reduce(pos, _normal_consistency_cost(normal, norm))) / 8
+
+
+def spatial_3x3_batched(pos, norm=1):
+    """
+    Args:
+        pos: [B, H, W, C]
+
+    Returns:
+        [B] spatial_3x3 of each sample
+    """
+    cost = grad_spatial2d_reduce(pos, _spatial_3x3_cost(norm))
+    return torch.mean(cost.reshape(pos.shape[0], -1), dim=-1) / 8
+
+
+def depth_rgb_gradient_consistency_batched(image, depth):
+    """
+    Args:
+        image: [B, H, W, 3] RGB images
+        depth: [B, H, W] depth images
+
+    Returns:
+        [B] depth_rgb_gradient_consistency of each sample
+    """
+    im_depth = torch.cat([torch.mean(image, dim=-1, keepdim=True),
+                          depth[..., np.newaxis]], dim=-1)
+    cost = grad_spatial2d_reduce(im_depth, _gradient_consistency_cost)
+    return torch.mean(cost.reshape(image.shape[0], -1), dim=-1) / 8
+
+
+def normal_consistency_cost_batched(pos, normal, norm):
+    """
+    Args:
+        pos: [B, H, W, 3] position
+        normal: [B, H, W, 3] normals
+
+    Returns:
+        [B] normal_consistency_cost of each sample
+    """
+    cost = grad_spatial2d_reduce(pos, _normal_consistency_cost(normal, norm))
+    return torch.mean(cost.reshape(pos.shape[0], -1), dim=-1) / 8
 
 
 def find_average_normal(pos, kernel_size):
@@ -860,7 +1282,6 @@ def find_average_normal(pos, kernel_size):
     Returns:
 
     """
-    nbhr_diff = normalize(grad_spatial2d(pos), 1e-10)
     # cross-prod of neighboring difference
     # 0 1 2
     # 3 4 5
@@ -870,17 +1291,49 @@ def find_average_normal(pos, kernel_size):
     # 3 - 4
     # 5 6 7
     # Take cross products in counter-clockwise direction
-    normal = torch.stack([torch.cross(nbhr_diff[4], nbhr_diff[2], dim=-1),
-                          torch.cross(nbhr_diff[2], nbhr_diff[1], dim=-1),
-                          torch.cross(nbhr_diff[1], nbhr_diff[0], dim=-1),
-                          torch.cross(nbhr_diff[0], nbhr_diff[3], dim=-1),
-                          torch.cross(nbhr_diff[3], nbhr_diff[5], dim=-1),
-                          torch.cross(nbhr_diff[5], nbhr_diff[6], dim=-1),
-                          torch.cross(nbhr_diff[6], nbhr_diff[7], dim=-1),
-                          torch.cross(nbhr_diff[7], nbhr_diff[4], dim=-1)], dim=0)
-    if np.any(np.isnan(get_data(normal))):
+    normal = None
+    first = prev = None
+    for diff in spatial_neighbor_diffs(pos, order=[4, 2, 1, 0, 3, 5, 6, 7]):
+        diff = normalize(diff, 1e-10)
+        if prev is None:
+            first = diff
+        else:
+            cross = torch.cross(prev, diff, dim=-1)
+            normal = cross if normal is None else normal + cross
+        prev = diff
+    normal = normal + torch.cross(prev, first, dim=-1)
+    if not STRICT_NO_SYNC:
         assert not np.any(np.isnan(get_data(normal)))
-    return torch.clamp(normalize(torch.mean(normal, dim=0), 1e-10), 0.0, 1.0)
+    return torch.clamp(normalize(normal / 8, 1e-10), 0.0, 1.0)
+
+
+def plane_fit_normals(pos):
+    """Least squares solution of the plane fit of
+    estimate_surface_normals_plane_fit. The normal equations only need the
+    sums over the neighbors of the products of the normalized differences,
+    so they are accumulated one neighbor at a time.
+    Args:
+        pos: [..., H, W, 3]
+
+    Returns:
+        normals: [..., H, W, 3]
+
+    """
+    a = b = d = u = v = 0
+    for diff in spatial_neighbor_diffs(pos):
+        diff = normalize(diff, 1e-10)
+        dx, dy, dz = diff[..., 0], diff[..., 1], diff[..., 2]
+        # M^TM = [[a, b], [b, d]] and -M^T (z - z0) = [u, v]
+        a = a + dx * dx
+        b = b + dx * dy
+        d = d + dy * dy
+        u = u - dx * dz
+        v = v - dy * dz
+    # (M^TM)^{-1} = [[d, -b], [-b, a]] / (ad - b^2)
+    det = a * d - b * b + 1e-12
+    normal = torch.stack([(d * u - b * v) / det, (a * v - b * u) / det,
+                          torch.ones_like(det)], dim=-1)
+    return normalize(normal)
 
 
 def estimate_surface_normals_plane_fit(pos, kernel_size):
@@ -907,21 +1360,7 @@ def estimate_surface_normals_plane_fit(pos, kernel_size):
         normals: [num_positions, 3]
 
     """
-    nbhr_diff = normalize(grad_spatial2d(pos), 1e-10)
-    nbhr_diff = nbhr_diff.view(nbhr_diff.shape[0], -1, 3)
-    M = nbhr_diff[:, :, :2].transpose(1, 0)
-    Mt = M.transpose(2, 1)
-    MtM = Mt.matmul(M)
-    ad_m_bc = MtM[:, 0, 0] * MtM[:, 1, 1] - MtM[:, 0, 1] * MtM[:, 1, 0]
-    # [[a, b], [c, d]] --> [[d, -b], [-c, a]]
-    MtM = MtM.index_select(1, tch_var_l([1, 0])).transpose(2, 1).index_select(1, tch_var_l([1, 0])) * \
-          tch_var_f([[1, -1], [-1, 1]])[np.newaxis, ...]
-    MtMinv = MtM / (ad_m_bc[:, np.newaxis, np.newaxis] + 1e-12)
-    # (M^TM)^{-1}M^T -(z - z0)
-    normal = MtMinv.matmul(Mt.matmul(-nbhr_diff[..., 2].transpose(1, 0)[:, :, np.newaxis])).squeeze()
-    normal = torch.cat([normal, tch_var_f(np.ones((normal.shape[0], 1)))], dim=1).view(pos.shape)
-
-    return normalize(normal)
+    return plane_fit_normals(pos)
 
 def estimate_surface_normals_plane_fit_batched(pos):
     """Performs constrained plane estimation with the requirements that
@@ -946,21 +1385,7 @@ def estimate_surface_normals_plane_fit_batched(pos):
         normals: [batch, H, W, 3]
 
     """
-    nbhr_diff = normalize(grad_spatial2d_batched(pos), 1e-10) # [batch, 8, H, W, 3]
-    nbhr_diff = nbhr_diff.view(*nbhr_diff.shape[:-3], -1, 3) # [batch, 8, num_positions, 3]
-    M = nbhr_diff[..., :2].transpose(-2, -3) # [batch, num_positions, 8, 2]
-    Mt = M.transpose(-1, -2) # [batch, num_positions, 2, 8]
-    MtM = Mt.matmul(M) # [batch, num_positions, 2, 2]
-    ad_m_bc = MtM[..., 0, 0] * MtM[..., 1, 1] - MtM[..., 0, 1] * MtM[..., 1, 0] # [batch, num_positions]
-    # [[a, b], [c, d]] --> [[d, -b], [-c, a]]
-    MtM = MtM.index_select(-2, tch_var_l([1, 0])).transpose(-1, -2).index_select(-2, tch_var_l([1, 0])) * \
-          tch_var_f([[1, -1], [-1, 1]]) # flip the rows, transpose, flip again, then multiply by this matrix results in inverse
-    MtMinv = MtM / (ad_m_bc.unsqueeze(-1).unsqueeze(-1) + 1e-12) # [batch, num_positions, 2, 2]
-    # -(M^TM)^{-1}M^T (z - z0)
-    normal = MtMinv.matmul(Mt.matmul(-nbhr_diff[..., 2].transpose(-1, -2).unsqueeze(-1))).squeeze(-1) # [batch, num_positions, 2]
-    normal = torch.cat([normal, tch_var_f(np.ones((*normal.shape[:-1], 1)))], dim=-1).view(pos.shape)
-
-    return normalize(normal)
+    return plane_fit_normals(pos)
 
 
 NORMAL_EST_FN_MAP = {'plane': estimate_surface_normals_plane_fit,